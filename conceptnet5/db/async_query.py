@@ -0,0 +1,77 @@
+"""
+An asyncio interface to the ConceptNet database, for use by asynchronous
+Web front ends.
+
+pg8000 has no asynchronous API, so the queries themselves are run by a
+pool of worker threads, each of which checks out its own connection from the
+AssertionFinder's ConnectionPool. The event loop is never blocked on the
+database, and lookups that are awaited together -- for example, with
+`asyncio.gather` -- run at the same time on different connections.
+"""
+import asyncio
+import functools
+from concurrent.futures import ThreadPoolExecutor
+
+from conceptnet5.db import config
+from conceptnet5.db.query import make_finder
+
+
+class AsyncAssertionFinder(object):
+    """
+    An asynchronous version of AssertionFinder. Its methods take the same
+    arguments as AssertionFinder's, and are coroutines.
+
+    `max_workers` is the number of queries that can run at once. It
+    defaults to the size of the connection pool, because more threads than
+    that would only wait for a connection.
+    """
+    def __init__(self, dbname=None, max_workers=None, finder=None):
+        self.finder = finder or make_finder(dbname)
+        self.executor = ThreadPoolExecutor(max_workers=max_workers or config.DB_POOL_SIZE)
+
+    async def _run(self, func, *args, **kwargs):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            self.executor, functools.partial(func, *args, **kwargs)
+        )
+
+    async def lookup(self, uri, limit=100, offset=0, after=None, raw=False):
+        return await self._run(
+            self.finder.lookup, uri, limit=limit, offset=offset, after=after, raw=raw
+        )
+
+    async def lookup_many(self, uris, limit_per_uri=20):
+        return await self._run(self.finder.lookup_many, uris, limit_per_uri=limit_per_uri)
+
+    async def lookup_grouped_by_feature(self, uri, limit=20):
+        return await self._run(self.finder.lookup_grouped_by_feature, uri, limit=limit)
+
+    async def lookup_feature_summary(self, uri, limit=20):
+        return await self._run(self.finder.lookup_feature_summary, uri, limit=limit)
+
+    async def complete_terms(self, language, text, limit=10):
+        return await self._run(self.finder.complete_terms, language, text, limit=limit)
+
+    async def fuzzy_terms(self, language, text, limit=10):
+        return await self._run(self.finder.fuzzy_terms, language, text, limit=limit)
+
+    async def lookup_assertion(self, uri):
+        return await self._run(self.finder.lookup_assertion, uri)
+
+    async def query(self, criteria, limit=20, offset=0, after=None, raw=False):
+        return await self._run(
+            self.finder.query, criteria, limit=limit, offset=offset, after=after, raw=raw
+        )
+
+    async def sample_dataset(self, uri, limit=50, offset=0):
+        return await self._run(self.finder.sample_dataset, uri, limit=limit, offset=offset)
+
+    async def random_edges(self, limit=20):
+        return await self._run(self.finder.random_edges, limit=limit)
+
+    def close(self):
+        """
+        Stop the worker threads, after letting any queries in progress
+        finish.
+        """
+        self.executor.shutdown(wait=True)
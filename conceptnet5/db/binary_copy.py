@@ -0,0 +1,280 @@
+"""
+Load the assertions into the database without writing CSV files first.
+
+`stream_load` converts the assertions into rows the same way that
+`prepare_data.assertions_to_sql_csv` does, but encodes each table's rows
+in PostgreSQL's binary COPY format and sends them through a CopyPipe to a
+COPY that's running on its own connection. All the tables are loaded at
+once, while the assertions are being read.
+
+The CSV files can still be written at the same time, gzipped, for
+distributing the data.
+"""
+from concurrent.futures import ThreadPoolExecutor
+import os
+import queue
+import struct
+import threading
+
+from conceptnet5.db.prepare_data import (
+    CSV_NAMES, RowWriter, convert_assertions, strip_separators
+)
+from conceptnet5.db.schema import run_tasks
+
+# The types of the columns of each table, as created by schema.TABLES
+TABLE_TYPES = {
+    'nodes': ['integer', 'text'],
+    'sources': ['integer', 'text'],
+    'relations': ['integer', 'text', 'bool'],
+    'edges': ['integer', 'text', 'integer', 'integer', 'integer', 'real', 'jsonb'],
+    'edges_ld': ['integer', 'text'],
+    'edge_sources': ['integer', 'integer'],
+    'node_prefixes': ['integer', 'integer'],
+    'edge_features': ['integer', 'integer', 'integer', 'integer'],
+}
+
+# The signature, flags, and header extension length that start binary COPY
+# data, and the field count that ends it
+COPY_HEADER = b'PGCOPY\n\xff\r\n\x00' + struct.pack('>ii', 0, 0)
+COPY_TRAILER = struct.pack('>h', -1)
+
+# How many bytes of rows to send through a CopyPipe at a time, and how many
+# of those chunks can be waiting in it
+CHUNK_SIZE = 1 << 20
+PIPE_CHUNKS = 8
+
+_LENGTH = struct.Struct('>i')
+_INTEGER = struct.Struct('>ii')
+_REAL = struct.Struct('>if')
+_JSONB_VERSION = b'\x01'
+
+
+def _encode_integer(buf, value):
+    buf += _INTEGER.pack(4, value)
+
+
+def _encode_real(buf, value):
+    buf += _REAL.pack(4, value)
+
+
+def _encode_bool(buf, value):
+    buf += _LENGTH.pack(1)
+    buf += b'\x01' if value else b'\x00'
+
+
+def _encode_text(buf, value):
+    data = strip_separators(value).encode('utf-8')
+    buf += _LENGTH.pack(len(data))
+    buf += data
+
+
+def _encode_jsonb(buf, value):
+    data = strip_separators(value).encode('utf-8')
+    buf += _LENGTH.pack(len(data) + 1)
+    buf += _JSONB_VERSION
+    buf += data
+
+
+ENCODERS = {
+    'integer': _encode_integer,
+    'real': _encode_real,
+    'bool': _encode_bool,
+    'text': _encode_text,
+    'jsonb': _encode_jsonb,
+}
+
+
+class PipeClosed(IOError):
+    """
+    Raised on one end of a CopyPipe when the other end has failed.
+    """
+    pass
+
+
+# Sent through a CopyPipe in place of data when the writer has failed
+_ABORT = object()
+
+
+class CopyPipe(object):
+    """
+    A bounded stream of bytes from a thread that writes it to a thread
+    that's running a COPY, which reads it like a file.
+    """
+    def __init__(self, max_chunks=PIPE_CHUNKS):
+        self.queue = queue.Queue(max_chunks)
+        self.reader_failed = threading.Event()
+        self.chunk = memoryview(b'')
+        self.pos = 0
+        self.eof = False
+
+    def _put(self, item):
+        while True:
+            if self.reader_failed.is_set():
+                raise PipeClosed("The COPY reading this data has failed")
+            try:
+                self.queue.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                pass
+
+    def write(self, data):
+        if data:
+            self._put(data)
+
+    def close(self):
+        """
+        Tell the reader that the data is complete.
+        """
+        self._put(b'')
+
+    def abort(self):
+        """
+        Tell the reader that the data will never be complete, so that its
+        COPY fails instead of loading part of the table.
+        """
+        try:
+            self._put(_ABORT)
+        except PipeClosed:
+            pass
+
+    def fail_reader(self):
+        """
+        Tell the writer that nothing is reading the data anymore.
+        """
+        self.reader_failed.set()
+
+    def read(self, size=-1):
+        while self.pos >= len(self.chunk):
+            if self.eof:
+                return b''
+            item = self.queue.get()
+            if item is _ABORT:
+                raise PipeClosed("The data for this COPY stopped before it was complete")
+            if not item:
+                self.eof = True
+                return b''
+            self.chunk = memoryview(item)
+            self.pos = 0
+        if size is None or size < 0:
+            end = len(self.chunk)
+        else:
+            end = min(self.pos + size, len(self.chunk))
+        data = bytes(self.chunk[self.pos:end])
+        self.pos = end
+        return data
+
+
+class BinaryCopyWriter(object):
+    """
+    Encodes rows of a table in binary COPY format, and writes them to a
+    CopyPipe a chunk at a time. It has the same `write_row` and `close`
+    methods as prepare_data.RowWriter.
+    """
+    def __init__(self, pipe, column_types):
+        self.pipe = pipe
+        self.encoders = [ENCODERS[column_type] for column_type in column_types]
+        self.row_header = struct.pack('>h', len(column_types))
+        self.buffer = bytearray(COPY_HEADER)
+
+    def write_row(self, items):
+        buf = self.buffer
+        buf += self.row_header
+        for encode, item in zip(self.encoders, items):
+            encode(buf, item)
+        if len(buf) >= CHUNK_SIZE:
+            self.flush()
+
+    def flush(self):
+        if self.buffer:
+            self.pipe.write(bytes(self.buffer))
+            self.buffer = bytearray()
+
+    def close(self):
+        self.buffer += COPY_TRAILER
+        self.flush()
+        self.pipe.close()
+
+
+class TeeWriter(object):
+    """
+    Gives each row to several writers.
+    """
+    def __init__(self, writers):
+        self.writers = writers
+
+    def write_row(self, items):
+        for writer in self.writers:
+            writer.write_row(items)
+
+    def close(self):
+        for writer in self.writers:
+            writer.close()
+
+
+def stream_load(pool, msgpack_filename, compact=False, tee_dir=None):
+    """
+    Load the assertions in `msgpack_filename` into the tables, which must
+    already exist, using one connection from `pool` per table.
+
+    If `tee_dir` is given, also write the gzipped CSV files that
+    `prepare_data` would have written (as `<table>.csv.gz`) there.
+    """
+    # A COPY that's waiting for a connection would stop reading its pipe,
+    # and then the others would stop getting data
+    if pool.size < len(CSV_NAMES):
+        raise ValueError("Loading the tables at once needs %d connections" % len(CSV_NAMES))
+    pipes = {name: CopyPipe() for name in CSV_NAMES}
+    copy_writers = {
+        name: BinaryCopyWriter(pipes[name], TABLE_TYPES[name])
+        for name in CSV_NAMES
+    }
+    csv_writers = {}
+    if tee_dir is not None:
+        csv_writers = {
+            name: RowWriter(os.path.join(tee_dir, name + '.csv.gz'))
+            for name in CSV_NAMES
+        }
+    writers = {}
+    for name in CSV_NAMES:
+        if name in csv_writers:
+            writers[name] = TeeWriter([copy_writers[name], csv_writers[name]])
+        else:
+            writers[name] = copy_writers[name]
+    tasks = [
+        ('COPY %s' % name, _binary_copy_task(name, pipes[name]))
+        for name in CSV_NAMES
+    ]
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        copying = executor.submit(run_tasks, pool, tasks, len(tasks))
+        try:
+            convert_assertions(msgpack_filename, writers, compact)
+            for writer in copy_writers.values():
+                writer.close()
+        except PipeClosed:
+            # One of the COPYs failed, and its error says why
+            for pipe in pipes.values():
+                pipe.abort()
+            copying.result()
+            raise
+        except BaseException:
+            for pipe in pipes.values():
+                pipe.abort()
+            raise
+        finally:
+            for writer in csv_writers.values():
+                writer.close()
+        copying.result()
+
+
+def _binary_copy_task(tablename, pipe):
+    def copy(pooled):
+        cursor = pooled.connection.cursor()
+        try:
+            cursor.execute("COPY %s FROM STDIN WITH (FORMAT binary)" % tablename, stream=pipe)
+        except BaseException:
+            pipe.fail_reader()
+            raise
+        finally:
+            cursor.close()
+        pooled.connection.commit()
+    return copy
@@ -0,0 +1,156 @@
+"""
+Caches for the results that AssertionFinder returns.
+
+ConceptNet's data doesn't change between builds, so a cached result stays
+valid until the database is reloaded. AssertionFinder includes the build ID
+(see `conceptnet5.db.connection.get_build_id`) and the active version of the
+data (see `conceptnet5.db.versions`) in every cache key, so results from an
+old build are never used again, and eventually get evicted.
+
+Cached results are shared by everything that asks for them, so they must be
+treated as read-only.
+"""
+from collections import OrderedDict
+import hashlib
+import pickle
+import sys
+import threading
+import time
+
+from conceptnet5.db import config
+
+
+class LRUCache(object):
+    """
+    A thread-safe cache in the memory of this process, which holds up to
+    `size` values and evicts the least recently used ones. If `ttl` is
+    set, values also expire that many seconds after they were stored.
+    """
+    def __init__(self, size=1000, ttl=None):
+        self.size = size
+        self.ttl = ttl or None
+        self.hits = 0
+        self.misses = 0
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """
+        Get the value for `key`, or None if it isn't in the cache.
+        """
+        with self._lock:
+            item = self._items.get(key)
+            if item is not None:
+                value, expires = item
+                if expires is None or expires > time.monotonic():
+                    self._items.move_to_end(key)
+                    self.hits += 1
+                    return value
+                del self._items[key]
+            self.misses += 1
+            return None
+
+    def set(self, key, value):
+        expires = None
+        if self.ttl is not None:
+            expires = time.monotonic() + self.ttl
+        with self._lock:
+            self._items[key] = (value, expires)
+            self._items.move_to_end(key)
+            while len(self._items) > self.size:
+                self._items.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+
+    def stats(self):
+        with self._lock:
+            return {
+                'backend': 'local',
+                'hits': self.hits,
+                'misses': self.misses,
+                'size': len(self._items)
+            }
+
+
+class UWSGICache(object):
+    """
+    A cache stored in the shared memory of a uWSGI server, so that all of
+    its worker processes share the same cached results. The cache has to be
+    configured in uWSGI, with a `cache2` option whose name matches `name`,
+    such as:
+
+        cache2 = name=conceptnet,items=10000,blocks=20000,blocksize=8192,bitmap=1
+
+    Caches that hold different kinds of values need different names, so that
+    they can't return each other's values or clear each other.
+
+    uWSGI handles eviction and expiration. The hit and miss counts are for
+    this process only.
+    """
+    def __init__(self, name='conceptnet', ttl=None):
+        import uwsgi
+        self.uwsgi = uwsgi
+        self.name = name
+        self.ttl = int(ttl or 0)
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def _key(key):
+        return hashlib.sha1(repr(key).encode('utf-8')).hexdigest()
+
+    def get(self, key):
+        data = self.uwsgi.cache_get(self._key(key), self.name)
+        if data is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return pickle.loads(data)
+
+    def set(self, key, value):
+        # This fails silently if the value is too large to cache
+        data = pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+        self.uwsgi.cache_update(self._key(key), data, self.ttl, self.name)
+
+    def clear(self):
+        self.uwsgi.cache_clear(self.name)
+
+    def stats(self):
+        return {
+            'backend': 'uwsgi',
+            'hits': self.hits,
+            'misses': self.misses
+        }
+
+
+def make_cache(backend=None, size=None, ttl=None, name='conceptnet'):
+    """
+    Make the cache that's configured by the CONCEPTNET_DB_CACHE environment
+    variables, or return None if caching is turned off. The arguments
+    override the configuration.
+
+    `name` is the name of the uWSGI cache to use, if the backend is "uwsgi".
+    If that backend is requested when we're not running in uWSGI, we fall
+    back on a cache local to this process.
+    """
+    backend = backend or config.DB_CACHE
+    size = size or config.DB_CACHE_SIZE
+    if ttl is None:
+        ttl = config.DB_CACHE_TTL
+    if backend == 'none':
+        return None
+    elif backend == 'uwsgi':
+        try:
+            return UWSGICache(name=name, ttl=ttl)
+        except ImportError:
+            print(
+                "Not running in uWSGI, so results will be cached in each process",
+                file=sys.stderr
+            )
+            return LRUCache(size=size, ttl=ttl)
+    elif backend == 'local':
+        return LRUCache(size=size, ttl=ttl)
+    else:
+        raise ValueError("Unknown cache backend: %r" % backend)
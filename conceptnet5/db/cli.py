@@ -1,7 +1,19 @@
 import click
-from .connection import get_db_connection, check_db_connection
-from .prepare_data import assertions_to_sql_csv, load_sql_csv
-from .schema import create_tables, create_indices
+import os
+import sys
+import time
+from conceptnet5.db import config
+from conceptnet5.util import get_data_filename
+from .connection import get_db_connection, check_db_connection, ConnectionPool
+from .binary_copy import stream_load
+from .prepare_data import (
+    CSV_NAMES, assertions_to_sql_csv, load_sql_csv, merge_shards, prepare_sharded
+)
+from .schema import create_tables, create_indices, set_tables_logged, MEMORY_SETTING_RE
+from .versions import (
+    activate_version, create_version_schema, drop_version, get_active_version,
+    list_versions, mark_version_loaded
+)
 
 
 @click.group()
@@ -12,17 +24,192 @@ def cli():
 @cli.command(name='prepare_data')
 @click.argument('input_filename', type=click.Path(readable=True, dir_okay=False))
 @click.argument('output_dir', type=click.Path(writable=True, dir_okay=True, file_okay=False))
-def prepare_data(input_filename, output_dir):
-    assertions_to_sql_csv(input_filename, output_dir)
+@click.option('--compact', is_flag=True,
+              help='Store edges with ids instead of URIs (serve them with CONCEPTNET_DB_COMPACT=1)')
+@click.option('--shards', type=click.IntRange(1, 65535), default=1,
+              help='Divide the assertions among this many processes')
+@click.option('--shard', type=int, default=None,
+              help='Only write this shard, to be combined later with merge_shards')
+def prepare_data(input_filename, output_dir, compact, shards, shard):
+    if shard is not None:
+        if not 0 <= shard < shards:
+            raise click.BadParameter("must be between 0 and --shards - 1", param_hint='--shard')
+        assertions_to_sql_csv(input_filename, output_dir, compact, shards, shard)
+    elif shards > 1:
+        prepare_sharded(input_filename, output_dir, shards, compact)
+    else:
+        assertions_to_sql_csv(input_filename, output_dir, compact=compact)
+
+
+@cli.command(name='merge_shards')
+@click.argument('output_dir', type=click.Path(writable=True, dir_okay=True, file_okay=False))
+@click.argument('shard_dirs', nargs=-1, required=True,
+                type=click.Path(readable=True, dir_okay=True, file_okay=False))
+@click.option('--compact', is_flag=True, help='The shards were written with --compact')
+def run_merge_shards(output_dir, shard_dirs, compact):
+    """
+    Combine the shards written by prepare_data --shard.
+    """
+    merge_shards(shard_dirs, output_dir, compact)
+
+
+@cli.command(name='build_embedded')
+@click.argument('input_filename', type=click.Path(readable=True, dir_okay=False))
+@click.argument('output_dir', type=click.Path(writable=True, dir_okay=True, file_okay=False))
+def run_build_embedded(input_filename, output_dir):
+    """
+    Build the files that serve the API without a database
+    (with CONCEPTNET_DB_BACKEND=embedded).
+    """
+    from .embedded import build_embedded
+    build_embedded(input_filename, output_dir)
+
+
+@cli.command(name='build_completions')
+@click.argument('input_filename', type=click.Path(readable=True, dir_okay=False))
+@click.argument('output_dir', type=click.Path(writable=True, dir_okay=True, file_okay=False))
+def run_build_completions(input_filename, output_dir):
+    """
+    Build the files that /search/prefix uses to complete terms quickly.
+    """
+    from .completions import build_completions
+    build_completions(input_filename, output_dir)
+
+
+def load_options(func):
+    """
+    Add the options that control how the database is loaded, which are
+    shared by load_data and stream_load.
+    """
+    options = [
+        click.option('--jobs', '-j', type=click.IntRange(1, None), default=4,
+                     help='How many connections to load tables and build indices over at once'),
+        click.option('--maintenance-work-mem', default='256MB',
+                     help="PostgreSQL's maintenance_work_mem for each index build, such as 1GB"),
+        click.option('--version', default=None,
+                     help='Load the data as a separate version, leaving the active one in place'),
+        click.option('--activate', is_flag=True,
+                     help='Make the version active once it has been loaded'),
+    ]
+    for option in reversed(options):
+        func = option(func)
+    return func
+
+
+def run_load(load_tables, jobs, maintenance_work_mem, version, activate, pool_size=None):
+    """
+    Create the tables, call `load_tables` with a ConnectionPool to fill
+    them, and then build their indices.
+    """
+    if not MEMORY_SETTING_RE.match(maintenance_work_mem):
+        raise click.BadParameter(
+            "should be an amount of memory such as 256MB",
+            param_hint='--maintenance-work-mem'
+        )
+    if activate and version is None:
+        raise click.BadParameter("requires --version", param_hint='--activate')
+    start_time = time.monotonic()
+    conn = get_db_connection(building=True)
+    if version is not None:
+        try:
+            create_version_schema(conn, version)
+        except ValueError as err:
+            raise click.ClickException(str(err))
+    create_tables(conn)
+    pool = ConnectionPool(
+        config.DB_NAME, size=max(jobs, pool_size or 0), version=version,
+        follow_active=False, statement_timeout=0
+    )
+    try:
+        load_tables(pool)
+        set_tables_logged(pool, jobs)
+        create_indices(pool, jobs, maintenance_work_mem)
+    finally:
+        pool.close_idle()
+    if version is not None:
+        mark_version_loaded(conn, version)
+    print("%7.1fs  total" % (time.monotonic() - start_time), file=sys.stderr)
+    if activate:
+        activate_version(conn, version)
+        mark_db_updated()
 
 
 @cli.command(name='load_data')
 @click.argument('input_dir', type=click.Path(readable=True, writable=True, dir_okay=True, file_okay=False))
-def load_data(input_dir):
+@load_options
+def load_data(input_dir, jobs, maintenance_work_mem, version, activate):
+    run_load(
+        lambda pool: load_sql_csv(pool, input_dir, jobs),
+        jobs, maintenance_work_mem, version, activate
+    )
+
+
+@cli.command(name='stream_load')
+@click.argument('input_filename', type=click.Path(readable=True, dir_okay=False))
+@click.option('--compact', is_flag=True,
+              help='Store edges with ids instead of URIs (serve them with CONCEPTNET_DB_COMPACT=1)')
+@click.option('--csv-dir', type=click.Path(writable=True, dir_okay=True, file_okay=False),
+              default=None, help='Also write the gzipped CSV files to this directory')
+@load_options
+def run_stream_load(input_filename, compact, csv_dir, jobs, maintenance_work_mem, version, activate):
+    """
+    Load assertions.msgpack straight into the database, without writing
+    uncompressed CSV files. Every table is loaded at once, on its own
+    connection, whatever --jobs is.
+    """
+    run_load(
+        lambda pool: stream_load(pool, input_filename, compact, csv_dir),
+        jobs, maintenance_work_mem, version, activate, pool_size=len(CSV_NAMES)
+    )
+
+
+@cli.command(name='activate')
+@click.argument('version')
+def activate(version):
+    """
+    Switch the API to a version that has been loaded with load_data --version.
+    """
     conn = get_db_connection(building=True)
-    create_tables(conn)
-    load_sql_csv(conn, input_dir)
-    create_indices(conn)
+    try:
+        activate_version(conn, version)
+    except ValueError as err:
+        raise click.ClickException(str(err))
+    mark_db_updated()
+
+
+@cli.command(name='versions')
+def versions():
+    """
+    List the versions that have been loaded, marking the active one.
+    """
+    conn = get_db_connection(building=True)
+    active = get_active_version(conn)
+    for version in list_versions(conn):
+        marker = '*' if version == active else ' '
+        click.echo('%s %s' % (marker, version))
+
+
+@cli.command(name='drop_version')
+@click.argument('version')
+def run_drop_version(version):
+    """
+    Remove a version that isn't active.
+    """
+    conn = get_db_connection(building=True)
+    try:
+        drop_version(conn, version)
+    except ValueError as err:
+        raise click.ClickException(str(err))
+
+
+def mark_db_updated():
+    """
+    Update the modification time of the file that marks the database as
+    built, which changes the build ID that query results are cached under.
+    """
+    done_filename = get_data_filename('psql/done')
+    if os.access(done_filename, os.F_OK):
+        os.utime(done_filename)
 
 
 @cli.command(name='check')
@@ -0,0 +1,127 @@
+"""
+A compact way to store edges in the database.
+
+Normally, the `data` column of the `edges` table contains the whole edge,
+including the URIs of its relation, nodes, dataset, and sources, which are
+repeated in every edge that uses them. In a compact build (made with
+`cn5-db prepare_data --compact`), those URIs are replaced by the ids of the
+rows in the `relations`, `nodes`, and `sources` tables, and the edge's URI
+is left out when it can be reconstructed from its relation and nodes.
+
+The full edges are rebuilt when they're read, by a CompactEdgeDecoder,
+which keeps the relations and sources in memory and caches the URIs of
+nodes that it has looked up recently.
+"""
+from conceptnet5.db.cache import LRUCache
+from conceptnet5.uri import assertion_uri
+
+# The fields that are replaced by ids, or removed, in a compact edge
+COMPACTED_FIELDS = {'uri', 'rel', 'start', 'end', 'dataset', 'sources', 'features'}
+
+NODE_CACHE_SIZE = 100000
+
+NODE_URIS_QUERY = "SELECT id, uri FROM nodes WHERE id = ANY(CAST(:ids AS integer[]))"
+
+
+def compact_edge(assertion, rel_idx, start_idx, end_idx, dataset_idx, source_index):
+    """
+    Make the compact form of an assertion, given the ids of its relation,
+    nodes, and dataset, and a function that gets the id of a source URI.
+    """
+    compact = {
+        key: value for (key, value) in assertion.items()
+        if key not in COMPACTED_FIELDS
+    }
+    compact['rel'] = rel_idx
+    compact['start'] = start_idx
+    compact['end'] = end_idx
+    compact['dataset'] = dataset_idx
+    compact['sources'] = [
+        {key: source_index(value) for (key, value) in source.items()}
+        for source in assertion['sources']
+    ]
+    if assertion['uri'] != assertion_uri(assertion['rel'], assertion['start'], assertion['end']):
+        compact['uri'] = assertion['uri']
+    return compact
+
+
+def is_compact(data):
+    """
+    Determine whether the data of an edge is in the compact form.
+    """
+    return isinstance(data.get('rel'), int)
+
+
+class CompactEdgeDecoder(object):
+    """
+    Rebuilds full edges from their compact form. `fetchall` is a function
+    that runs a query and returns its rows, such as
+    `AssertionFinder._fetchall`.
+
+    The decoder remembers URIs from one build of the database, identified
+    by the `build_key` passed to `decode_many`, and forgets them when the
+    database changes.
+    """
+    def __init__(self, fetchall, node_cache_size=NODE_CACHE_SIZE):
+        self.fetchall = fetchall
+        self.node_cache_size = node_cache_size
+        self.build_key = None
+        self.relations = None
+        self.sources = None
+        self.nodes = LRUCache(size=node_cache_size)
+
+    def _load(self, build_key):
+        if self.relations is None or build_key != self.build_key:
+            self.relations = dict(self.fetchall("SELECT id, uri FROM relations"))
+            self.sources = dict(self.fetchall("SELECT id, uri FROM sources"))
+            self.nodes = LRUCache(size=self.node_cache_size)
+            self.build_key = build_key
+
+    def _node_uris(self, node_ids):
+        """
+        Get a dictionary from node ids to their URIs, fetching the ones that
+        aren't cached in a single query.
+        """
+        uris = {}
+        missing = []
+        for node_id in node_ids:
+            uri = self.nodes.get(node_id)
+            if uri is None:
+                missing.append(node_id)
+            else:
+                uris[node_id] = uri
+        if missing:
+            for node_id, uri in self.fetchall(NODE_URIS_QUERY, {'ids': missing}):
+                self.nodes.set(node_id, uri)
+                uris[node_id] = uri
+        return uris
+
+    def decode_many(self, datas, build_key=None):
+        """
+        Rebuild a list of edges from their compact data. Data that isn't
+        compact is passed through unchanged.
+        """
+        self._load(build_key)
+        node_ids = set()
+        for data in datas:
+            if is_compact(data):
+                node_ids.update((data['start'], data['end'], data['dataset']))
+        node_uris = self._node_uris(node_ids)
+        return [
+            self._decode(data, node_uris) if is_compact(data) else data
+            for data in datas
+        ]
+
+    def _decode(self, data, node_uris):
+        edge = dict(data)
+        edge['rel'] = self.relations[data['rel']]
+        edge['start'] = node_uris[data['start']]
+        edge['end'] = node_uris[data['end']]
+        edge['dataset'] = node_uris[data['dataset']]
+        edge['sources'] = [
+            {key: self.sources[value] for (key, value) in source.items()}
+            for source in data['sources']
+        ]
+        if 'uri' not in edge:
+            edge['uri'] = assertion_uri(edge['rel'], edge['start'], edge['end'])
+        return edge
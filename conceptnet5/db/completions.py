@@ -0,0 +1,193 @@
+"""
+Completions of partly-typed concept names, ranked by how many edges the
+concepts have, for a search box that suggests concepts as someone types.
+
+`cn5-db build_completions` builds two marisa-trie files from
+`assertions.msgpack`:
+
+    terms.marisa - a RecordTrie from the URI of each term (a concept without
+        a sense, such as /c/en/ice_cream) to its number of edges
+    top.marisa - a BytesTrie from the prefixes that more than SCAN_LIMIT
+        terms start with, such as /c/en/ or /c/en/s, to the JSON of their
+        top TOP_COMPLETIONS [uri, edge_count] completions
+
+A prefix that's in top.marisa is answered by reading its precomputed list.
+Any other prefix has at most SCAN_LIMIT completions, which are few enough
+to find in terms.marisa and rank on the spot. Either way, a completion
+takes well under a millisecond.
+
+The database has the same information in its `term_search` view, which
+AssertionFinder falls back on when these files haven't been built.
+"""
+from collections import Counter
+import bisect
+import json
+import os
+import threading
+
+import marisa_trie
+import numpy as np
+
+from conceptnet5.formats.msgpack_stream import read_msgpack_stream
+from conceptnet5.languages import LCODE_ALIASES
+from conceptnet5.nodes import standardize_text
+from conceptnet5.uri import uri_prefix
+from conceptnet5.util import get_data_filename
+
+TERMS_FILE = 'terms.marisa'
+TOP_FILE = 'top.marisa'
+
+# The edge count of a term
+TERMS_FORMAT = '<I'
+
+# Prefixes with more completions than this get a precomputed list of their
+# top completions, instead of being ranked when they're looked up
+SCAN_LIMIT = 1000
+
+# How many completions are precomputed for each of those prefixes
+TOP_COMPLETIONS = 50
+
+_COMPLETIONS = None
+_COMPLETIONS_LOCK = threading.Lock()
+
+
+def completion_prefix(language, text):
+    """
+    Get the URI prefix that completions of some partly-typed text start
+    with. The text is standardized in the same way as the text of concept
+    URIs, except that trailing spaces are kept, as an underscore, because
+    they mean that the previous word is complete.
+
+    >>> completion_prefix('en', 'Ice cr')
+    '/c/en/ice_cr'
+    >>> completion_prefix('en', 'ice ')
+    '/c/en/ice_'
+    """
+    language = LCODE_ALIASES.get(language, language)
+    standardized = standardize_text(text)
+    if standardized and (text[-1:].isspace() or text.endswith('_')):
+        standardized += '_'
+    return '/c/%s/%s' % (language, standardized)
+
+
+def count_term_edges(msgpack_filename):
+    """
+    Count the edges that each term is involved in, as the start or end of
+    the edge or as the term that a more specific start or end belongs to.
+    """
+    counts = Counter()
+    for assertion in read_msgpack_stream(msgpack_filename):
+        terms = {
+            uri_prefix(node) for node in (assertion['start'], assertion['end'])
+            if node.startswith('/c/')
+        }
+        # Leave out nodes that are just a language, such as /c/en
+        counts.update(term for term in terms if term.count('/') == 3)
+    return counts
+
+
+def top_completions(uris, counts, limit=TOP_COMPLETIONS, scan_limit=SCAN_LIMIT):
+    """
+    Find the prefixes that more than `scan_limit` of the sorted list of
+    `uris` start with, and get the top `limit` (uri, count) completions of
+    each one.
+
+    The prefixes form a tree, with '/c/' at the root. The completions of a
+    prefix are a contiguous range of `uris`, so the tree is walked by
+    splitting each range on the character that follows the prefix.
+    """
+    counts = np.asarray(counts)
+    results = {}
+    stack = [('/c/', bisect.bisect_left(uris, '/c/'), _prefix_end(uris, '/c/'))]
+    while stack:
+        prefix, start, end = stack.pop()
+        if end - start <= scan_limit:
+            continue
+        # A stable sort keeps terms with the same count in URI order
+        order = np.argsort(-counts[start:end], kind='mergesort')[:limit] + start
+        results[prefix] = [[uris[idx], int(counts[idx])] for idx in order]
+
+        child_start = start
+        while child_start < end:
+            if len(uris[child_start]) == len(prefix):
+                # The prefix itself is a term
+                child_start += 1
+                continue
+            child = uris[child_start][:len(prefix) + 1]
+            child_end = _prefix_end(uris, child, child_start, end)
+            stack.append((child, child_start, child_end))
+            child_start = child_end
+    return results
+
+
+def _prefix_end(uris, prefix, start=0, end=None):
+    """
+    Find where the range of sorted `uris` that start with `prefix` ends.
+    """
+    if end is None:
+        end = len(uris)
+    following = prefix[:-1] + chr(ord(prefix[-1]) + 1)
+    return bisect.bisect_left(uris, following, start, end)
+
+
+def build_completions(msgpack_filename, output_dir):
+    """
+    Build the completion files for the assertions in `msgpack_filename`,
+    in the directory `output_dir`.
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    counts = count_term_edges(msgpack_filename)
+    uris = sorted(counts)
+    term_counts = [counts[uri] for uri in uris]
+    del counts
+    marisa_trie.RecordTrie(
+        TERMS_FORMAT, [(uri, (count,)) for uri, count in zip(uris, term_counts)]
+    ).save(os.path.join(output_dir, TERMS_FILE))
+
+    top = top_completions(uris, term_counts)
+    marisa_trie.BytesTrie(
+        (prefix, json.dumps(completions, ensure_ascii=False).encode('utf-8'))
+        for prefix, completions in top.items()
+    ).save(os.path.join(output_dir, TOP_FILE))
+
+
+class Completions(object):
+    """
+    The completion files in a directory, mapped into memory.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.terms = marisa_trie.RecordTrie(TERMS_FORMAT)
+        self.terms.mmap(os.path.join(path, TERMS_FILE))
+        self.top = marisa_trie.BytesTrie()
+        self.top.mmap(os.path.join(path, TOP_FILE))
+
+    def complete(self, prefix, limit=10):
+        """
+        Get the `limit` terms with the most edges that start with `prefix`,
+        as a list of (uri, edge_count) pairs, in descending order of edge
+        count and then by URI.
+        """
+        if limit <= TOP_COMPLETIONS:
+            found = self.top.get(prefix)
+            if found:
+                completions = json.loads(found[0].decode('utf-8'))
+                return [(uri, count) for uri, count in completions[:limit]]
+        matches = [(uri, count) for uri, (count,) in self.terms.items(prefix)]
+        matches.sort(key=lambda item: (-item[1], item[0]))
+        return matches[:limit]
+
+
+def get_completions():
+    """
+    Get the Completions built in the 'completions' data directory, or None
+    if they haven't been built.
+    """
+    global _COMPLETIONS
+    with _COMPLETIONS_LOCK:
+        if _COMPLETIONS is None:
+            path = get_data_filename('completions')
+            if not os.access(os.path.join(path, TOP_FILE), os.F_OK):
+                return None
+            _COMPLETIONS = Completions(path)
+        return _COMPLETIONS
@@ -7,6 +7,45 @@ environment variables:
     CONCEPTNET_DB_HOSTNAME - the host to connect to (default "localhost")
     CONCEPTNET_DB_PORT - the port number to connect to (default 5432)
     CONCEPTNET_DB_NAME - the database name to use (default "conceptnet5")
+    CONCEPTNET_DB_REPLICAS - read replicas to send queries to instead of
+        the primary server, as comma-separated "host" or "host:port" entries
+        (see conceptnet5.db.hosts)
+    CONCEPTNET_DB_ROUTING - how to choose a replica for each query:
+        "round_robin" (the default) or "least_latency"
+    CONCEPTNET_DB_STATEMENT_TIMEOUT - how many seconds a query can run
+        before it's cancelled, or 0 for no limit (default 10)
+    CONCEPTNET_DB_CONNECT_TIMEOUT - how many seconds to wait for a server
+        to respond before giving up on it (default 5)
+    CONCEPTNET_DB_FAILURE_THRESHOLD - how many failures in a row take a
+        server out of service (default 3)
+    CONCEPTNET_DB_RETRY_SECONDS - how long a server stays out of service
+        before we try it again (default 30)
+    CONCEPTNET_DB_POOL_SIZE - the maximum number of connections that each
+        process keeps open for queries (default 4)
+    CONCEPTNET_DB_POOL_TIMEOUT - how many seconds to wait for a free
+        connection before giving up (default 10)
+    CONCEPTNET_DB_CACHE - where to cache query results: "none" (the
+        default), "local" for a cache in each process, or "uwsgi" for a
+        cache shared by all the processes of a uWSGI server, in the uWSGI
+        cache named 'conceptnet'
+    CONCEPTNET_DB_CACHE_SIZE - how many results a local cache holds
+        (default 10000)
+    CONCEPTNET_DB_CACHE_TTL - how many seconds a cached result can be used
+        for, or 0 to keep it until it's evicted (default 0)
+    CONCEPTNET_DB_PRECOMPUTED_LD - set to 1 to read edges from the
+        `edges_ld` table, where they're stored already transformed for
+        Linked Data, when the database has them
+    CONCEPTNET_DB_COMPACT - set to 1 if the database was built with
+        `cn5-db prepare_data --compact`, so its edges have to be decoded
+    CONCEPTNET_DB_SLOW_QUERY_SECONDS - queries that take at least this long
+        are logged as slow queries (default 0.5)
+    CONCEPTNET_DB_EXPLAIN_SAMPLE_RATE - the fraction of slow queries that
+        are run again with EXPLAIN ANALYZE to get their plans (default 0.1)
+    CONCEPTNET_DB_BACKEND - where to look up edges: "postgres" (the default)
+        for the database, or "embedded" for the files built by
+        `cn5-db build_embedded`, which don't need a database server
+    CONCEPTNET_DB_EMBEDDED_PATH - the directory of the embedded files
+        (default: the "embedded" directory of the data directory)
 """
 import os
 
@@ -15,3 +54,20 @@ DB_PASSWORD = os.environ.get('CONCEPTNET_DB_PASSWORD', '')
 DB_HOSTNAME = os.environ.get('CONCEPTNET_DB_HOSTNAME', 'localhost')
 DB_PORT = int(os.environ.get('CONCEPTNET_DB_PORT', '5432'))
 DB_NAME = os.environ.get('CONCEPTNET_DB_NAME', 'conceptnet5')
+DB_REPLICAS = os.environ.get('CONCEPTNET_DB_REPLICAS', '')
+DB_ROUTING = os.environ.get('CONCEPTNET_DB_ROUTING', 'round_robin')
+DB_STATEMENT_TIMEOUT = float(os.environ.get('CONCEPTNET_DB_STATEMENT_TIMEOUT', '10'))
+DB_CONNECT_TIMEOUT = float(os.environ.get('CONCEPTNET_DB_CONNECT_TIMEOUT', '5'))
+DB_FAILURE_THRESHOLD = int(os.environ.get('CONCEPTNET_DB_FAILURE_THRESHOLD', '3'))
+DB_RETRY_SECONDS = float(os.environ.get('CONCEPTNET_DB_RETRY_SECONDS', '30'))
+DB_POOL_SIZE = int(os.environ.get('CONCEPTNET_DB_POOL_SIZE', '4'))
+DB_POOL_TIMEOUT = float(os.environ.get('CONCEPTNET_DB_POOL_TIMEOUT', '10'))
+DB_CACHE = os.environ.get('CONCEPTNET_DB_CACHE', 'none')
+DB_CACHE_SIZE = int(os.environ.get('CONCEPTNET_DB_CACHE_SIZE', '10000'))
+DB_CACHE_TTL = float(os.environ.get('CONCEPTNET_DB_CACHE_TTL', '0'))
+DB_PRECOMPUTED_LD = os.environ.get('CONCEPTNET_DB_PRECOMPUTED_LD') == '1'
+DB_COMPACT = os.environ.get('CONCEPTNET_DB_COMPACT') == '1'
+DB_SLOW_QUERY_SECONDS = float(os.environ.get('CONCEPTNET_DB_SLOW_QUERY_SECONDS', '0.5'))
+DB_EXPLAIN_SAMPLE_RATE = float(os.environ.get('CONCEPTNET_DB_EXPLAIN_SAMPLE_RATE', '0.1'))
+DB_BACKEND = os.environ.get('CONCEPTNET_DB_BACKEND', 'postgres')
+DB_EMBEDDED_PATH = os.environ.get('CONCEPTNET_DB_EMBEDDED_PATH', '')
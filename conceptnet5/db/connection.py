@@ -1,55 +1,574 @@
 import pg8000
+import socket
+import threading
 import time
 import sys
 import os
+from contextlib import contextmanager
 from conceptnet5.db import config
+from conceptnet5.db.hosts import (
+    DatabaseUnavailable, HostRouter, QueryTimeout, primary_host, replica_hosts
+)
+from conceptnet5.db.versions import get_active_version, use_version
 from conceptnet5.util import get_data_filename
 
 _CONNECTIONS = {}
+_POOLS = {}
+_POOLS_LOCK = threading.Lock()
+
+# Errors that mean the connection itself is unusable, as opposed to an error
+# in a particular query. This includes the socket timing out, because the
+# reply we stopped waiting for could still arrive, and be read as the reply
+# to the next query.
+CONNECTION_ERRORS = (
+    pg8000.InterfaceError, pg8000.OperationalError, ConnectionError,
+    socket.timeout, TimeoutError
+)
+
+# All the errors that can come from using a connection
+DB_ERRORS = (pg8000.Error,) + CONNECTION_ERRORS
+
+# SQLSTATE codes that PostgreSQL sends when it's shutting down or restarting,
+# which we'll see as an error on the next query we run
+DISCONNECT_CODES = ('57P01', '57P02', '57P03')
+
+# The SQLSTATE code of a query that was cancelled by its statement_timeout
+STATEMENT_TIMEOUT_CODE = '57014'
+
+# An idle pooled connection is checked with a trivial query before being
+# handed out, if it hasn't been used for this many seconds
+HEALTH_CHECK_INTERVAL = 30
+
+# How often, in seconds, a pool checks which version of the data is active
+# (see conceptnet5.db.versions)
+VERSION_CHECK_INTERVAL = 5
 
 
 def get_db_connection(dbname=None, building=False):
     """
-    Get a global connection to the ConceptNet PostgreSQL database.
+    Get a global connection to the ConceptNet PostgreSQL database, on the
+    primary server. This is used by build and administration commands, so
+    its queries have no statement_timeout.
 
     `dbname` specifies the name of the database in PostgreSQL.
     `building` specifies whether it's okay for the DB to not exist
     (set it to True at build time).
     """
-    if not building and not os.access(get_data_filename('psql/done'), os.F_OK):
-        raise IOError("The ConceptNet database has not been built.")
+    if not building:
+        check_db_built()
     if dbname is None:
         dbname = config.DB_NAME
-    if dbname in _CONNECTIONS:
-        return _CONNECTIONS[dbname]
-    else:
-        for attempt in range(10):
+    if dbname not in _CONNECTIONS:
+        _CONNECTIONS[dbname] = _connect_with_retry(dbname)
+    return _CONNECTIONS[dbname]
+
+
+def get_db_pool(dbname=None, building=False):
+    """
+    Get the global ConnectionPool for the ConceptNet PostgreSQL database.
+    The arguments are the same as for `get_db_connection`.
+
+    Unlike the single connection from `get_db_connection`, the pool can be
+    shared by multiple threads that are querying the database at once.
+
+    If read replicas are configured, this is a ReplicaPool that spreads the
+    queries among them.
+    """
+    if not building:
+        check_db_built()
+    if dbname is None:
+        dbname = config.DB_NAME
+    with _POOLS_LOCK:
+        if dbname not in _POOLS:
+            replicas = replica_hosts()
+            if replicas:
+                _POOLS[dbname] = ReplicaPool(dbname, replicas, fallback=primary_host())
+            else:
+                _POOLS[dbname] = ConnectionPool(dbname)
+        return _POOLS[dbname]
+
+
+def check_db_built():
+    if not os.access(get_data_filename('psql/done'), os.F_OK):
+        raise IOError("The ConceptNet database has not been built.")
+
+
+def get_build_id():
+    """
+    Get a string that identifies the build of ConceptNet that's loaded in
+    the database, which changes whenever the database is reloaded. It comes
+    from the modification time of the `psql/done` file that marks the end
+    of a build.
+
+    Returns None if the database hasn't been built.
+    """
+    try:
+        return str(os.stat(get_data_filename('psql/done')).st_mtime_ns)
+    except OSError:
+        return None
+
+
+def is_disconnect(err):
+    """
+    Determine whether an exception from pg8000 means that we've lost our
+    connection to the database.
+    """
+    if isinstance(err, CONNECTION_ERRORS):
+        return True
+    if isinstance(err, pg8000.DatabaseError):
+        message = str(err)
+        return any(code in message for code in DISCONNECT_CODES)
+    return False
+
+
+def is_socket_timeout(err):
+    """
+    Determine whether an exception means that a connection's socket timed
+    out waiting for the server, which pg8000 may have wrapped in an
+    InterfaceError.
+    """
+    timeouts = (socket.timeout, TimeoutError)
+    if isinstance(err, pg8000.InterfaceError):
+        return isinstance(err.__cause__ or err.__context__, timeouts)
+    return isinstance(err, timeouts)
+
+
+def is_statement_timeout(err):
+    """
+    Determine whether an exception from pg8000 means that a query was
+    cancelled because it ran past its statement_timeout.
+    """
+    return isinstance(err, pg8000.DatabaseError) and STATEMENT_TIMEOUT_CODE in str(err)
+
+
+class PooledConnection(object):
+    """
+    A pg8000 connection that belongs to a ConnectionPool, along with the
+    bookkeeping that the pool keeps about it.
+    """
+    def __init__(self, connection):
+        self.connection = connection
+        self.last_used = time.monotonic()
+        # The version of the data this connection's search_path points to
+        self.version = None
+        # Server-side prepared statements that exist on this connection,
+        # maintained by conceptnet5.db.prepared
+        self.prepared = {}
+
+    def fetchall(self, query, params=None):
+        """
+        Run a query on this connection with a new cursor, and return all of
+        its rows.
+        """
+        cursor = self.connection.cursor()
+        try:
+            cursor.execute(query, params)
+            return cursor.fetchall()
+        finally:
+            cursor.close()
+
+    def set_statement_timeout(self, seconds):
+        """
+        Change how long queries can run for the rest of the current
+        transaction, which lasts until the connection is checked in.
+        """
+        cursor = self.connection.cursor()
+        try:
+            cursor.execute("SET LOCAL statement_timeout = %d" % round(seconds * 1000))
+        finally:
+            cursor.close()
+
+
+class ConnectionPool(object):
+    """
+    A bounded, thread-safe pool of connections to one database on one
+    server, `host`, which defaults to the primary server.
+
+    Connections are opened lazily, up to `size` of them. A thread that wants
+    to run a query checks out a connection, gets its own cursor on it, and
+    checks it back in when it's done. If all the connections are checked
+    out, it waits up to `timeout` seconds for one to be returned.
+
+    Connections that have been idle for a while are checked before they're
+    handed out, and connections that turn out to be broken are thrown away
+    and replaced, so the pool recovers on its own when the database server
+    restarts.
+
+    The pool also keeps its connections using the active version of the
+    data, checking for a new one every `version_check_interval` seconds.
+    If `follow_active` is False, the pool uses `version` instead, where None
+    means the tables in the `public` schema.
+
+    Queries are cancelled after `statement_timeout` seconds, which defaults
+    to the CONCEPTNET_DB_STATEMENT_TIMEOUT setting; 0 means no limit. The
+    server's circuit breaker (see `conceptnet5.db.hosts`) is told whether
+    each use of a connection succeeded, and while the breaker is open, the
+    pool refuses to hand out connections.
+    """
+    def __init__(self, dbname, size=None, timeout=None,
+                 check_interval=HEALTH_CHECK_INTERVAL, version=None,
+                 follow_active=True, version_check_interval=VERSION_CHECK_INTERVAL,
+                 host=None, statement_timeout=None):
+        self.dbname = dbname
+        self.host = host or primary_host()
+        if statement_timeout is None:
+            statement_timeout = config.DB_STATEMENT_TIMEOUT
+        self.statement_timeout = statement_timeout
+        self.size = size or config.DB_POOL_SIZE
+        self.timeout = timeout or config.DB_POOL_TIMEOUT
+        self.check_interval = check_interval
+        self.version = version
+        self.follow_active = follow_active
+        self.version_check_interval = version_check_interval
+        self._version_checked = None
+        self._idle = []
+        self._lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(self.size)
+
+    def checkout(self):
+        """
+        Get a PooledConnection for the exclusive use of the caller, who must
+        give it back with `checkin`. The server's circuit breaker learns how
+        the use of the connection went when it's checked in.
+        """
+        if not self._slots.acquire(timeout=self.timeout):
+            raise DatabaseUnavailable(
+                "Timed out waiting for a connection to database %r at %r"
+                % (self.dbname, self.host)
+            )
+        if not self.host.breaker.allow():
+            self._slots.release()
+            raise DatabaseUnavailable(
+                "Database %r at %r is out of service after repeated failures"
+                % (self.dbname, self.host)
+            )
+        try:
+            pooled = None
+            while pooled is None:
+                with self._lock:
+                    if not self._idle:
+                        break
+                    pooled = self._idle.pop()
+                if not self._is_healthy(pooled):
+                    self._close(pooled)
+                    pooled = None
+            if pooled is None:
+                pooled = PooledConnection(
+                    _connect(self.dbname, self.host, self.statement_timeout)
+                )
+            try:
+                self._use_current_version(pooled)
+            except BaseException:
+                self._close(pooled)
+                raise
+            return pooled
+        except BaseException as err:
+            # We didn't get to use the server, so tell its circuit breaker
+            # whether that was the server's fault
+            if isinstance(err, DatabaseUnavailable) or is_disconnect(err):
+                self.host.breaker.record_failure()
+            else:
+                self.host.breaker.record_success()
+            self._slots.release()
+            raise
+
+    def checkin(self, pooled, discard=False, failed=None):
+        """
+        Return a connection to the pool. If `discard` is True, the connection
+        is known to be broken, so close it instead of reusing it.
+
+        The server's circuit breaker records the use of the connection as a
+        failure if `failed` is True, and as a success otherwise. `failed`
+        defaults to `discard`. This is what resolves the single trial that
+        a half-open breaker allows.
+        """
+        if failed is None:
+            failed = discard
+        try:
+            if not discard:
+                try:
+                    # End the transaction that pg8000 implicitly started, so
+                    # the connection doesn't sit idle in a transaction
+                    pooled.connection.rollback()
+                except DB_ERRORS:
+                    discard = True
+                    failed = True
+            if discard:
+                self._close(pooled)
+                # If one connection was dropped, the others that were opened
+                # to the same server probably were too
+                self.close_idle()
+            else:
+                pooled.last_used = time.monotonic()
+                with self._lock:
+                    self._idle.append(pooled)
+        finally:
+            if failed:
+                self.host.breaker.record_failure()
+            else:
+                self.host.breaker.record_success()
+            self._slots.release()
+
+    @contextmanager
+    def connection(self):
+        """
+        Check out a PooledConnection for the duration of a `with` block.
+
+        Lost connections, including ones whose socket timed out, and
+        statement timeouts count as failures of the server; anything else,
+        including errors in the query, counts as a success.
+        """
+        pooled = self.checkout()
+        try:
+            yield pooled
+        except Exception as err:
+            disconnected = is_disconnect(err)
+            self.checkin(
+                pooled, discard=disconnected,
+                failed=disconnected or is_statement_timeout(err)
+            )
+            raise
+        else:
+            self.checkin(pooled)
+
+    @contextmanager
+    def cursor(self):
+        """
+        Get a new cursor on a pooled connection for the duration of a `with`
+        block.
+        """
+        with self.connection() as pooled:
+            cursor = pooled.connection.cursor()
             try:
-                _CONNECTIONS[dbname] = _get_db_connection_inner(dbname)
-                return _CONNECTIONS[dbname]
-            except pg8000.InterfaceError:
-                if attempt == 0:
-                    print(
-                        "Database %r at %s:%s is not available, retrying for 10 seconds"
-                        % (dbname, config.DB_HOSTNAME, config.DB_PORT),
-                        file=sys.stderr
-                    )
-                time.sleep(1)
-        raise IOError(
-            "Couldn't connect to database %r at %s:%s" %
-            (dbname, config.DB_HOSTNAME, config.DB_PORT)
-        )
-
-
-def _get_db_connection_inner(dbname):
+                yield cursor
+            finally:
+                cursor.close()
+
+    def run(self, func, timeout=None):
+        """
+        Call `func` on a checked-out PooledConnection and return its result.
+
+        If the connection turns out to have been dropped -- for example,
+        because the database server restarted -- `func` is retried once on a
+        new connection, so it should only run read-only queries.
+
+        `timeout` sets a different statement_timeout, in seconds, for the
+        queries that `func` runs. It can't usefully be longer than the
+        pool's `statement_timeout`, because the connection's socket gives up
+        waiting soon after that.
+
+        A query that runs out of time raises QueryTimeout, which is an
+        IOError, so the API reports it as a temporary problem.
+        """
+        for attempt in range(2):
+            try:
+                with self.connection() as pooled:
+                    if timeout is not None:
+                        pooled.set_statement_timeout(timeout)
+                    return func(pooled)
+            except DB_ERRORS as err:
+                if is_statement_timeout(err):
+                    raise QueryTimeout(
+                        "A query to database %r at %r took too long, and was cancelled"
+                        % (self.dbname, self.host)
+                    ) from err
+                if is_socket_timeout(err):
+                    raise QueryTimeout(
+                        "Database %r at %r stopped responding to a query"
+                        % (self.dbname, self.host)
+                    ) from err
+                if attempt > 0 or not is_disconnect(err):
+                    raise
+
+    def fetchall(self, query, params=None, timeout=None):
+        """
+        Run a query on a pooled connection and return all of its rows.
+        """
+        return self.run(lambda pooled: pooled.fetchall(query, params), timeout)
+
+    def close_idle(self):
+        """
+        Close all the connections that aren't currently checked out.
+        """
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for pooled in idle:
+            self._close(pooled)
+
+    def _use_current_version(self, pooled):
+        """
+        Find out which version of the data is active, if we haven't checked
+        recently, and point the connection's search_path at it.
+        """
+        now = time.monotonic()
+        if self.follow_active and (
+            self._version_checked is None
+            or now - self._version_checked >= self.version_check_interval
+        ):
+            self.version = get_active_version(pooled.connection)
+            pooled.connection.rollback()
+            self._version_checked = now
+        if pooled.version != self.version:
+            use_version(pooled.connection, self.version)
+            pooled.version = self.version
+            pooled.prepared.clear()
+
+    def _is_healthy(self, pooled):
+        if time.monotonic() - pooled.last_used < self.check_interval:
+            return True
+        cursor = None
+        try:
+            cursor = pooled.connection.cursor()
+            cursor.execute("SELECT 1")
+            cursor.fetchall()
+            pooled.connection.rollback()
+            return True
+        except DB_ERRORS:
+            return False
+        finally:
+            if cursor is not None:
+                try:
+                    cursor.close()
+                except DB_ERRORS:
+                    pass
+
+    @staticmethod
+    def _close(pooled):
+        try:
+            pooled.connection.close()
+        except DB_ERRORS:
+            pass
+
+
+class ReplicaPool(object):
+    """
+    Runs read-only queries on a ConnectionPool for each of several servers,
+    such as read replicas. A HostRouter chooses which server to try first,
+    and if it's out of service or its connection fails, the query fails
+    over to the next one. `fallback`, usually the primary server, is tried
+    after all the others.
+
+    It has the same methods for running queries as ConnectionPool. Other
+    keyword arguments are passed on to each ConnectionPool.
+    """
+    def __init__(self, dbname, hosts, fallback=None, routing=None, **pool_args):
+        self.dbname = dbname
+        self.router = HostRouter(hosts, fallback, routing)
+        all_hosts = list(hosts)
+        if fallback is not None and fallback not in all_hosts:
+            all_hosts.append(fallback)
+        self.pools = {
+            host: ConnectionPool(dbname, host=host, **pool_args)
+            for host in all_hosts
+        }
+        self._last_pool = self.pools[all_hosts[0]]
+
+    @property
+    def version(self):
+        """
+        The version of the data that was used by the most recent query. The
+        servers should all have the same active version, except for a
+        moment while a new version is being replicated.
+        """
+        return self._last_pool.version
+
+    def run(self, func, timeout=None):
+        """
+        Call `func` on a PooledConnection from the first server that can run
+        it, and return its result. See `ConnectionPool.run`.
+        """
+        error = None
+        for host in self.router.hosts_to_try():
+            pool = self.pools[host]
+            start_time = time.monotonic()
+            try:
+                result = pool.run(func, timeout)
+            except DatabaseUnavailable as err:
+                error = err
+                continue
+            except DB_ERRORS as err:
+                if not is_disconnect(err):
+                    raise
+                error = err
+                continue
+            host.record_latency(time.monotonic() - start_time)
+            self._last_pool = pool
+            return result
+        raise DatabaseUnavailable(
+            "No server is available for database %r" % self.dbname
+        ) from error
+
+    def fetchall(self, query, params=None, timeout=None):
+        return self.run(lambda pooled: pooled.fetchall(query, params), timeout)
+
+    def close_idle(self):
+        for pool in self.pools.values():
+            pool.close_idle()
+
+
+def _connect(dbname, host, statement_timeout=0):
+    """
+    Connect to a database server once, raising DatabaseUnavailable if it
+    can't be reached. Waiting and retrying are left to the server's circuit
+    breaker.
+    """
+    try:
+        return _get_db_connection_inner(dbname, host, statement_timeout)
+    except (pg8000.InterfaceError, OSError) as err:
+        raise DatabaseUnavailable(
+            "Couldn't connect to database %r at %r" % (dbname, host)
+        ) from err
+
+
+def _connect_with_retry(dbname):
+    """
+    Connect to the primary server, waiting up to 10 seconds for it to start
+    accepting connections. Build commands use this, because they may start
+    at the same time as the server.
+    """
+    for attempt in range(10):
+        try:
+            return _get_db_connection_inner(dbname)
+        except pg8000.InterfaceError:
+            if attempt == 0:
+                print(
+                    "Database %r at %s:%s is not available, retrying for 10 seconds"
+                    % (dbname, config.DB_HOSTNAME, config.DB_PORT),
+                    file=sys.stderr
+                )
+            time.sleep(1)
+    raise IOError(
+        "Couldn't connect to database %r at %s:%s" %
+        (dbname, config.DB_HOSTNAME, config.DB_PORT)
+    )
+
+
+def _get_db_connection_inner(dbname, host=None, statement_timeout=0):
+    """
+    Open a connection to `host`, or the primary server. If there's a
+    `statement_timeout`, the connection's queries are cancelled after that
+    many seconds, and its socket stops waiting for a reply a few seconds
+    after that, in case the server itself has stopped responding.
+    """
+    if host is None:
+        host = primary_host()
+    socket_timeout = None
+    if statement_timeout:
+        socket_timeout = statement_timeout + config.DB_CONNECT_TIMEOUT
     conn = pg8000.connect(
         user=config.DB_USERNAME,
         password=config.DB_PASSWORD,
-        host=config.DB_HOSTNAME,
-        port=config.DB_PORT,
-        database=dbname
+        host=host.hostname,
+        port=host.port,
+        database=dbname,
+        timeout=socket_timeout
     )
     pg8000.paramstyle = 'named'
+    if statement_timeout:
+        cursor = conn.cursor()
+        cursor.execute("SET statement_timeout = %d" % round(statement_timeout * 1000))
+        cursor.close()
+        conn.commit()
     return conn
 
 
@@ -65,4 +584,3 @@ def check_db_connection(dbname=None):
     if dbname is None:
         dbname = config.DB_NAME
     _get_db_connection_inner(dbname)
-
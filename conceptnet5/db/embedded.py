@@ -0,0 +1,484 @@
+"""
+A read-only store of ConceptNet's edges that doesn't need PostgreSQL, for
+single-machine deployments and tests.
+
+`cn5-db build_embedded` builds it from `assertions.msgpack` into a
+directory of files that are memory-mapped when they're read, so the
+EmbeddedAssertionFinder starts almost immediately and serves lookups from
+the operating system's page cache:
+
+    edges.tsv - one line per edge, `uri <tab> weight <tab> Linked Data JSON`,
+        sorted by descending weight and then by URI, which is the order that
+        queries return edges in. An edge's index is its line number.
+    offsets.npy - the byte offset of each line of edges.tsv, plus the length
+        of the file
+    rels.npy - the index of each edge's relation in relations.json
+    relations.json - a list of [uri, directed] pairs for the relations
+    postings.npy - sorted lists of edge indices, stored one after another
+    index.marisa - a marisa-trie RecordTrie from keys to the (start, length)
+        of their list in postings.npy
+
+A key is a one-letter kind followed by a URI. The kinds are in KEY_KINDS:
+'s' and 'e' are followed by every prefix of an edge's start or end node,
+so they find the edges of more specific nodes too, as the node_prefixes
+table does in the database.
+
+The edges of a dataset are listed in a random order that stays the same
+until the store is rebuilt, like the sample keys in the database.
+"""
+from array import array
+import json
+import mmap
+import os
+import random
+import tempfile
+import time
+
+import marisa_trie
+import numpy as np
+
+from conceptnet5.db import config
+from conceptnet5.db.completions import completion_prefix, get_completions
+from conceptnet5.db.query import RawEdge, set_other_node, list_criteria_key
+from conceptnet5.db.stats import QueryStats
+from conceptnet5.edges import transform_for_linked_data
+from conceptnet5.formats.msgpack_stream import read_msgpack_stream
+from conceptnet5.relations import SYMMETRIC_RELATIONS
+from conceptnet5.uri import uri_prefixes
+from conceptnet5.util import get_data_filename
+
+EDGES_FILE = 'edges.tsv'
+OFFSETS_FILE = 'offsets.npy'
+RELS_FILE = 'rels.npy'
+RELATIONS_FILE = 'relations.json'
+POSTINGS_FILE = 'postings.npy'
+INDEX_FILE = 'index.marisa'
+
+# The (start, length) of a list of edges in postings.npy
+INDEX_FORMAT = '<QQ'
+
+KEY_KINDS = {
+    'start': 's',
+    'end': 'e',
+    'rel': 'r',
+    'source': 'o',
+    'dataset': 'd',
+    'assertion': 'a',
+}
+
+# The seed for the order of the edges in each dataset
+DATASET_SAMPLE_SEED = 0
+
+EMPTY_POSTINGS = np.zeros(0, dtype=np.uint32)
+
+
+def index_key(kind, uri):
+    """
+    Get the key of the index that lists the edges with a given kind of
+    relationship to a URI.
+
+    >>> index_key('start', '/c/en/cat')
+    's/c/en/cat'
+    """
+    return KEY_KINDS[kind] + uri
+
+
+def edge_keys(assertion):
+    """
+    Get the set of index keys that an assertion should be listed under.
+    """
+    keys = {
+        index_key('rel', assertion['rel']),
+        index_key('dataset', assertion['dataset']),
+        index_key('assertion', assertion['uri']),
+    }
+    for prefix in uri_prefixes(assertion['start']):
+        keys.add(index_key('start', prefix))
+    for prefix in uri_prefixes(assertion['end']):
+        keys.add(index_key('end', prefix))
+    for source in assertion['sources']:
+        for value in source.values():
+            keys.add(index_key('source', value))
+    return keys
+
+
+def build_embedded(msgpack_filename, output_dir):
+    """
+    Build an embedded store of the assertions in `msgpack_filename`, in
+    the directory `output_dir`.
+
+    The assertions are first copied to a temporary file, so that they can
+    be written out again in sorted order without holding them all in
+    memory.
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    order = []
+    seen = set()
+    with tempfile.TemporaryFile(dir=output_dir) as temp_file:
+        for assertion in read_msgpack_stream(msgpack_filename):
+            if assertion['uri'] in seen:
+                continue
+            seen.add(assertion['uri'])
+            data = json.dumps(assertion, ensure_ascii=False, sort_keys=True).encode('utf-8')
+            order.append((-assertion['weight'], assertion['uri'], temp_file.tell(), len(data)))
+            temp_file.write(data)
+        del seen
+        order.sort()
+
+        relation_indices = {}
+        postings = {}
+        offsets = np.zeros(len(order) + 1, dtype=np.uint64)
+        rels = np.zeros(len(order), dtype=np.uint16)
+        with open(os.path.join(output_dir, EDGES_FILE), 'wb') as edge_file:
+            for edge_idx, (_weight, uri, position, length) in enumerate(order):
+                temp_file.seek(position)
+                assertion = json.loads(temp_file.read(length).decode('utf-8'))
+                rel = assertion['rel']
+                if rel not in relation_indices:
+                    relation_indices[rel] = len(relation_indices)
+                rels[edge_idx] = relation_indices[rel]
+                for key in edge_keys(assertion):
+                    if key not in postings:
+                        postings[key] = array('I')
+                    postings[key].append(edge_idx)
+
+                ld_edge = transform_for_linked_data(assertion)
+                line = '%s\t%r\t%s\n' % (
+                    uri, float(assertion['weight']),
+                    json.dumps(ld_edge, ensure_ascii=False, sort_keys=True)
+                )
+                edge_file.write(line.encode('utf-8'))
+                offsets[edge_idx + 1] = edge_file.tell()
+
+    relations = [[rel, rel not in SYMMETRIC_RELATIONS] for rel in relation_indices]
+    with open(os.path.join(output_dir, RELATIONS_FILE), 'w', encoding='utf-8') as rel_file:
+        json.dump(relations, rel_file, ensure_ascii=False)
+    np.save(os.path.join(output_dir, OFFSETS_FILE), offsets)
+    np.save(os.path.join(output_dir, RELS_FILE), rels)
+    write_index(output_dir, postings)
+
+
+def write_index(output_dir, postings):
+    """
+    Write postings.npy and index.marisa from a dictionary of index keys to
+    arrays of edge indices.
+    """
+    total = sum(len(edges) for edges in postings.values())
+    posting_array = np.zeros(total, dtype=np.uint32)
+    sampler = np.random.RandomState(DATASET_SAMPLE_SEED)
+    records = []
+    start = 0
+    for key in sorted(postings):
+        edges = np.frombuffer(postings[key], dtype=np.uint32)
+        if key.startswith(KEY_KINDS['dataset']):
+            edges = sampler.permutation(edges)
+        posting_array[start:start + len(edges)] = edges
+        records.append((key, (start, len(edges))))
+        start += len(edges)
+    np.save(os.path.join(output_dir, POSTINGS_FILE), posting_array)
+    marisa_trie.RecordTrie(INDEX_FORMAT, records).save(os.path.join(output_dir, INDEX_FILE))
+
+
+class EmbeddedStore(object):
+    """
+    The files of an embedded store, mapped into memory.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.offsets = np.load(os.path.join(path, OFFSETS_FILE), mmap_mode='r')
+        self.rels = np.load(os.path.join(path, RELS_FILE), mmap_mode='r')
+        self.postings = np.load(os.path.join(path, POSTINGS_FILE), mmap_mode='r')
+        self.index = marisa_trie.RecordTrie(INDEX_FORMAT)
+        self.index.mmap(os.path.join(path, INDEX_FILE))
+        with open(os.path.join(path, RELATIONS_FILE), encoding='utf-8') as rel_file:
+            self.relations = json.load(rel_file)
+        self._edge_file = open(os.path.join(path, EDGES_FILE), 'rb')
+        if len(self) > 0:
+            self.edge_text = mmap.mmap(self._edge_file.fileno(), 0, access=mmap.ACCESS_READ)
+        else:
+            # mmap can't map an empty file
+            self.edge_text = b''
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def edges_for(self, kind, uri):
+        """
+        Get the sorted array of indices of the edges listed under a key.
+        """
+        found = self.index.get(index_key(kind, uri))
+        if not found:
+            return EMPTY_POSTINGS
+        start, length = found[0]
+        return self.postings[start:start + length]
+
+    def edge_line(self, edge_idx):
+        """
+        Get the (uri, weight, Linked Data JSON text) of an edge.
+        """
+        start = int(self.offsets[edge_idx])
+        end = int(self.offsets[edge_idx + 1])
+        uri, weight, text = self.edge_text[start:end].decode('utf-8').rstrip('\n').split('\t', 2)
+        return uri, float(weight), text
+
+    def close(self):
+        if isinstance(self.edge_text, mmap.mmap):
+            self.edge_text.close()
+        self._edge_file.close()
+
+
+class EmbeddedAssertionFinder(object):
+    """
+    Looks up edges in an embedded store, with the same methods as
+    `conceptnet5.db.query.AssertionFinder`. `path` is the directory that
+    `build_embedded` wrote, which defaults to the
+    CONCEPTNET_DB_EMBEDDED_PATH setting.
+
+    The results aren't cached, because reading them from the store is
+    about as fast as reading them from a cache.
+    """
+    def __init__(self, path=None):
+        self.path = path or config.DB_EMBEDDED_PATH or get_data_filename('embedded')
+        self.store = None
+        self.stats = QueryStats()
+
+    def _get_store(self):
+        if self.store is None:
+            if not os.access(os.path.join(self.path, INDEX_FILE), os.F_OK):
+                raise IOError("The embedded ConceptNet data has not been built.")
+            self.store = EmbeddedStore(self.path)
+        return self.store
+
+    def _timed(self, query_type, params, run):
+        """
+        Run a lookup by calling `run`, and record how long it took in
+        `self.stats`, as AssertionFinder does for its queries.
+        """
+        start_time = time.monotonic()
+        results = run()
+        seconds = time.monotonic() - start_time
+        self.stats.record(query_type, seconds, len(results))
+        if seconds >= config.DB_SLOW_QUERY_SECONDS:
+            self.stats.record_slow(query_type, query_type, params, seconds)
+        return results
+
+    def _edges(self, edge_indices, raw=False):
+        store = self._get_store()
+        results = []
+        for edge_idx in edge_indices:
+            uri, weight, text = store.edge_line(edge_idx)
+            if raw:
+                results.append(RawEdge(text, uri=uri, weight=weight))
+            else:
+                results.append(json.loads(text))
+        return results
+
+    def query_stats(self):
+        return self.stats.to_dict()
+
+    def cache_stats(self):
+        return None
+
+    @staticmethod
+    def prepared_statement_stats():
+        return None
+
+    def lookup(self, uri, limit=100, offset=0, after=None, raw=False):
+        """
+        Look up the edges involving a URI, which can be a node, relation,
+        source, dataset, or assertion. See `AssertionFinder.lookup`.
+        """
+        if uri.startswith('/c/') or uri.startswith('http'):
+            criteria = {'node': uri}
+        elif uri.startswith('/r/'):
+            criteria = {'rel': uri}
+        elif uri.startswith('/s/'):
+            criteria = {'source': uri}
+        elif uri.startswith('/a/'):
+            return self.lookup_assertion(uri)
+        elif uri.startswith('/d/'):
+            return self.sample_dataset(uri, limit, offset)
+        else:
+            raise ValueError
+        return self.query(criteria, limit, offset, after=after, raw=raw)
+
+    def lookup_many(self, uris, limit_per_uri=20):
+        return {uri: self.lookup(uri, limit=limit_per_uri) for uri in uris}
+
+    def lookup_grouped_by_feature(self, uri, limit=20):
+        summary = self.lookup_feature_summary(uri, limit)
+        return {feature: edges for feature, (count, edges) in summary.items()}
+
+    def lookup_feature_summary(self, uri, limit=20):
+        """
+        Get the top edges of a concept grouped by their features, along
+        with the number of edges each feature has. See
+        `AssertionFinder.lookup_feature_summary`.
+        """
+        return self._timed(
+            'feature_summary', {'node': uri, 'limit': limit},
+            lambda: self._lookup_feature_summary(uri, limit)
+        )
+
+    def _lookup_feature_summary(self, uri, limit):
+        # Like the feature_summary table, only summarize terms, not
+        # languages or other prefixes
+        if not uri.startswith('/c/') or '/' not in uri[3:]:
+            return {}
+        store = self._get_store()
+        directed = np.array([rel_directed for (_rel, rel_directed) in store.relations], dtype=bool)
+        as_start = np.asarray(store.edges_for('start', uri), dtype=np.int64)
+        as_end = np.asarray(store.edges_for('end', uri), dtype=np.int64)
+        edge_indices = np.concatenate([as_start, as_end])
+        rels = np.asarray(store.rels[edge_indices], dtype=np.int64)
+        # Symmetric relations have the direction 0 whichever end the node is on
+        directions = np.concatenate([
+            np.where(directed[rels[:len(as_start)]], 1, 0),
+            np.where(directed[rels[len(as_start):]], -1, 0)
+        ])
+
+        # Sort by feature and then by edge index, which is weight order, and
+        # drop the duplicates that symmetric edges can have
+        order = np.lexsort((edge_indices, rels, directions))
+        edge_indices, rels, directions = edge_indices[order], rels[order], directions[order]
+        keep = np.ones(len(order), dtype=bool)
+        keep[1:] = (
+            (edge_indices[1:] != edge_indices[:-1]) |
+            (rels[1:] != rels[:-1]) |
+            (directions[1:] != directions[:-1])
+        )
+        edge_indices, rels, directions = edge_indices[keep], rels[keep], directions[keep]
+
+        results = {}
+        boundaries = np.flatnonzero(
+            (rels[1:] != rels[:-1]) | (directions[1:] != directions[:-1])
+        ) + 1
+        starts = [0] + boundaries.tolist()
+        ends = boundaries.tolist() + [len(edge_indices)]
+        for start, end in zip(starts, ends):
+            if start == end:
+                continue
+            feature = (int(directions[start]), store.relations[rels[start]][0])
+            edges = self._edges(edge_indices[start:min(end, start + limit)])
+            results[feature] = (end - start, [set_other_node(edge, uri) for edge in edges])
+        return results
+
+    def complete_terms(self, language, text, limit=10):
+        """
+        Get the terms in a language whose text starts with `text`, from the
+        files built by `cn5-db build_completions`. See
+        `AssertionFinder.complete_terms`.
+        """
+        prefix = completion_prefix(language, text)
+        if prefix.endswith('/'):
+            return []
+        completions = get_completions()
+        if completions is None:
+            raise IOError("The ConceptNet completions have not been built.")
+        return self._timed(
+            'complete_terms', {'prefix': prefix, 'limit': limit},
+            lambda: completions.complete(prefix, limit)
+        )
+
+    def fuzzy_terms(self, language, text, limit=10):
+        raise IOError("Fuzzy search needs the ConceptNet database.")
+
+    def lookup_assertion(self, uri):
+        return self._timed(
+            'assertion', {'uri': uri},
+            lambda: self._edges(self._get_store().edges_for('assertion', uri))
+        )
+
+    def sample_dataset(self, uri, limit=50, offset=0):
+        """
+        Get a sample of the edges from a dataset, which stays the same until
+        the store is rebuilt.
+        """
+        return self._timed(
+            'sample_dataset', {'dataset': uri, 'limit': limit, 'offset': offset},
+            lambda: self._edges(self._get_store().edges_for('dataset', uri)[offset:offset + limit])
+        )
+
+    def random_edges(self, limit=20):
+        """
+        Get `limit` edges chosen at random.
+        """
+        store = self._get_store()
+        return self._timed(
+            'random_edges', {'limit': limit},
+            lambda: self._edges(random.sample(range(len(store)), min(limit, len(store))))
+        )
+
+    def query(self, criteria, limit=20, offset=0, after=None, raw=False):
+        """
+        Find edges that match a dictionary of criteria, sorted by descending
+        weight and then by URI. See `AssertionFinder.query`.
+        """
+        criteria = dict(criteria)
+        criteria.pop('after', None)
+        if after is not None:
+            after = (float(after[0]), after[1])
+            query_type = 'query(%s)' % ','.join(list_criteria_key(dict(criteria, after=True)))
+        else:
+            query_type = 'query(%s)' % ','.join(list_criteria_key(criteria))
+        params = dict(criteria, limit=limit, offset=offset, after=after)
+        return self._timed(
+            query_type, params,
+            lambda: self._query(criteria, limit, offset, after, raw)
+        )
+
+    def _query(self, criteria, limit, offset, after, raw):
+        matched = self._match(criteria)
+        if after is not None:
+            matched = matched[self._position_after(matched, after):]
+        return self._edges(matched[offset:offset + limit], raw=raw)
+
+    def _match(self, criteria):
+        """
+        Get the sorted array of the indices of the edges that match all the
+        criteria.
+        """
+        store = self._get_store()
+        matches = []
+        if 'node' in criteria:
+            node = criteria['node']
+            if 'other' in criteria:
+                other = criteria['other']
+                matches.append(np.union1d(
+                    np.intersect1d(store.edges_for('start', node), store.edges_for('end', other)),
+                    np.intersect1d(store.edges_for('end', node), store.edges_for('start', other))
+                ))
+            else:
+                matches.append(np.union1d(
+                    store.edges_for('start', node), store.edges_for('end', node)
+                ))
+        elif 'other' in criteria:
+            matches.append(store.edges_for('end', criteria['other']))
+        for kind in ('start', 'end', 'rel', 'source'):
+            if kind in criteria:
+                matches.append(store.edges_for(kind, criteria[kind]))
+        if not matches:
+            return np.arange(len(store))
+        matched = matches[0]
+        for edges in matches[1:]:
+            matched = np.intersect1d(matched, edges, assume_unique=True)
+        return matched
+
+    def _position_after(self, matched, after):
+        """
+        Find the position in `matched` of the first edge that comes after
+        the given (weight, uri), by binary search. The edge indices are in
+        the same order as (-weight, uri).
+        """
+        store = self._get_store()
+        after_weight, after_uri = after
+        target = (-after_weight, after_uri)
+        low, high = 0, len(matched)
+        while low < high:
+            mid = (low + high) // 2
+            uri, weight, _text = store.edge_line(matched[mid])
+            if (-weight, uri) <= target:
+                low = mid + 1
+            else:
+                high = mid
+        return low
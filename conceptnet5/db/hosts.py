@@ -0,0 +1,199 @@
+"""
+The database servers that ConceptNet can read from, and how queries are
+routed among them.
+
+The primary server is the one in CONCEPTNET_DB_HOSTNAME and
+CONCEPTNET_DB_PORT. Read replicas can be listed in CONCEPTNET_DB_REPLICAS,
+as comma-separated `host` or `host:port` entries. When there are replicas,
+queries are spread among them -- in turn, or by which has been answering
+fastest, depending on CONCEPTNET_DB_ROUTING -- and the primary is only
+read from when none of them are available.
+
+Each server has a CircuitBreaker. After several failures in a row, the
+server is taken out of service for a while, so that queries fail over to
+another server right away instead of waiting for one that isn't
+responding. Then a single query is allowed through to find out whether it
+has recovered.
+"""
+import itertools
+import threading
+import time
+
+from conceptnet5.db import config
+
+ROUTING_METHODS = ('round_robin', 'least_latency')
+
+# How much each new measurement moves a host's average latency
+LATENCY_SMOOTHING = 0.2
+
+_HOSTS = {}
+_HOSTS_LOCK = threading.Lock()
+
+
+class DatabaseUnavailable(IOError):
+    """
+    Raised when no database server can be used, either because they're
+    failing or because their circuit breakers are open.
+    """
+    pass
+
+
+class QueryTimeout(IOError):
+    """
+    Raised when a query is cancelled for running longer than its
+    statement_timeout.
+    """
+    pass
+
+
+class CircuitBreaker(object):
+    """
+    Keeps track of whether a server is working, so that we can stop sending
+    it queries after `failure_threshold` consecutive failures.
+
+    The breaker is 'closed' when the server is in use, and 'open' when it's
+    out of service. `retry_seconds` after opening, it becomes 'half-open':
+    one caller is allowed to try the server, and its success or failure
+    closes or reopens the breaker.
+    """
+    def __init__(self, failure_threshold=None, retry_seconds=None):
+        self.failure_threshold = failure_threshold or config.DB_FAILURE_THRESHOLD
+        self.retry_seconds = retry_seconds or config.DB_RETRY_SECONDS
+        self._lock = threading.Lock()
+        self.failures = 0
+        self.opened_at = None
+        self.trial_running = False
+
+    @property
+    def state(self):
+        with self._lock:
+            return self._state()
+
+    def _state(self):
+        if self.opened_at is None:
+            return 'closed'
+        if time.monotonic() - self.opened_at >= self.retry_seconds:
+            return 'half-open'
+        return 'open'
+
+    def allow(self):
+        """
+        Determine whether the server can be tried now. In the half-open
+        state, this returns True to only one caller, until it reports how
+        its attempt went.
+        """
+        with self._lock:
+            state = self._state()
+            if state == 'closed':
+                return True
+            if state == 'half-open' and not self.trial_running:
+                self.trial_running = True
+                return True
+            return False
+
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+            self.trial_running = False
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.trial_running or self.failures >= self.failure_threshold:
+                self.opened_at = time.monotonic()
+            self.trial_running = False
+
+
+class DatabaseHost(object):
+    """
+    A database server, with its circuit breaker and a moving average of
+    how long its queries take.
+    """
+    def __init__(self, hostname, port):
+        self.hostname = hostname
+        self.port = port
+        self.breaker = CircuitBreaker()
+        self.latency = 0.
+        self._lock = threading.Lock()
+
+    def __repr__(self):
+        return '%s:%s' % (self.hostname, self.port)
+
+    def record_latency(self, seconds):
+        with self._lock:
+            if self.latency == 0.:
+                self.latency = seconds
+            else:
+                self.latency += LATENCY_SMOOTHING * (seconds - self.latency)
+
+
+def get_host(hostname, port):
+    """
+    Get the global DatabaseHost for a server, so that everything connecting
+    to it shares one circuit breaker.
+    """
+    with _HOSTS_LOCK:
+        if (hostname, port) not in _HOSTS:
+            _HOSTS[hostname, port] = DatabaseHost(hostname, port)
+        return _HOSTS[hostname, port]
+
+
+def parse_hosts(spec, default_port=5432):
+    """
+    Parse a comma-separated list of `host` or `host:port` entries into
+    (host, port) pairs.
+
+    >>> parse_hosts('db1, db2:5433')
+    [('db1', 5432), ('db2', 5433)]
+    """
+    hosts = []
+    for entry in spec.split(','):
+        entry = entry.strip()
+        if not entry:
+            continue
+        hostname, _, port = entry.partition(':')
+        hosts.append((hostname, int(port) if port else default_port))
+    return hosts
+
+
+def primary_host():
+    return get_host(config.DB_HOSTNAME, config.DB_PORT)
+
+
+def replica_hosts():
+    return [
+        get_host(hostname, port)
+        for hostname, port in parse_hosts(config.DB_REPLICAS, config.DB_PORT)
+    ]
+
+
+class HostRouter(object):
+    """
+    Chooses the order in which to try a list of hosts for each query.
+    `fallback` is a host to try after all of them, usually the primary.
+    """
+    def __init__(self, hosts, fallback=None, routing=None):
+        routing = routing or config.DB_ROUTING
+        if routing not in ROUTING_METHODS:
+            raise ValueError("Unknown routing method: %r" % routing)
+        self.hosts = list(hosts)
+        self.fallback = fallback
+        self.routing = routing
+        self._counter = itertools.count()
+
+    def hosts_to_try(self):
+        """
+        Get the hosts in the order they should be tried, leaving out the
+        ones whose circuit breakers are open. (A host whose breaker is
+        half-open is included, but only one query at a time gets to try it:
+        see `ConnectionPool.checkout` and `ConnectionPool.checkin`.)
+        """
+        if self.routing == 'least_latency':
+            ordered = sorted(self.hosts, key=lambda host: host.latency)
+        else:
+            start = next(self._counter) % len(self.hosts)
+            ordered = self.hosts[start:] + self.hosts[:start]
+        if self.fallback is not None and self.fallback not in ordered:
+            ordered.append(self.fallback)
+        return [host for host in ordered if host.breaker.state != 'open']
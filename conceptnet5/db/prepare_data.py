@@ -1,118 +1,492 @@
+"""
+Convert the assertions from `assertions.msgpack` into the CSV files that
+`load_sql_csv` loads into the database.
+
+The URIs of nodes, sources, and relations are numbered by Interners, which
+write each URI to its CSV file the first time they see it, and keep the
+URIs they've seen packed into a single bytearray. Rows are collected and
+written in batches.
+
+The work can be divided into shards, by a hash of each assertion's URI, so
+that several processes can each convert part of the assertions (see
+`prepare_sharded`). Each shard numbers its URIs on its own, and
+`merge_shards` renumbers them into one set of files, which are the same as
+the files that one process would write.
+"""
+from concurrent.futures import ProcessPoolExecutor
+from array import array
+import gzip
+import hashlib
+import heapq
+import json
+import os
+import shutil
+
 from conceptnet5.formats.msgpack_stream import read_msgpack_stream
 from conceptnet5.uri import uri_prefixes
 from conceptnet5.relations import SYMMETRIC_RELATIONS
-from ordered_set import OrderedSet
-import json
+from conceptnet5.edges import transform_for_linked_data
+from conceptnet5.db.compact import compact_edge
+from conceptnet5.db.schema import run_tasks
 
+CSV_NAMES = [
+    'nodes', 'edges', 'edges_ld', 'relations', 'sources',
+    'edge_sources', 'node_prefixes', 'edge_features'
+]
 
-def write_row(outfile, items):
-    print('\t'.join(sanitize(str(x)) for x in items), file=outfile)
+# A file that each shard writes along with its CSV files, with a row for
+# each edge, saying where the edge's assertion was in the input and how many
+# rows of each file the shard had written after converting it
+SHARD_INDEX_NAME = 'shard_index'
 
+# How many rows a RowWriter collects before writing them out at once
+WRITE_BATCH_SIZE = 10000
 
-def write_ordered_set(filename, oset):
-    with open(filename, 'w', encoding='utf-8') as outfile:
-        for i, item in enumerate(oset):
-            print('%d\t%s' % (i, sanitize(item)), file=outfile)
 
-
-def write_relations(filename, oset):
-    with open(filename, 'w', encoding='utf-8') as outfile:
-        for i, rel in enumerate(oset):
-            directed_str = 't'
-            if rel in SYMMETRIC_RELATIONS:
-                directed_str = 'f'
-            print('%d\t%s\t%s' % (i, sanitize(rel), directed_str), file=outfile)
+def strip_separators(text):
+    """
+    Remove the tabs and newlines from text, which would otherwise separate
+    the fields and rows of the tab-separated COPY format. The binary COPY
+    in `binary_copy` removes them too, so both load the same values.
+    """
+    return text.replace('\n', '').replace('\t', '')
 
 
 def sanitize(text):
-    return text.replace('\n', '').replace('\t', '').replace('\\', '\\\\')
-
-
-def assertions_to_sql_csv(msgpack_filename, output_dir):
-    output_nodes = output_dir + '/nodes.csv'
-    output_edges = output_dir + '/edges.csv'
-    output_relations = output_dir + '/relations.csv'
-    output_sources = output_dir + '/sources.csv'
-    output_edge_sources = output_dir + '/edge_sources.csv'
-    output_node_prefixes = output_dir + '/node_prefixes.csv'
-    output_features = output_dir + '/edge_features.csv'
-
-    node_list = OrderedSet()
-    source_list = OrderedSet()
-    assertion_list = OrderedSet()
-    relation_list = OrderedSet()
-    seen_prefixes = set()
-
-    edge_file = open(output_edges, 'w', encoding='utf-8')
-    edge_source_file = open(output_edge_sources, 'w', encoding='utf-8')
-    node_prefix_file = open(output_node_prefixes, 'w', encoding='utf-8')
-    feature_file = open(output_features, 'w', encoding='utf-8')
-
-    for assertion in read_msgpack_stream(msgpack_filename):
-        if assertion['uri'] in assertion_list:
+    return strip_separators(text).replace('\\', '\\\\')
+
+
+def bytes_hash(data):
+    """
+    Get a 64-bit hash of some bytes, which stays the same between processes
+    (unlike Python's `hash`).
+    """
+    digest = hashlib.blake2b(data, digest_size=8).digest()
+    return int.from_bytes(digest, 'little')
+
+
+def uri_hash(text):
+    return bytes_hash(text.encode('utf-8'))
+
+
+class RowWriter(object):
+    """
+    Writes rows to a file in PostgreSQL's tab-separated COPY format, a batch
+    at a time. The file is gzipped if its name ends with '.gz'.
+
+    Text is sanitized as it's written, unless `escape` is False because it
+    has been already.
+    """
+    def __init__(self, filename, escape=True):
+        if filename.endswith('.gz'):
+            self.file = gzip.open(filename, 'wt', encoding='utf-8')
+        else:
+            self.file = open(filename, 'w', encoding='utf-8')
+        self.escape = escape
+        self.lines = []
+
+    def format_item(self, item):
+        if isinstance(item, bool):
+            return 't' if item else 'f'
+        elif isinstance(item, str):
+            return sanitize(item) if self.escape else item
+        else:
+            return str(item)
+
+    def write_row(self, items):
+        self.lines.append('\t'.join([self.format_item(item) for item in items]) + '\n')
+        if len(self.lines) >= WRITE_BATCH_SIZE:
+            self.flush()
+
+    def flush(self):
+        self.file.write(''.join(self.lines))
+        self.lines = []
+
+    def close(self):
+        self.flush()
+        self.file.close()
+
+
+class Interner(object):
+    """
+    Assigns consecutive ids to strings, in the order they're first added.
+
+    The strings are stored as UTF-8, one after another in a bytearray, with
+    an array of where each one ends, which takes much less memory than a
+    set of Python strings. They're found by a 64-bit hash. A string that's
+    found by its hash is compared to the stored string, and a string whose
+    hash collides with a different string's is kept in a separate
+    dictionary, so it still gets an id of its own.
+
+    `on_new` is called with the id and the string whenever a new string is
+    added, which is when it should be written out.
+    """
+    def __init__(self, on_new=None):
+        self.ids = {}
+        self.collided = {}
+        self.data = bytearray()
+        self.ends = array('Q')
+        self.on_new = on_new
+
+    def __len__(self):
+        return len(self.ends)
+
+    def _hash(self, data):
+        return bytes_hash(data)
+
+    def _stored(self, idx):
+        start = self.ends[idx - 1] if idx > 0 else 0
+        return self.data[start:self.ends[idx]]
+
+    def add(self, text):
+        data = text.encode('utf-8')
+        key = self._hash(data)
+        idx = self.ids.get(key)
+        if idx is not None:
+            if self._stored(idx) == data:
+                return idx
+            idx = self.collided.get(text)
+            if idx is not None:
+                return idx
+
+        idx = len(self.ends)
+        if key in self.ids:
+            self.collided[text] = idx
+        else:
+            self.ids[key] = idx
+        self.data += data
+        self.ends.append(len(self.data))
+        if self.on_new is not None:
+            self.on_new(idx, text)
+        return idx
+
+
+def _open_writers(output_dir, escape=True):
+    return {
+        name: RowWriter(os.path.join(output_dir, name + '.csv'), escape)
+        for name in CSV_NAMES
+    }
+
+
+def _close_writers(writers):
+    for writer in writers.values():
+        writer.close()
+
+
+def _grow(flags, idx):
+    """
+    Make an array of flags, indexed by id, long enough to contain `idx`,
+    filling it with zeroes.
+    """
+    if idx >= len(flags):
+        flags.extend([0] * max(idx + 1 - len(flags), len(flags)))
+
+
+def assertions_to_sql_csv(msgpack_filename, output_dir, compact=False, shards=1, shard=0):
+    """
+    Write the CSV files that get loaded into the database.
+
+    If `compact` is True, the `data` of each edge refers to its relation,
+    nodes, and sources by their ids (see conceptnet5.db.compact), and the
+    `edges_ld` file is left empty, because its contents would take up more
+    space than the compact edges save.
+
+    If `shards` is more than 1, only the assertions in shard number `shard`
+    are written, and the files need to be combined with `merge_shards`.
+    """
+    writers = _open_writers(output_dir)
+    if shards > 1:
+        writers[SHARD_INDEX_NAME] = RowWriter(
+            os.path.join(output_dir, SHARD_INDEX_NAME + '.csv')
+        )
+    try:
+        convert_assertions(msgpack_filename, writers, compact, shards, shard)
+    finally:
+        _close_writers(writers)
+
+
+def convert_assertions(msgpack_filename, writers, compact=False, shards=1, shard=0):
+    """
+    Convert the assertions into rows for each table, and give them to
+    `writers`, a dictionary from table names to objects with a `write_row`
+    method, such as RowWriters. See `assertions_to_sql_csv`.
+
+    When `shards` is more than 1, `writers` also needs a writer for the
+    shard's index, named by SHARD_INDEX_NAME.
+    """
+    nodes = Interner(lambda idx, uri: writers['nodes'].write_row([idx, uri]))
+    sources = Interner(lambda idx, uri: writers['sources'].write_row([idx, uri]))
+    relations = Interner(lambda idx, rel: writers['relations'].write_row(
+        [idx, rel, rel not in SYMMETRIC_RELATIONS]
+    ))
+    assertions = Interner()
+    # Which nodes have had their prefixes written, indexed by node id
+    prefixes_written = bytearray()
+
+    for position, assertion in enumerate(read_msgpack_stream(msgpack_filename)):
+        if shards > 1 and uri_hash(assertion['uri']) % shards != shard:
+            continue
+        assertion_idx = len(assertions)
+        if assertions.add(assertion['uri']) != assertion_idx:
+            # We've already converted this assertion
             continue
-        assertion_idx = assertion_list.add(assertion['uri'])
-        rel_idx = relation_list.add(assertion['rel'])
-        start_idx = node_list.add(assertion['start'])
-        end_idx = node_list.add(assertion['end'])
-
-        source_indices = []
-        sources = assertion['sources']
-        for source in sources:
+        rel_idx = relations.add(assertion['rel'])
+        start_idx = nodes.add(assertion['start'])
+        end_idx = nodes.add(assertion['end'])
+
+        source_indices = set()
+        for source in assertion['sources']:
             for sourceval in sorted(source.values()):
-                source_idx = source_list.add(sourceval)
-                source_indices.append(source_idx)
+                source_indices.add(sources.add(sourceval))
 
         jsondata = json.dumps(assertion, ensure_ascii=False, sort_keys=True)
-        weight = assertion['weight']
-        write_row(
-            edge_file,
+        if compact:
+            dataset_idx = nodes.add(assertion['dataset'])
+            edge_data = compact_edge(
+                assertion, rel_idx, start_idx, end_idx, dataset_idx, sources.add
+            )
+            edge_jsondata = json.dumps(edge_data, ensure_ascii=False, sort_keys=True)
+        else:
+            edge_jsondata = jsondata
+        writers['edges'].write_row(
             [assertion_idx, assertion['uri'],
              rel_idx, start_idx, end_idx,
-             weight, jsondata]
+             assertion['weight'], edge_jsondata]
         )
+        prefix_rows = 0
         for node in (assertion['start'], assertion['end'], assertion['dataset']):
-            write_prefixes(node_prefix_file, seen_prefixes, node_list, node)
-        for source_idx in sorted(set(source_indices)):
-            write_row(edge_source_file, [assertion_idx, source_idx])
+            node_idx = nodes.add(node)
+            _grow(prefixes_written, node_idx)
+            if not prefixes_written[node_idx]:
+                prefixes_written[node_idx] = 1
+                for prefix in uri_prefixes(node):
+                    writers['node_prefixes'].write_row([node_idx, nodes.add(prefix)])
+                    prefix_rows += 1
+        for source_idx in sorted(source_indices):
+            writers['edge_sources'].write_row([assertion_idx, source_idx])
 
         if assertion['rel'] in SYMMETRIC_RELATIONS:
             features = [(0, start_idx), (0, end_idx)]
         else:
             features = [(1, start_idx), (-1, end_idx)]
-
         for direction, node_idx in features:
-            write_row(feature_file, [rel_idx, direction, node_idx, assertion_idx])
+            writers['edge_features'].write_row([rel_idx, direction, node_idx, assertion_idx])
+
+        if shards > 1:
+            writers[SHARD_INDEX_NAME].write_row([
+                position, len(nodes), len(sources), len(relations),
+                prefix_rows, len(source_indices)
+            ])
+
+        if not compact:
+            # Also store the edge in the form that the API returns,
+            # serialized the same way as the API's JSON output, so it can
+            # be returned as-is. This modifies `assertion`, so it comes
+            # last.
+            ld_edge = transform_for_linked_data(assertion)
+            writers['edges_ld'].write_row(
+                [assertion_idx, json.dumps(ld_edge, ensure_ascii=False, sort_keys=True)]
+            )
+
+
+def shard_dirs(output_dir, shards):
+    return [os.path.join(output_dir, 'shard%d' % shard) for shard in range(shards)]
+
+
+def prepare_sharded(msgpack_filename, output_dir, shards, compact=False):
+    """
+    Write the CSV files using `shards` processes at once, each of which
+    reads all the assertions but only converts its own shard of them, and
+    then merge the shards.
+    """
+    dirs = shard_dirs(output_dir, shards)
+    for dirname in dirs:
+        os.makedirs(dirname, exist_ok=True)
+    with ProcessPoolExecutor(max_workers=shards) as executor:
+        futures = [
+            executor.submit(
+                assertions_to_sql_csv, msgpack_filename, dirname, compact, shards, shard
+            )
+            for shard, dirname in enumerate(dirs)
+        ]
+    for future in futures:
+        future.result()
+    merge_shards(dirs, output_dir, compact)
+    for dirname in dirs:
+        shutil.rmtree(dirname)
 
-    edge_file.close()
-    edge_source_file.close()
-    node_prefix_file.close()
-    write_ordered_set(output_nodes, node_list)
-    write_ordered_set(output_sources, source_list)
-    write_relations(output_relations, relation_list)
 
+def _read_rows(filename):
+    with open(filename, encoding='utf-8') as infile:
+        for line in infile:
+            yield line.rstrip('\n').split('\t')
 
-def write_prefixes(prefix_file, seen_prefixes, node_list, node):
-    for prefix in uri_prefixes(node):
-        if (node, prefix) not in seen_prefixes:
-            seen_prefixes.add((node, prefix))
-            node_idx = node_list.add(node)
-            prefix_idx = node_list.add(prefix)
-            write_row(prefix_file, [node_idx, prefix_idx])
 
+class ShardReader(object):
+    """
+    Reads back the files that `assertions_to_sql_csv` wrote for one shard,
+    one edge at a time, and maps the shard's ids for URIs to the ids they
+    get in the merged files.
+    """
+    def __init__(self, dirname):
+        self.rows = {
+            name: _read_rows(os.path.join(dirname, name + '.csv'))
+            for name in CSV_NAMES + [SHARD_INDEX_NAME]
+        }
+        self.node_map = array('l')
+        self.source_map = array('l')
+        self.rel_map = array('l')
 
-def load_sql_csv(connection, input_dir):
-    for (filename, tablename) in [
+    def index(self, shard_num):
+        """
+        Get the rows of the shard's index, as (position, shard_num, counts)
+        tuples, which sort in the order their assertions were read.
+        """
+        for row in self.rows[SHARD_INDEX_NAME]:
+            position, *counts = [int(value) for value in row]
+            yield position, shard_num, counts
+
+    def read_ids(self, name, id_map, interner, count, on_row=None):
+        """
+        Read the (id, uri) rows of the shard's file `name` until `id_map`
+        covers `count` of them, mapping each to the id that `interner`
+        gives the same URI.
+        """
+        while len(id_map) < count:
+            row = next(self.rows[name])
+            if on_row is not None:
+                on_row(row)
+            id_map.append(interner.add(row[1]))
+
+    def read(self, name, count):
+        """
+        Read the next `count` rows of the shard's file `name`.
+        """
+        return [next(self.rows[name]) for _ in range(count)]
+
+
+def _remap_compact(data, rel_map, node_map, source_map):
+    """
+    Renumber the ids in the sanitized JSON of a compact edge.
+    """
+    edge = json.loads(data.replace('\\\\', '\\'))
+    edge['rel'] = rel_map[edge['rel']]
+    edge['start'] = node_map[edge['start']]
+    edge['end'] = node_map[edge['end']]
+    edge['dataset'] = node_map[edge['dataset']]
+    edge['sources'] = [
+        {key: source_map[value] for (key, value) in source.items()}
+        for source in edge['sources']
+    ]
+    return sanitize(json.dumps(edge, ensure_ascii=False, sort_keys=True))
+
+
+def merge_shards(dirs, output_dir, compact=False):
+    """
+    Combine the CSV files that `assertions_to_sql_csv` wrote for each
+    shard, in the directories `dirs`, into one set of files in
+    `output_dir`, giving each URI a single id.
+
+    The edges of all the shards are merged back into the order their
+    assertions were read in, using the shards' indexes. Going through them
+    in that order, the URIs that each edge added to its shard are numbered
+    again, and a node's prefixes are kept from the first edge that wrote
+    them, so the files come out the same as if one process had written
+    them.
+    """
+    # The text in the shards' files is already sanitized
+    writers = _open_writers(output_dir, escape=False)
+    nodes = Interner(lambda idx, uri: writers['nodes'].write_row([idx, uri]))
+    sources = Interner(lambda idx, uri: writers['sources'].write_row([idx, uri]))
+    directed = {}
+    relations = Interner(lambda idx, rel: writers['relations'].write_row(
+        [idx, rel, directed[rel]]
+    ))
+    # Which nodes have had their prefixes written, indexed by node id
+    prefixes_written = bytearray()
+
+    def add_relation(row):
+        directed[row[1]] = row[2]
+
+    try:
+        readers = [ShardReader(dirname) for dirname in dirs]
+        merged_index = heapq.merge(
+            *[reader.index(shard_num) for (shard_num, reader) in enumerate(readers)]
+        )
+        for assertion_idx, (_position, shard_num, counts) in enumerate(merged_index):
+            reader = readers[shard_num]
+            num_nodes, num_sources, num_relations, num_prefixes, num_edge_sources = counts
+            reader.read_ids('nodes', reader.node_map, nodes, num_nodes)
+            reader.read_ids('sources', reader.source_map, sources, num_sources)
+            reader.read_ids(
+                'relations', reader.rel_map, relations, num_relations, add_relation
+            )
+            node_map, source_map, rel_map = reader.node_map, reader.source_map, reader.rel_map
+
+            [(_idx, uri, rel, start, end, weight, data)] = reader.read('edges', 1)
+            if compact:
+                data = _remap_compact(data, rel_map, node_map, source_map)
+            writers['edges'].write_row([
+                assertion_idx, uri, rel_map[int(rel)],
+                node_map[int(start)], node_map[int(end)], weight, data
+            ])
+            if not compact:
+                [(_idx, data)] = reader.read('edges_ld', 1)
+                writers['edges_ld'].write_row([assertion_idx, data])
+
+            new_prefixes = set()
+            for node, prefix in reader.read('node_prefixes', num_prefixes):
+                node_idx = node_map[int(node)]
+                _grow(prefixes_written, node_idx)
+                if not prefixes_written[node_idx]:
+                    new_prefixes.add(node_idx)
+                if node_idx in new_prefixes:
+                    writers['node_prefixes'].write_row([node_idx, node_map[int(prefix)]])
+            for node_idx in new_prefixes:
+                prefixes_written[node_idx] = 1
+
+            # The sources were sorted by the shard's ids, which can be in a
+            # different order than the merged ids
+            source_indices = sorted(
+                source_map[int(source)]
+                for (_idx, source) in reader.read('edge_sources', num_edge_sources)
+            )
+            for source_idx in source_indices:
+                writers['edge_sources'].write_row([assertion_idx, source_idx])
+            for rel, direction, node, _idx in reader.read('edge_features', 2):
+                writers['edge_features'].write_row(
+                    [rel_map[int(rel)], direction, node_map[int(node)], assertion_idx]
+                )
+    finally:
+        _close_writers(writers)
+
+
+def load_sql_csv(pool, input_dir, jobs=1):
+    """
+    Load the CSV files in `input_dir` into their tables, using up to `jobs`
+    connections from `pool` at once. The largest files are started first,
+    so that they don't end up being loaded on their own at the end.
+    """
+    tasks = []
+    for (filename, tablename) in sorted([
         (input_dir + '/relations.csv', 'relations'),
         (input_dir + '/nodes.csv', 'nodes'),
         (input_dir + '/edges.csv', 'edges'),
+        (input_dir + '/edges_ld.csv', 'edges_ld'),
         (input_dir + '/sources.csv', 'sources'),
         (input_dir + '/edge_sources.csv', 'edge_sources'),
         (input_dir + '/node_prefixes.csv', 'node_prefixes'),
         (input_dir + '/edge_features.csv', 'edge_features')
-    ]:
-        cursor = connection.cursor()
+    ], key=lambda item: -os.path.getsize(item[0])):
+        tasks.append(('COPY %s' % tablename, _copy_task(filename, tablename)))
+    run_tasks(pool, tasks, jobs)
+
+
+def _copy_task(filename, tablename):
+    def copy(pooled):
+        cursor = pooled.connection.cursor()
         with open(filename, 'rb') as file:
             cursor.execute("COPY %s FROM STDIN" % tablename, stream=file)
         cursor.close()
-        connection.commit()
+        pooled.connection.commit()
+    return copy
@@ -0,0 +1,149 @@
+"""
+Server-side prepared statements for the queries that AssertionFinder runs
+most often.
+
+A PreparedQuery is created once per SQL query, and is prepared on each
+pooled connection the first time it runs there. After that, running it only
+sends an EXECUTE with the parameter values, so PostgreSQL doesn't have to
+parse and analyze the query again, and can reuse its plan.
+
+EXECUTE is a utility statement, which can't take bound parameters, so the
+parameter values are sent as quoted SQL literals. `sql_literal` only accepts
+the types of values that our queries use.
+"""
+import re
+import threading
+import time
+
+PARAM_RE = re.compile(r'(?<![:\w]):([A-Za-z_]\w*)')
+
+# Parameters whose types can't be inferred as text
+PARAM_TYPES = {
+    'limit': 'bigint',
+    'offset': 'bigint',
+    'after_weight': 'real',
+}
+
+
+def sql_literal(value):
+    """
+    Express a Python value as a literal in PostgreSQL syntax.
+
+    >>> sql_literal("it's")
+    "E'it''s'"
+    >>> sql_literal(20)
+    '20'
+    """
+    if isinstance(value, bool):
+        return 'true' if value else 'false'
+    elif isinstance(value, int):
+        return str(value)
+    elif isinstance(value, float):
+        if value != value or value in (float('inf'), float('-inf')):
+            raise ValueError("Can't use %r as a query parameter" % value)
+        return repr(value)
+    elif isinstance(value, str):
+        if '\x00' in value:
+            raise ValueError("Query parameters can't contain null characters")
+        escaped = value.replace('\\', '\\\\').replace("'", "''")
+        return "E'%s'" % escaped
+    else:
+        raise TypeError("Can't use %r as a query parameter" % (value,))
+
+
+class PreparedStatementStats(object):
+    """
+    Thread-safe counters about how prepared statements are being used.
+
+    `max_planning_seconds_saved` is an upper bound on the planning time
+    saved: when a statement is prepared on a connection, we time how long
+    PostgreSQL takes to plan it once (using EXPLAIN), and count that much
+    time each time it's reused. PostgreSQL still plans the first few
+    executions of a prepared statement for their parameter values, and
+    keeps doing so if a generic plan doesn't look cheaper, so those reuses
+    only save parsing and analysis.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.prepared = 0
+            self.executed = 0
+            self.reused = 0
+            self.max_planning_seconds_saved = 0.
+
+    def record_prepare(self):
+        with self._lock:
+            self.prepared += 1
+            self.executed += 1
+
+    def record_reuse(self, planning_seconds):
+        with self._lock:
+            self.executed += 1
+            self.reused += 1
+            self.max_planning_seconds_saved += planning_seconds
+
+    def to_dict(self):
+        with self._lock:
+            return {
+                'prepared': self.prepared,
+                'executed': self.executed,
+                'reused': self.reused,
+                'max_planning_seconds_saved': self.max_planning_seconds_saved,
+            }
+
+
+STATS = PreparedStatementStats()
+
+
+class PreparedQuery(object):
+    """
+    A query, written with `:name` parameters like the rest of our queries,
+    that can be run as a named server-side prepared statement.
+    """
+    def __init__(self, name, query):
+        self.name = name
+        self.query = query
+        self.param_names = []
+        for param in PARAM_RE.findall(query):
+            if param not in self.param_names:
+                self.param_names.append(param)
+
+        def numbered_param(match):
+            return '$%d' % (self.param_names.index(match.group(1)) + 1)
+
+        types = [PARAM_TYPES.get(param, 'text') for param in self.param_names]
+        self.prepare_sql = 'PREPARE %s (%s) AS %s' % (
+            self.name, ', '.join(types), PARAM_RE.sub(numbered_param, query)
+        )
+
+    def execute_sql(self, params):
+        """
+        Get the EXECUTE statement that runs this query with the given
+        parameter values.
+        """
+        if not self.param_names:
+            return 'EXECUTE %s' % self.name
+        literals = [sql_literal(params[param]) for param in self.param_names]
+        return 'EXECUTE %s (%s)' % (self.name, ', '.join(literals))
+
+    def fetchall(self, pooled, params):
+        """
+        Run this query on a PooledConnection, preparing it there first if
+        necessary, and return all of its rows.
+        """
+        execute_sql = self.execute_sql(params)
+        if self.name in pooled.prepared:
+            STATS.record_reuse(pooled.prepared[self.name])
+        else:
+            pooled.fetchall(self.prepare_sql)
+            # The statement exists on the connection now, even if the rest
+            # of this fails, and PREPARE would fail if we tried it again
+            pooled.prepared[self.name] = 0.
+            STATS.record_prepare()
+            start_time = time.monotonic()
+            pooled.fetchall('EXPLAIN ' + execute_sql)
+            pooled.prepared[self.name] = time.monotonic() - start_time
+        return pooled.fetchall(execute_sql)
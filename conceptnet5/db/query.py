@@ -1,39 +1,244 @@
-from .connection import get_db_connection
+from .cache import make_cache
+from .connection import get_db_pool, get_build_id
+from conceptnet5.db import config
+from .prepared import PreparedQuery, STATS as PREPARED_STATS
+from .compact import CompactEdgeDecoder
+from .completions import completion_prefix, get_completions
+from .stats import QueryStats
 from conceptnet5.edges import transform_for_linked_data
-import json
+from conceptnet5.uri import split_uri
+from concurrent.futures import ThreadPoolExecutor
+import functools
 import itertools
+import json
+import pg8000
+import random
+import threading
+import time
+
 
+# How many slow queries can be waiting to be explained in the background.
+# Slow queries beyond this aren't explained, so that a burst of them can't
+# add to the load that's making them slow.
+EXPLAIN_QUEUE_SIZE = 4
 
 NODE_PREFIX_CRITERIA = {'node', 'other', 'start', 'end'}
+LIST_CRITERIA = NODE_PREFIX_CRITERIA | {'rel', 'source', 'after'}
 LIST_QUERIES = {}
+PREPARED_LIST_QUERIES = {}
 FEATURE_QUERIES = {}
 
-RANDOM_QUERY = "SELECT uri, data FROM edges TABLESAMPLE SYSTEM(0.01) ORDER BY random() LIMIT :limit"
-RANDOM_NODES_QUERY = "SELECT * FROM nodes TABLESAMPLE SYSTEM(1) WHERE uri LIKE :prefix ORDER BY random() LIMIT :limit"
-DATASET_QUERY = "SELECT uri, data FROM edges TABLESAMPLE SYSTEM(0.01) WHERE data->'dataset' = :dataset ORDER BY weight DESC OFFSET :offset LIMIT :limit"
-
-
-NODE_TO_FEATURE_QUERY = """
-WITH node_ids AS (
-    SELECT p.node_id FROM nodes n, node_prefixes p
-    WHERE p.prefix_id=n.id AND n.uri=:node
-    LIMIT 10
-)
-SELECT rf.direction, r.uri, e.data
-FROM ranked_features rf, edges e, relations r
-WHERE rf.node_id IN (SELECT node_id FROM node_ids)
-AND rf.edge_id = e.id
-AND rf.rel_id = r.id
-AND rank <= :limit
-ORDER BY direction, uri, rank;
+# The queries that return edges get the edge data from a table called
+# {edge_data}, which has an 'id' and a 'data' column. This is either 'edges',
+# whose data has to be transformed for Linked Data, or 'edges_ld', which
+# contains the transformed data as JSON text.
+#
+# RANDOM_QUERY gets the edges whose sample keys follow a random starting key, wrapping
+# around to the lowest keys if we reach the end. The second half of the
+# UNION ALL only runs if the first half doesn't fill the limit.
+RANDOM_QUERY = """
+SELECT s.uri, d.data FROM (
+    (SELECT edge_id, uri, 0 AS pass, sample_key FROM edge_samples
+     WHERE sample_key >= :start ORDER BY sample_key LIMIT :limit)
+    UNION ALL
+    (SELECT edge_id, uri, 1 AS pass, sample_key FROM edge_samples
+     WHERE sample_key < :start ORDER BY sample_key LIMIT :limit)
+    LIMIT :limit
+) s, {edge_data} d
+WHERE d.id = s.edge_id
+ORDER BY s.pass, s.sample_key
+"""
+DATASET_QUERY = """
+SELECT s.uri, d.data FROM (
+    SELECT edge_id, uri, sample_key FROM edge_samples
+    WHERE dataset = :dataset
+    ORDER BY sample_key OFFSET :offset LIMIT :limit
+) s, {edge_data} d
+WHERE d.id = s.edge_id
+ORDER BY s.sample_key
+"""
+ASSERTION_QUERY = """
+SELECT d.data FROM edges e, {edge_data} d WHERE e.uri=:uri AND d.id = e.id
+"""
+
+
+FEATURE_SUMMARY_QUERY = """
+SELECT fs.direction, r.uri, fs.edge_count, d.data
+FROM nodes n, feature_summary fs, relations r, {edge_data} d
+WHERE n.uri=:node
+AND fs.prefix_id = n.id
+AND fs.rank <= :limit
+AND fs.rel_id = r.id
+AND fs.edge_id = d.id
+ORDER BY fs.direction, r.uri, fs.rank
 """
 MAX_GROUP_SIZE = 20
 
+# Get the top edges for each of a list of nodes, using the same ordering as
+# the node_edges query that `make_list_query` builds for a single node
+LOOKUP_MANY_QUERY = """
+SELECT q.uri, e.uri, d.data
+FROM unnest(CAST(:uris AS text[])) AS q(uri)
+JOIN nodes n ON n.uri = q.uri
+CROSS JOIN LATERAL (
+    SELECT ne.edge_id, ne.weight, ne.uri_rank FROM node_edges ne
+    WHERE ne.prefix_id = n.id
+    ORDER BY ne.weight DESC, ne.uri_rank
+    LIMIT :limit
+) ne
+JOIN edges e ON e.id = ne.edge_id
+JOIN {edge_data} d ON d.id = ne.edge_id
+ORDER BY q.uri, ne.weight DESC, ne.uri_rank
+"""
+
+# Completions and fuzzy matches of a term's text, from the term_search view.
+# The text_pattern_ops index supports the ~>=~ and ~<~ comparisons, and the
+# trigram index supports the similarity operator, %.
+COMPLETE_TERMS_QUERY = """
+SELECT uri, edge_count FROM term_search
+WHERE language = :language AND text ~>=~ :prefix AND text ~<~ :upper
+ORDER BY edge_count DESC, text
+LIMIT :limit
+"""
+FUZZY_TERMS_QUERY = """
+SELECT uri, edge_count FROM term_search
+WHERE language = :language AND text % :text
+ORDER BY similarity(text, :text) DESC, edge_count DESC, text
+LIMIT :limit
+"""
+
+
+class RawEdge(str):
+    """
+    The JSON text of an edge in its Linked Data form, which can be included
+    in an API response without being decoded and encoded again. It also
+    records the edge's URI and weight, which are needed for pagination.
+    """
+    def __new__(cls, text, uri=None, weight=None):
+        obj = str.__new__(cls, text)
+        obj.uri = uri
+        obj.weight = weight
+        return obj
+
+
+def set_other_node(edge, uri):
+    """
+    Set the 'other' node of an edge that was found by looking up `uri`: the
+    node that (in most cases) didn't match the URI. Returns the edge.
+    """
+    # Hacky way to figure out what the 'other' node is. If both start with
+    # our given URI, take the longer one, which is either a more specific
+    # sense or a different, longer word.
+    shorter, longer = sorted([edge['start'], edge['end']], key=lambda node: len(node['@id']))
+    if shorter['@id'].startswith(uri):
+        edge['other'] = longer
+    else:
+        edge['other'] = shorter
+    return edge
+
+
+def list_criteria_key(criteria):
+    """
+    Get the sorted tuple of criteria that determines what query
+    `make_list_query` builds. Criteria that it doesn't know about are left
+    out, because they don't affect the query.
+    """
+    return tuple(sorted(key for key in criteria if key in LIST_CRITERIA))
 
-def make_list_query(criteria):
-    crit_tuple = tuple(sorted(criteria))
-    if crit_tuple in LIST_QUERIES:
-        return LIST_QUERIES[crit_tuple]
+
+def can_use_node_edges(crit_tuple):
+    """
+    Determine whether a query with these criteria can be answered from the
+    `node_edges` table: it must be about exactly one node (as 'node',
+    'start', or 'end'), optionally restricted to one relation.
+    """
+    node_criteria = [key for key in crit_tuple if key in ('node', 'start', 'end')]
+    return (
+        len(node_criteria) == 1 and
+        set(crit_tuple) <= {'node', 'start', 'end', 'rel', 'after'}
+    )
+
+
+def keyset_condition(table):
+    """
+    Get the SQL condition that selects only the rows that come after the
+    row with weight :after_weight and URI :after_uri, when the rows are
+    sorted by descending weight and then by URI.
+
+    The first part of the condition can be used as a bound on an index
+    of weights, and the second part filters out the rows with the same
+    weight that we've already seen.
+    """
+    return (
+        "AND {t}.weight <= :after_weight AND "
+        "({t}.weight < :after_weight OR {t}.uri > :after_uri)"
+    ).format(t=table)
+
+
+def node_edges_keyset_condition():
+    """
+    Get the condition that `keyset_condition` gets for `node_edges`, which
+    sorts the edges with the same weight by their `uri_rank` in
+    `edge_order`. The edges that come after :after_uri are the ones whose
+    rank is at least the rank of the first URI after it.
+    """
+    return """
+        AND ne.weight <= :after_weight AND (
+            ne.weight < :after_weight OR ne.uri_rank >= (
+                SELECT o.uri_rank FROM edges ae, edge_order o
+                WHERE ae.uri > :after_uri AND o.edge_id = ae.id
+                ORDER BY ae.uri LIMIT 1
+            )
+        )
+    """
+
+
+def make_node_edges_query(crit_tuple, edge_data):
+    """
+    Build a query that finds the edges of a single node using the
+    precomputed `node_edges` table. Its index is sorted by weight, so the
+    query reads a range of the index instead of joining and sorting every
+    matching edge.
+    """
+    if 'start' in crit_tuple:
+        node_param = 'start'
+    elif 'end' in crit_tuple:
+        node_param = 'end'
+    else:
+        node_param = 'node'
+    parts = ["""
+        SELECT e.uri, ne.weight, d.data
+        FROM node_edges ne, edges e, %s d
+        WHERE ne.prefix_id = (SELECT id FROM nodes WHERE uri = :%s)
+        AND e.id = ne.edge_id AND d.id = ne.edge_id
+    """ % (edge_data, node_param)]
+    if node_param == 'start':
+        parts.append("AND ne.is_start")
+    elif node_param == 'end':
+        parts.append("AND ne.is_end")
+    if 'rel' in crit_tuple:
+        parts.append("AND ne.relation_id = (SELECT id FROM relations WHERE uri = :rel)")
+    if 'after' in crit_tuple:
+        parts.append(node_edges_keyset_condition())
+    parts.append("""
+        ORDER BY ne.weight DESC, ne.uri_rank
+        OFFSET :offset LIMIT :limit
+    """)
+    return '\n'.join(parts)
+
+
+def make_list_query(criteria, edge_data='edges'):
+    """
+    Build a query for the edges matching a dictionary of criteria. The
+    `edge_data` table that the data comes from is described above.
+    """
+    crit_tuple = list_criteria_key(criteria)
+    if (crit_tuple, edge_data) in LIST_QUERIES:
+        return LIST_QUERIES[crit_tuple, edge_data]
+    if can_use_node_edges(crit_tuple):
+        query = make_node_edges_query(crit_tuple, edge_data)
+        LIST_QUERIES[crit_tuple, edge_data] = query
+        return query
     parts = ["WITH matched_edges AS ("]
     if 'node' in criteria:
         piece_directions = [1, -1]
@@ -43,7 +248,7 @@ def make_list_query(criteria):
         if direction == -1:
             parts.append("UNION ALL")
         parts.append("""
-            SELECT e.uri, e.weight, e.data
+            (SELECT DISTINCT e.id, e.uri, e.weight
             FROM relations r, edges e, nodes n1, nodes n2,
                  node_prefixes p1, node_prefixes p2, nodes np1, nodes np2
         """)
@@ -76,26 +281,250 @@ def make_list_query(criteria):
             parts.append("AND np1.uri = :start")
         if 'end' in criteria:
             parts.append("AND np2.uri = :end")
-    parts.append("LIMIT 10000")
+        if 'after' in criteria:
+            parts.append(keyset_condition('e'))
+        # Each direction only needs to contribute the edges that could be
+        # on this page, which are at the top of the same order. An edge is
+        # joined once per prefix of its nodes, so the duplicates are
+        # removed first (with DISTINCT, above) to keep them from taking up
+        # the limit.
+        parts.append("""
+            ORDER BY e.weight DESC, e.uri
+            LIMIT :offset + :limit)
+        """)
     parts.append(")")
     parts.append("""
-        SELECT DISTINCT ON (weight, uri) uri, data FROM matched_edges
-        ORDER BY weight DESC, uri
-        OFFSET :offset LIMIT :limit
-    """)
+        SELECT m.uri, m.weight, d.data FROM (
+            SELECT DISTINCT ON (weight, uri) id, weight, uri FROM matched_edges
+            ORDER BY weight DESC, uri
+            OFFSET :offset LIMIT :limit
+        ) m, %s d
+        WHERE d.id = m.id
+        ORDER BY m.weight DESC, m.uri
+    """ % edge_data)
     query = '\n'.join(parts)
-    LIST_QUERIES[crit_tuple] = query
+    LIST_QUERIES[crit_tuple, edge_data] = query
     return query
 
 
+def make_prepared_list_query(criteria, edge_data='edges'):
+    """
+    Get the query from `make_list_query` as a PreparedQuery, with one
+    prepared statement per combination of criteria.
+    """
+    crit_tuple = list_criteria_key(criteria)
+    if (crit_tuple, edge_data) not in PREPARED_LIST_QUERIES:
+        name = '_'.join(('cn5_list', edge_data) + crit_tuple)
+        PREPARED_LIST_QUERIES[crit_tuple, edge_data] = PreparedQuery(
+            name, make_list_query(criteria, edge_data)
+        )
+    return PREPARED_LIST_QUERIES[crit_tuple, edge_data]
+
+
 class AssertionFinder(object):
-    def __init__(self, dbname=None):
-        self.connection = None
+    """
+    Looks up edges in the ConceptNet database.
+
+    The queries are run on a pool of connections (see
+    `conceptnet5.db.connection.ConnectionPool`), so one AssertionFinder can
+    be used by several threads at once.
+
+    The results of `query` (and therefore most lookups) and of
+    `lookup_grouped_by_feature` can be cached. By default, the cache is the
+    one configured in `conceptnet5.db.config`; `cache` can be set to a
+    different cache object from `conceptnet5.db.cache`, or to False to turn
+    off caching.
+
+    If `precomputed_ld` is True, the edges are read from the `edges_ld`
+    table, which contains them already transformed for Linked Data, instead
+    of being transformed as they're returned. It defaults to the
+    CONCEPTNET_DB_PRECOMPUTED_LD setting. If the `edges_ld` table is empty,
+    as it is in a database loaded from files that don't include it, the
+    edges are transformed as usual.
+    """
+    def __init__(self, dbname=None, cache=None, precomputed_ld=None, compact=None):
+        self.pool = None
         self.dbname = dbname
+        if cache is None:
+            cache = make_cache()
+        self.cache = cache or None
+        if precomputed_ld is None:
+            precomputed_ld = config.DB_PRECOMPUTED_LD
+        if compact is None:
+            compact = config.DB_COMPACT
+        if precomputed_ld and compact:
+            raise ValueError("A compact database doesn't contain precomputed Linked Data")
+        self.precomputed_ld = precomputed_ld
+        self._ld_loaded = (None, False)
+        self.decoder = None
+        if compact:
+            self.decoder = CompactEdgeDecoder(
+                functools.partial(self._fetchall, query_type='compact_nodes')
+            )
+        self.stats = QueryStats()
+        self._explainer = None
+        self._explain_lock = threading.Lock()
+        self._explains_pending = 0
+
+    def _edge_data(self):
+        """
+        Get the {edge_data} table to read the edges from: 'edges_ld' if
+        we're using precomputed Linked Data and the database has it, or
+        'edges' otherwise. Whether `edges_ld` has any rows is checked once
+        for each build and version of the database.
+        """
+        if not self.precomputed_ld:
+            return 'edges'
+        build_key = (get_build_id(), self._get_pool().version)
+        checked_key, loaded = self._ld_loaded
+        if checked_key != build_key:
+            rows = self._get_pool().fetchall('SELECT EXISTS (SELECT 1 FROM edges_ld)')
+            loaded = bool(rows[0][0])
+            self._ld_loaded = (build_key, loaded)
+        return 'edges_ld' if loaded else 'edges'
+
+    def _raw_edges(self, rows, edge_data):
+        """
+        Get RawEdges from (uri, weight, data) rows that were read from the
+        `edge_data` table. The JSON text comes straight from the database
+        if it's precomputed Linked Data, and otherwise it's serialized the
+        same way that the API would serialize it.
+        """
+        if edge_data == 'edges_ld':
+            return [RawEdge(data, uri=uri, weight=weight) for uri, weight, data in rows]
+        edges = self._edges([data for uri, weight, data in rows], edge_data)
+        return [
+            RawEdge(json.dumps(edge, ensure_ascii=False, sort_keys=True), uri=uri, weight=weight)
+            for (uri, weight, data), edge in zip(rows, edges)
+        ]
+
+    def _edges(self, datas, edge_data):
+        """
+        Get the Linked Data form of a list of edges from the data that the
+        database returned for them from the `edge_data` table.
+        """
+        if edge_data == 'edges_ld':
+            return [json.loads(data) for data in datas]
+        if self.decoder is not None:
+            datas = self.decoder.decode_many(
+                datas, build_key=(get_build_id(), self._get_pool().version)
+            )
+        return [transform_for_linked_data(data) for data in datas]
+
+    def _get_pool(self):
+        if self.pool is None:
+            self.pool = get_db_pool(self.dbname)
+        return self.pool
+
+    def _fetchall(self, query, params=None, query_type='other'):
+        return self._timed(
+            query_type, query, params,
+            lambda: self._get_pool().fetchall(query, params)
+        )
+
+    def _fetchall_prepared(self, prepared, params, query_type):
+        return self._timed(
+            query_type, prepared.query, params,
+            lambda: self._get_pool().run(lambda pooled: prepared.fetchall(pooled, params))
+        )
+
+    def _timed(self, query_type, query, params, run):
+        """
+        Run a query by calling `run`, and record how long it took in
+        `self.stats`. See `conceptnet5.db.stats`.
+        """
+        start_time = time.monotonic()
+        rows = run()
+        seconds = time.monotonic() - start_time
+        self.stats.record(query_type, seconds, len(rows))
+        if seconds >= config.DB_SLOW_QUERY_SECONDS:
+            entry = self.stats.record_slow(query_type, query, params, seconds)
+            if random.random() < config.DB_EXPLAIN_SAMPLE_RATE:
+                self._explain_later(entry, query, params)
+        return rows
+
+    def _explain_later(self, entry, query, params):
+        """
+        Explain a slow query on a background thread, so that the request
+        that ran it doesn't wait for it to run again. The queries are
+        explained one at a time, and at most EXPLAIN_QUEUE_SIZE of them can
+        be waiting; any more aren't explained.
+        """
+        with self._explain_lock:
+            if self._explains_pending >= EXPLAIN_QUEUE_SIZE:
+                return
+            self._explains_pending += 1
+            if self._explainer is None:
+                self._explainer = ThreadPoolExecutor(max_workers=1)
+        self._explainer.submit(self._explain, entry, query, params)
+
+    def _explain(self, entry, query, params):
+        """
+        Run a query again with EXPLAIN (ANALYZE, BUFFERS), and add the text
+        of its plan to its entry in the slow query log.
+        """
+        try:
+            try:
+                rows = self._get_pool().fetchall('EXPLAIN (ANALYZE, BUFFERS) ' + query, params)
+            except (pg8000.Error, IOError) as err:
+                plan = "Couldn't explain the query: %s" % err
+            else:
+                plan = '\n'.join(line for (line,) in rows)
+            self.stats.add_plan(entry, plan)
+        finally:
+            with self._explain_lock:
+                self._explains_pending -= 1
+
+    def query_stats(self):
+        """
+        Get the statistics about the queries this AssertionFinder has run,
+        as a dictionary with 'queries' (latency and row counts for each kind
+        of query) and 'slow_queries' (the most recent slow queries).
+        """
+        return self.stats.to_dict()
+
+    def _cached(self, key, compute):
+        """
+        Get the result for a cache key, calling `compute` to get it if it's
+        not in the cache.
+        """
+        if self.cache is None:
+            return compute()
+        key = (self.dbname, get_build_id(), self._get_pool().version) + key
+        result = self.cache.get(key)
+        if result is None:
+            result = compute()
+            self.cache.set(key, result)
+        return result
+
+    def cache_stats(self):
+        """
+        Get the hit and miss counts of the result cache, or None if results
+        aren't being cached.
+        """
+        if self.cache is None:
+            return None
+        return self.cache.stats()
 
-    def lookup(self, uri, limit=100, offset=0):
-        if self.connection is None:
-            self.connection = get_db_connection(self.dbname)
+    @staticmethod
+    def prepared_statement_stats():
+        """
+        Get counters of how often our prepared statements have been reused
+        in this process, and an upper bound on the query planning time that
+        this has saved.
+        """
+        return PREPARED_STATS.to_dict()
+
+    def lookup(self, uri, limit=100, offset=0, after=None, raw=False):
+        """
+        Look up the edges involving a URI, which can be a node, relation,
+        source, dataset, or assertion.
+
+        `after` can be set to the (weight, uri) of the last edge on the
+        previous page, to get the page that follows it; it takes the place
+        of `offset` when paging through all the results. `raw` asks for
+        the edges as RawEdge text. See `query`.
+        """
         if uri.startswith('/c/') or uri.startswith('http'):
             criteria = {'node': uri}
         elif uri.startswith('/r/'):
@@ -108,69 +537,216 @@ class AssertionFinder(object):
             return self.sample_dataset(uri, limit, offset)
         else:
             raise ValueError
-        return self.query(criteria, limit, offset)
+        return self.query(criteria, limit, offset, after=after, raw=raw)
+
+    def lookup_many(self, uris, limit_per_uri=20):
+        """
+        Look up the top `limit_per_uri` edges for each of a list of URIs,
+        returning a dictionary from each URI to its list of edges. The edges
+        are the same ones that `lookup(uri, limit=limit_per_uri)` would
+        return.
+
+        All the node URIs are looked up in a single query. Other kinds of
+        URIs, which are uncommon here, are looked up one at a time.
+        """
+        results = {uri: [] for uri in uris}
+        node_uris = [
+            uri for uri in results
+            if uri.startswith('/c/') or uri.startswith('http')
+        ]
+        for uri in results:
+            if uri not in node_uris:
+                results[uri] = self.lookup(uri, limit=limit_per_uri)
+        if node_uris:
+            edge_data = self._edge_data()
+            rows = self._fetchall(
+                LOOKUP_MANY_QUERY.format(edge_data=edge_data),
+                {'uris': node_uris, 'limit': limit_per_uri},
+                query_type='lookup_many'
+            )
+            edges = self._edges([data for _query_uri, _uri, data in rows], edge_data)
+            for (query_uri, _uri, _data), edge in zip(rows, edges):
+                results[query_uri].append(edge)
+        return results
 
     def lookup_grouped_by_feature(self, uri, limit=20):
-        if self.connection is None:
-            self.connection = get_db_connection(self.dbname)
+        """
+        Get the top edges of a concept, grouped by their features. The
+        result is a dictionary from (direction, rel) pairs to lists of up to
+        `limit` edges.
+        """
+        summary = self.lookup_feature_summary(uri, limit)
+        return {feature: edges for feature, (count, edges) in summary.items()}
 
-        def extract_feature(row):
-            return tuple(row[:2])
+    def lookup_feature_summary(self, uri, limit=20):
+        """
+        Get the top edges of a concept grouped by their features, like
+        `lookup_grouped_by_feature`, along with the total number of edges
+        each feature has. The result is a dictionary from (direction, rel)
+        pairs to (count, edges) pairs.
 
-        def feature_data(row):
-            direction, _, data = row
+        The top edges come from the `feature_summary` table, which stores
+        at most `schema.FEATURE_SUMMARY_SIZE` edges per feature, so `limit`
+        can't usefully be larger than that.
+        """
+        return self._cached(
+            ('features', uri, limit),
+            lambda: self._lookup_feature_summary(uri, limit)
+        )
 
-            # Hacky way to figure out what the 'other' node is, the one that
-            # (in most cases) didn't match the URI. If both start with our
-            # given URI, take the longer one, which is either a more specific
-            # sense or a different, longer word.
-            shorter, longer = sorted([data['start'], data['end']], key=len)
-            if shorter.startswith(uri):
-                data['other'] = longer
-            else:
-                data['other'] = shorter
-            return data
+    def _lookup_feature_summary(self, uri, limit):
+        def extract_feature(item):
+            row, edge = item
+            return tuple(row[:2])
 
-        cursor = self.connection.cursor()
-        cursor.execute(NODE_TO_FEATURE_QUERY, {'node': uri, 'limit': limit})
+        edge_data = self._edge_data()
+        rows = self._fetchall(
+            FEATURE_SUMMARY_QUERY.format(edge_data=edge_data),
+            {'node': uri, 'limit': limit},
+            query_type='feature_summary'
+        )
+        edges = self._edges([row[3] for row in rows], edge_data)
         results = {}
-        for feature, rows in itertools.groupby(cursor.fetchall(), extract_feature):
-            results[feature] = [transform_for_linked_data(feature_data(row)) for row in rows]
+        for feature, group in itertools.groupby(zip(rows, edges), extract_feature):
+            group = list(group)
+            count = group[0][0][2]
+            results[feature] = (count, [set_other_node(edge, uri) for row, edge in group])
         return results
 
+    def complete_terms(self, language, text, limit=10):
+        """
+        Get the terms in a language whose text starts with some partly-typed
+        `text`, as a list of (uri, edge_count) pairs, with the terms that
+        have the most edges first.
+
+        The completions come from the files that `cn5-db build_completions`
+        builds, if they exist, and otherwise from the database.
+        """
+        prefix = completion_prefix(language, text)
+        language, prefix_text = split_uri(prefix)[1:3]
+        if not prefix_text:
+            return []
+        completions = get_completions()
+        if completions is not None:
+            start_time = time.monotonic()
+            results = completions.complete(prefix, limit)
+            self.stats.record('complete_terms', time.monotonic() - start_time, len(results))
+            return results
+        upper = prefix_text[:-1] + chr(ord(prefix_text[-1]) + 1)
+        rows = self._fetchall(
+            COMPLETE_TERMS_QUERY,
+            {'language': language, 'prefix': prefix_text, 'upper': upper, 'limit': limit},
+            query_type='complete_terms'
+        )
+        return [tuple(row) for row in rows]
+
+    def fuzzy_terms(self, language, text, limit=10):
+        """
+        Get the terms in a language whose text is similar to `text`, which
+        may be misspelled, as a list of (uri, edge_count) pairs. The most
+        similar terms come first, and equally similar ones are ranked by
+        their number of edges.
+        """
+        language, term_text = split_uri(completion_prefix(language, text))[1:3]
+        term_text = term_text.rstrip('_')
+        if not term_text:
+            return []
+        rows = self._fetchall(
+            FUZZY_TERMS_QUERY,
+            {'language': language, 'text': term_text, 'limit': limit},
+            query_type='fuzzy_terms'
+        )
+        return [tuple(row) for row in rows]
+
     def lookup_assertion(self, uri):
-        if self.connection is None:
-            self.connection = get_db_connection(self.dbname)
-        cursor = self.connection.cursor()
-        cursor.execute("SELECT data FROM edges WHERE uri=:uri", {'uri': uri})
-        results = [transform_for_linked_data(data) for (data,) in cursor.fetchall()]
+        edge_data = self._edge_data()
+        rows = self._fetchall(
+            ASSERTION_QUERY.format(edge_data=edge_data), {'uri': uri},
+            query_type='assertion'
+        )
+        results = self._edges([data for (data,) in rows], edge_data)
         return results
 
     def sample_dataset(self, uri, limit=50, offset=0):
-        if self.connection is None:
-            self.connection = get_db_connection(self.dbname)
-        cursor = self.connection.cursor()
-        dataset_json = json.dumps(uri)
-        cursor.execute(DATASET_QUERY, {'dataset': dataset_json, 'limit': limit, 'offset': offset})
-        results = [transform_for_linked_data(data) for uri, data in cursor.fetchall()]
+        """
+        Get a sample of the edges from a dataset. The sample is random, but
+        it stays the same until the database is rebuilt, so it can be paged
+        through with `offset`.
+        """
+        edge_data = self._edge_data()
+        rows = self._fetchall(
+            DATASET_QUERY.format(edge_data=edge_data),
+            {'dataset': uri, 'limit': limit, 'offset': offset},
+            query_type='sample_dataset'
+        )
+        results = self._edges([data for uri, data in rows], edge_data)
         return results
 
     def random_edges(self, limit=20):
-        if self.connection is None:
-            self.connection = get_db_connection(self.dbname)
-        cursor = self.connection.cursor()
-        cursor.execute(RANDOM_QUERY, {'limit': limit})
-        results = [transform_for_linked_data(data) for uri, data in cursor.fetchall()]
+        """
+        Get `limit` edges chosen at random.
+        """
+        edge_data = self._edge_data()
+        rows = self._fetchall(
+            RANDOM_QUERY.format(edge_data=edge_data),
+            {'start': random.random(), 'limit': limit},
+            query_type='random_edges'
+        )
+        results = self._edges([data for uri, data in rows], edge_data)
         return results
 
-    def query(self, criteria, limit=20, offset=0):
-        if self.connection is None:
-            self.connection = get_db_connection(self.dbname)
+    def query(self, criteria, limit=20, offset=0, after=None, raw=False):
+        """
+        Find edges that match a dictionary of criteria, sorted by descending
+        weight and then by URI.
+
+        To page through the results, set `after` to the (weight, uri) of the
+        last edge that was returned. Unlike a large `offset`, this doesn't
+        make the database find and skip all the earlier results.
+
+        If `raw` is True, the edges are returned as RawEdge strings of JSON
+        instead of dictionaries. With precomputed Linked Data, they're never
+        decoded at all, so they can be passed through to an API response.
+        """
+        criteria = dict(criteria)
+        criteria.pop('after', None)
+        if after is not None:
+            after = (float(after[0]), after[1])
+        return self._cached(
+            ('query', tuple(sorted(criteria.items())), limit, offset, after, raw),
+            lambda: self._query(criteria, limit, offset, after, raw)
+        )
+
+    def _query(self, criteria, limit, offset, after, raw):
         params = dict(criteria)
+        if after is not None:
+            after_weight, after_uri = after
+            criteria = dict(criteria, after=True)
+            params['after_weight'] = after_weight
+            params['after_uri'] = after_uri
         params['limit'] = limit
         params['offset'] = offset
-        query_string = make_list_query(criteria)
-        cursor = self.connection.cursor()
-        cursor.execute(query_string, params)
-        results = [transform_for_linked_data(data) for uri, data in cursor.fetchall()]
+        edge_data = self._edge_data()
+        prepared = make_prepared_list_query(criteria, edge_data)
+        query_type = 'query(%s)' % ','.join(list_criteria_key(criteria))
+        rows = self._fetchall_prepared(prepared, params, query_type)
+        if raw:
+            results = self._raw_edges(rows, edge_data)
+        else:
+            results = self._edges([data for uri, weight, data in rows], edge_data)
         return results
+
+
+def make_finder(dbname=None):
+    """
+    Make the kind of AssertionFinder that CONCEPTNET_DB_BACKEND asks for:
+    one that queries the database, or an EmbeddedAssertionFinder that reads
+    the files built by `cn5-db build_embedded`.
+    """
+    if config.DB_BACKEND == 'embedded':
+        from .embedded import EmbeddedAssertionFinder
+        return EmbeddedAssertionFinder()
+    elif config.DB_BACKEND == 'postgres':
+        return AssertionFinder(dbname)
+    else:
+        raise ValueError("Unknown database backend: %r" % config.DB_BACKEND)
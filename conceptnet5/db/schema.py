@@ -1,5 +1,23 @@
+import re
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+# How many of the top edges of each feature are stored in feature_summary
+FEATURE_SUMMARY_SIZE = 100
+
 TABLES = [
     "DROP MATERIALIZED VIEW IF EXISTS ranked_features",
+    "DROP MATERIALIZED VIEW IF EXISTS feature_summary",
+    "DROP MATERIALIZED VIEW IF EXISTS node_edges",
+    "DROP MATERIALIZED VIEW IF EXISTS edge_order",
+    "DROP MATERIALIZED VIEW IF EXISTS edge_samples",
+    "DROP MATERIALIZED VIEW IF EXISTS term_search",
+    # pg_trgm provides the trigram index that term_search uses for fuzzy
+    # search. It's installed in the public schema, so that every version
+    # of the data can use it.
+    "CREATE EXTENSION IF NOT EXISTS pg_trgm WITH SCHEMA public",
+    "DROP TABLE IF EXISTS edges_ld",
     "DROP TABLE IF EXISTS edge_features",
     "DROP TABLE IF EXISTS edge_sources",
     "DROP TABLE IF EXISTS node_prefixes",
@@ -7,55 +25,85 @@ TABLES = [
     "DROP TABLE IF EXISTS nodes",
     "DROP TABLE IF EXISTS sources",
     "DROP TABLE IF EXISTS relations",
-    """CREATE TABLE nodes (
-        id     integer NOT NULL PRIMARY KEY,
+    # The tables are created unlogged and without keys, so that loading them
+    # is as fast as possible. LOGGED_TABLES and INDEX_STAGES make them into
+    # normal tables after they're loaded.
+    """CREATE UNLOGGED TABLE nodes (
+        id     integer NOT NULL,
         uri    text NOT NULL
     )""",
-    """CREATE TABLE sources (
-        id     integer NOT NULL PRIMARY KEY,
+    """CREATE UNLOGGED TABLE sources (
+        id     integer NOT NULL,
         uri    text NOT NULL
     )""",
-    """CREATE TABLE relations (
-        id        integer NOT NULL PRIMARY KEY,
+    """CREATE UNLOGGED TABLE relations (
+        id        integer NOT NULL,
         uri       text NOT NULL,
         directed  bool NOT NULL
     )
     """,
-    """CREATE TABLE edges (
-        id             integer NOT NULL PRIMARY KEY,
+    """CREATE UNLOGGED TABLE edges (
+        id             integer NOT NULL,
         uri            text NOT NULL,
-        relation_id    integer NOT NULL REFERENCES relations (id),
-        start_id       integer NOT NULL REFERENCES nodes (id),
-        end_id         integer NOT NULL REFERENCES nodes (id),
+        relation_id    integer NOT NULL,
+        start_id       integer NOT NULL,
+        end_id         integer NOT NULL,
         weight         real NOT NULL,
         data           jsonb NOT NULL
     )""",
-    """CREATE TABLE edge_sources (
-        edge_id        integer NOT NULL REFERENCES edges (id),
-        source_id      integer NOT NULL REFERENCES sources (id)
+    # The same edges, already transformed into the form the API returns.
+    # The data is text, not jsonb, so that it comes back exactly as it was
+    # serialized.
+    """CREATE UNLOGGED TABLE edges_ld (
+        id             integer NOT NULL,
+        data           text NOT NULL
+    )""",
+    """CREATE UNLOGGED TABLE edge_sources (
+        edge_id        integer NOT NULL,
+        source_id      integer NOT NULL
     )
     """,
-    """CREATE TABLE node_prefixes (
-        node_id        integer NOT NULL REFERENCES nodes (id),
-        prefix_id      integer NOT NULL REFERENCES nodes (id)
+    """CREATE UNLOGGED TABLE node_prefixes (
+        node_id        integer NOT NULL,
+        prefix_id      integer NOT NULL
     )
     """,
-    """CREATE TABLE edge_features (
-        rel_id    integer NOT NULL REFERENCES relations (id),
+    """CREATE UNLOGGED TABLE edge_features (
+        rel_id    integer NOT NULL,
         direction integer NOT NULL,
-        node_id   integer NOT NULL REFERENCES nodes (id),
-        edge_id   integer NOT NULL REFERENCES edges (id)
+        node_id   integer NOT NULL,
+        edge_id   integer NOT NULL
     )
     """
 ]
 
-INDICES = [
-    "ALTER TABLE nodes ADD CONSTRAINT nodes_unique_uri UNIQUE (uri)",
-    "ALTER TABLE sources ADD CONSTRAINT sources_unique_uri UNIQUE (uri)",
-    "ALTER TABLE edges ADD CONSTRAINT edges_unique_uri UNIQUE (uri)",
-    "ALTER TABLE relations ADD CONSTRAINT relations_unique_uri UNIQUE (uri)",
+# The tables to switch to logged once they're loaded, which happens before
+# their indices are built, so the indices don't have to be rewritten
+LOGGED_TABLES = [
+    'relations', 'nodes', 'sources', 'edges', 'edges_ld',
+    'edge_sources', 'node_prefixes', 'edge_features'
+]
+
+# The commands that build keys, indices, and materialized views, in stages.
+# The tasks within a stage can run at the same time on different
+# connections without conflicting over locks, and each stage depends on the
+# ones before it. A task is a command, or a list of commands that run in
+# order on one connection.
+INDEX_STAGES = []
+
+# Adding a key locks its table against everything else, including building
+# its other indices, so the keys are added first
+INDEX_STAGES.append([
+    "ALTER TABLE nodes ADD PRIMARY KEY (id), ADD CONSTRAINT nodes_unique_uri UNIQUE (uri)",
+    "ALTER TABLE sources ADD PRIMARY KEY (id), ADD CONSTRAINT sources_unique_uri UNIQUE (uri)",
+    "ALTER TABLE edges ADD PRIMARY KEY (id), ADD CONSTRAINT edges_unique_uri UNIQUE (uri)",
+    "ALTER TABLE relations ADD PRIMARY KEY (id), ADD CONSTRAINT relations_unique_uri UNIQUE (uri)",
+    "ALTER TABLE edges_ld ADD PRIMARY KEY (id)",
     "ALTER TABLE edge_sources ADD CONSTRAINT edge_sources_unique UNIQUE (edge_id, source_id)",
     "ALTER TABLE node_prefixes ADD CONSTRAINT node_prefixes_unique UNIQUE (node_id, prefix_id)",
+])
+
+INDEX_STAGES.append([
     "CREATE INDEX edge_relation ON edges (relation_id)",
     "CREATE INDEX edge_start ON edges (start_id)",
     "CREATE INDEX edge_end ON edges (end_id)",
@@ -65,19 +113,146 @@ INDICES = [
     "CREATE INDEX np_prefix ON node_prefixes (prefix_id)",
     "CREATE INDEX ef_feature ON edge_features (rel_id, direction, node_id)",
     "CREATE INDEX ef_node ON edge_features (node_id)",
+    # edge_order numbers the edges in order of their URIs, so that
+    # node_edges can sort the edges that have the same weight by a small
+    # integer instead of by their URIs.
+    """
+    CREATE MATERIALIZED VIEW edge_order AS (
+    SELECT id AS edge_id, CAST(row_number() OVER (ORDER BY uri) AS integer) AS uri_rank
+    FROM edges
+    ) WITH DATA
+    """,
+])
+
+INDEX_STAGES.append([
+    # Each foreign key locks both the table it's on and the table it refers
+    # to, so adding them on different connections could deadlock. They're
+    # added one at a time, in one task.
+    [
+        """ALTER TABLE edges
+            ADD FOREIGN KEY (relation_id) REFERENCES relations (id),
+            ADD FOREIGN KEY (start_id) REFERENCES nodes (id),
+            ADD FOREIGN KEY (end_id) REFERENCES nodes (id)
+        """,
+        "ALTER TABLE edges_ld ADD FOREIGN KEY (id) REFERENCES edges (id)",
+        """ALTER TABLE edge_sources
+            ADD FOREIGN KEY (edge_id) REFERENCES edges (id),
+            ADD FOREIGN KEY (source_id) REFERENCES sources (id)
+        """,
+        """ALTER TABLE node_prefixes
+            ADD FOREIGN KEY (node_id) REFERENCES nodes (id),
+            ADD FOREIGN KEY (prefix_id) REFERENCES nodes (id)
+        """,
+        """ALTER TABLE edge_features
+            ADD FOREIGN KEY (rel_id) REFERENCES relations (id),
+            ADD FOREIGN KEY (node_id) REFERENCES nodes (id),
+            ADD FOREIGN KEY (edge_id) REFERENCES edges (id)
+        """,
+    ],
+    # feature_summary lists, for each concept and each of its features (a
+    # relation and a direction), the top edges of that feature among the
+    # concept and all the more specific concepts it's a prefix of, along with
+    # the total number of edges the feature has.
+    """
+    CREATE MATERIALIZED VIEW feature_summary AS (
+    SELECT f.prefix_id, f.rel_id, f.direction, f.edge_id, f.rank, f.edge_count
+    FROM (
+        SELECT pf.prefix_id, pf.rel_id, pf.direction, pf.edge_id,
+               row_number() OVER (
+                   PARTITION BY pf.prefix_id, pf.rel_id, pf.direction
+                   ORDER BY e.weight DESC, e.uri
+               ) AS rank,
+               count(*) OVER (
+                   PARTITION BY pf.prefix_id, pf.rel_id, pf.direction
+               ) AS edge_count
+        FROM (
+            SELECT DISTINCT p.prefix_id, ef.rel_id, ef.direction, ef.edge_id
+            FROM nodes n, node_prefixes p, edge_features ef
+            WHERE n.uri LIKE '/c/%%/%%' AND p.prefix_id=n.id AND ef.node_id=p.node_id
+        ) pf, edges e WHERE e.id=pf.edge_id
+    ) f
+    WHERE f.rank <= %d
+    ) WITH DATA
+    """ % FEATURE_SUMMARY_SIZE,
+    # node_edges lists, for each node, the edges that it or any of the nodes
+    # it's a prefix of participate in. Its index lets us find a node's edges,
+    # in weight order, by scanning a range of the index instead of joining
+    # the prefix tables. It only has integers and booleans, besides the
+    # weight, to keep it and its indices small.
     """
-    CREATE MATERIALIZED VIEW ranked_features AS (
-    SELECT ef.rel_id, ef.direction, ef.node_id, ef.edge_id, e.weight,
-           row_number() OVER (
-               PARTITION BY (ef.node_id, ef.rel_id, ef.direction)
-               ORDER BY e.weight DESC, e.id
-           ) AS rank
-    FROM edge_features ef, edges e WHERE e.id=ef.edge_id
+    CREATE MATERIALIZED VIEW node_edges AS (
+    SELECT pe.prefix_id, e.id AS edge_id, e.relation_id, e.weight, o.uri_rank,
+           pe.is_start, pe.is_end
+    FROM (
+        SELECT prefix_id, edge_id, bool_or(is_start) AS is_start, bool_or(is_end) AS is_end
+        FROM (
+            SELECT p.prefix_id, e.id AS edge_id, true AS is_start, false AS is_end
+            FROM node_prefixes p, edges e WHERE p.node_id=e.start_id
+            UNION ALL
+            SELECT p.prefix_id, e.id AS edge_id, false AS is_start, true AS is_end
+            FROM node_prefixes p, edges e WHERE p.node_id=e.end_id
+        ) pe_all
+        GROUP BY prefix_id, edge_id
+    ) pe, edges e, edge_order o WHERE e.id=pe.edge_id AND o.edge_id=pe.edge_id
     ) WITH DATA
     """,
-    "CREATE INDEX rf_node ON ranked_features (node_id)",
+    # edge_samples gives every edge a random sample key, fixed when the
+    # database is built, and the dataset it comes from. Scanning its indices
+    # from a random starting key gives a random sample of edges, and paging
+    # through a dataset in sample-key order gives a stable random sample.
+    # In a compact database, the dataset is stored as a node id.
+    """
+    CREATE MATERIALIZED VIEW edge_samples AS (
+    SELECT e.id AS edge_id, COALESCE(dn.uri, e.data->>'dataset') AS dataset, e.uri,
+           random() AS sample_key
+    FROM edges e LEFT JOIN nodes dn ON dn.id = (
+        CASE WHEN jsonb_typeof(e.data->'dataset') = 'number'
+        THEN CAST(e.data->>'dataset' AS integer) END
+    )
+    ) WITH DATA
+    """,
+    # term_search lists the terms -- concepts without a sense, such as
+    # /c/en/ice_cream -- with the number of edges each one has, so that
+    # they can be searched for by prefix or by fuzzy matching, and ranked.
+    """
+    CREATE MATERIALIZED VIEW term_search AS (
+    SELECT n.uri, split_part(n.uri, '/', 3) AS language,
+           split_part(n.uri, '/', 4) AS text, te.edge_count
+    FROM (
+        SELECT prefix_id, count(DISTINCT edge_id) AS edge_count
+        FROM (
+            SELECT p.prefix_id, e.id AS edge_id
+            FROM node_prefixes p, edges e WHERE p.node_id=e.start_id
+            UNION ALL
+            SELECT p.prefix_id, e.id AS edge_id
+            FROM node_prefixes p, edges e WHERE p.node_id=e.end_id
+        ) pe
+        GROUP BY prefix_id
+    ) te, nodes n
+    WHERE n.id=te.prefix_id AND n.uri ~ '^/c/[^/]+/[^/]+$'
+    ) WITH DATA
+    """,
+])
+
+INDEX_STAGES.append([
+    "CREATE INDEX fs_prefix ON feature_summary (prefix_id, rank)",
+    "CREATE UNIQUE INDEX edge_order_edge ON edge_order (edge_id)",
+    "CREATE INDEX ne_prefix ON node_edges (prefix_id, weight DESC, uri_rank)",
+    "CREATE INDEX ne_prefix_rel ON node_edges (prefix_id, relation_id, weight DESC, uri_rank)",
+    "CREATE INDEX edge_samples_key ON edge_samples (sample_key)",
+    "CREATE INDEX edge_samples_dataset ON edge_samples (dataset, sample_key)",
+    "CREATE INDEX term_search_prefix ON term_search (language, text text_pattern_ops)",
+    "CREATE INDEX term_search_trgm ON term_search USING gin (text public.gin_trgm_ops)",
+])
+
+INDICES = [
+    cmd for stage in INDEX_STAGES for task in stage
+    for cmd in ([task] if isinstance(task, str) else task)
 ]
 
+# Values that can be given for maintenance_work_mem, such as '256MB'
+MEMORY_SETTING_RE = re.compile(r'^[0-9]+ ?(kB|MB|GB|TB)?$')
+
 
 def run_commands(connection, commands):
     cursor = connection.cursor()
@@ -86,9 +261,84 @@ def run_commands(connection, commands):
     connection.commit()
 
 
+def describe_command(cmd, length=60):
+    """
+    Get a short, one-line description of a SQL command, for progress
+    messages.
+    """
+    text = ' '.join(cmd.split())
+    if len(text) > length:
+        text = text[:length - 3] + '...'
+    return text
+
+
+def run_tasks(pool, tasks, jobs=1):
+    """
+    Run a list of (description, func) tasks at the same time on up to `jobs`
+    connections from `pool`. Each `func` is called with a PooledConnection,
+    and is responsible for committing its own work.
+
+    Prints how long each task took to stderr, and raises the first error
+    from any of them after they've all finished.
+    """
+    def run_timed(description, func):
+        start_time = time.monotonic()
+        with pool.connection() as pooled:
+            func(pooled)
+        print(
+            "%7.1fs  %s" % (time.monotonic() - start_time, description),
+            file=sys.stderr
+        )
+
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        futures = [
+            executor.submit(run_timed, description, func)
+            for description, func in tasks
+        ]
+    for future in futures:
+        future.result()
+
+
 def create_tables(connection):
     run_commands(connection, TABLES)
 
 
-def create_indices(connection):
-    run_commands(connection, INDICES)
+def set_tables_logged(pool, jobs=1):
+    """
+    Switch the tables from unlogged, as they're created for loading, to
+    logged, so that they're crash-safe and can be replicated.
+    """
+    tasks = []
+    for table in LOGGED_TABLES:
+        cmd = 'ALTER TABLE %s SET LOGGED' % table
+        tasks.append((cmd, _command_task([cmd])))
+    run_tasks(pool, tasks, jobs)
+
+
+def create_indices(pool, jobs=1, maintenance_work_mem=None):
+    """
+    Build the keys, indices, and materialized views, running the commands in
+    each of the INDEX_STAGES on up to `jobs` connections at once.
+
+    `maintenance_work_mem` is the amount of memory that PostgreSQL can use
+    for building each index, such as '1GB'. It's used by every connection
+    at once, so it should be chosen with `jobs` in mind.
+    """
+    setup = []
+    if maintenance_work_mem is not None:
+        if not MEMORY_SETTING_RE.match(maintenance_work_mem):
+            raise ValueError(
+                "%r is not a valid amount of memory" % maintenance_work_mem
+            )
+        setup.append("SET maintenance_work_mem = '%s'" % maintenance_work_mem)
+    for stage in INDEX_STAGES:
+        tasks = []
+        for task in stage:
+            commands = [task] if isinstance(task, str) else task
+            description = describe_command('; '.join(commands))
+            tasks.append((description, _command_task(setup + commands)))
+        run_tasks(pool, tasks, jobs)
+
+
+def _command_task(commands):
+    return lambda pooled: run_commands(pooled.connection, commands)
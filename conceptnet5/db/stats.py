@@ -0,0 +1,142 @@
+"""
+Instrumentation for the queries that AssertionFinder runs.
+
+Every query is timed, and its latency and row count are added to the
+statistics for its kind of query. Queries made by `AssertionFinder.query`
+are told apart by the combination of criteria they use, such as
+'query(node,rel)', because that's what determines which SQL they run.
+
+Queries that take longer than CONCEPTNET_DB_SLOW_QUERY_SECONDS are logged,
+with their parameters, to the 'conceptnet5.db' logger. A fraction of them,
+set by CONCEPTNET_DB_EXPLAIN_SAMPLE_RATE, are run again with
+EXPLAIN (ANALYZE, BUFFERS) on a background thread, and the resulting plans
+are added to the most recent slow queries when they're ready.
+
+The statistics are kept separately by each process.
+"""
+from collections import deque
+import bisect
+import logging
+import threading
+
+LOGGER = logging.getLogger('conceptnet5.db')
+
+# The upper bounds, in seconds, of the buckets in the latency histograms
+LATENCY_BUCKETS = [
+    0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1., 2., 5., 10.
+]
+
+# How many slow queries to remember
+SLOW_QUERY_LOG_SIZE = 100
+
+
+class QueryTypeStats(object):
+    """
+    The statistics for one kind of query: how many times it ran, how many
+    rows it returned, and a histogram of how long it took.
+    """
+    def __init__(self):
+        self.count = 0
+        self.rows = 0
+        self.total_seconds = 0.
+        self.max_seconds = 0.
+        # One more bucket than LATENCY_BUCKETS, for queries slower than all
+        # of them
+        self.histogram = [0] * (len(LATENCY_BUCKETS) + 1)
+
+    def record(self, seconds, rows):
+        self.count += 1
+        self.rows += rows
+        self.total_seconds += seconds
+        self.max_seconds = max(self.max_seconds, seconds)
+        self.histogram[bisect.bisect_left(LATENCY_BUCKETS, seconds)] += 1
+
+    def percentile(self, fraction):
+        """
+        Estimate a percentile of the latency, as the upper bound of the
+        histogram bucket it falls in.
+        """
+        target = fraction * self.count
+        seen = 0
+        for bound, count in zip(LATENCY_BUCKETS, self.histogram):
+            seen += count
+            if seen >= target:
+                return bound
+        return self.max_seconds
+
+    def to_dict(self):
+        buckets = ['%g' % bound for bound in LATENCY_BUCKETS] + ['+Inf']
+        return {
+            'count': self.count,
+            'rows': self.rows,
+            'mean_rows': self.rows / self.count if self.count else 0.,
+            'total_seconds': self.total_seconds,
+            'mean_seconds': self.total_seconds / self.count if self.count else 0.,
+            'max_seconds': self.max_seconds,
+            'p50_seconds': self.percentile(0.5),
+            'p99_seconds': self.percentile(0.99),
+            'histogram': dict(zip(buckets, self.histogram)),
+        }
+
+
+class QueryStats(object):
+    """
+    Thread-safe statistics for all the kinds of queries that an
+    AssertionFinder runs, plus a log of recent slow queries.
+    """
+    def __init__(self, log_size=SLOW_QUERY_LOG_SIZE):
+        self._lock = threading.Lock()
+        self.log_size = log_size
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.by_type = {}
+            self.slow_queries = deque(maxlen=self.log_size)
+
+    def record(self, query_type, seconds, rows):
+        with self._lock:
+            if query_type not in self.by_type:
+                self.by_type[query_type] = QueryTypeStats()
+            self.by_type[query_type].record(seconds, rows)
+
+    def record_slow(self, query_type, query, params, seconds, plan=None):
+        """
+        Log a query that was slow. `plan` is the output of EXPLAIN ANALYZE,
+        if it was run. Returns the query's entry in the log, which a plan
+        can be added to later with `add_plan`.
+        """
+        LOGGER.warning(
+            "Slow %s query (%.3fs): %s with parameters %r",
+            query_type, seconds, ' '.join(query.split()), params
+        )
+        entry = {
+            'type': query_type,
+            'seconds': seconds,
+            'query': query,
+            'params': params,
+        }
+        if plan is not None:
+            entry['plan'] = plan
+        with self._lock:
+            self.slow_queries.append(entry)
+        return entry
+
+    def add_plan(self, entry, plan):
+        """
+        Add the output of EXPLAIN ANALYZE to a slow query's entry in the
+        log.
+        """
+        with self._lock:
+            entry['plan'] = plan
+
+    def to_dict(self):
+        with self._lock:
+            return {
+                'queries': {
+                    query_type: stats.to_dict()
+                    for (query_type, stats) in sorted(self.by_type.items())
+                },
+                # Copy the entries, because plans can be added to them later
+                'slow_queries': [dict(entry) for entry in self.slow_queries],
+            }
@@ -0,0 +1,152 @@
+"""
+Builds of ConceptNet can be loaded into the database side by side, so that a
+new build can be loaded while the API keeps serving the old one.
+
+Each version of the data is loaded into its own PostgreSQL schema, named
+`conceptnet_<version>`, with `cn5-db load_data --version <version>`. The
+one-row table `public.conceptnet_active` says which version is active, and
+`cn5-db activate <version>` changes it in a single transaction.
+
+ConnectionPools check which version is active every few seconds, and point
+the `search_path` of their connections at its schema, so running servers
+switch to a new version without being restarted. If no version has been
+activated, connections use the default `search_path`, where the tables are
+in the `public` schema as they were before versions existed.
+"""
+import re
+
+SCHEMA_PREFIX = 'conceptnet_'
+VERSION_RE = re.compile(r'^[a-z0-9_]+$')
+
+# The table that stores the active version
+ACTIVE_TABLE = 'public.conceptnet_active'
+
+# An empty table that's created in a version's schema once all of its
+# tables and indices have been built
+LOADED_TABLE = 'conceptnet_loaded'
+
+
+def schema_name(version):
+    """
+    Get the name of the schema that holds a version of ConceptNet, checking
+    that the version is a valid name.
+
+    >>> schema_name('5_6_0')
+    'conceptnet_5_6_0'
+    """
+    if not VERSION_RE.match(version):
+        raise ValueError(
+            "%r is not a valid version name: use lowercase letters, digits, "
+            "and underscores" % version
+        )
+    return SCHEMA_PREFIX + version
+
+
+def create_version_schema(connection, version):
+    """
+    Create an empty schema to load a version into, replacing it if it
+    already exists, and use only that schema for the rest of this
+    connection's session. The active version can't be replaced.
+
+    The `public` schema is left off the search_path, so that the commands
+    that drop and create tables can't affect the tables there.
+    """
+    schema = schema_name(version)
+    if get_active_version(connection) == version:
+        raise ValueError("Version %r is active, so it can't be replaced" % version)
+    cursor = connection.cursor()
+    cursor.execute("DROP SCHEMA IF EXISTS %s CASCADE" % schema)
+    cursor.execute("CREATE SCHEMA %s" % schema)
+    cursor.execute("SET search_path TO %s" % schema)
+    connection.commit()
+
+
+def use_version(connection, version):
+    """
+    Make a connection use the tables of a version, or the tables in the
+    `public` schema if `version` is None.
+
+    This also discards the connection's prepared statements, which were
+    planned for the tables it was using before.
+    """
+    cursor = connection.cursor()
+    if version is None:
+        cursor.execute("RESET search_path")
+    else:
+        cursor.execute("SET search_path TO %s, public" % schema_name(version))
+    cursor.execute("DEALLOCATE ALL")
+    connection.commit()
+
+
+def get_active_version(connection):
+    """
+    Get the version that's active in the database, or None if no version
+    has been activated.
+    """
+    cursor = connection.cursor()
+    cursor.execute("SELECT to_regclass(:table) IS NOT NULL", {'table': ACTIVE_TABLE})
+    [(exists,)] = cursor.fetchall()
+    if not exists:
+        return None
+    cursor.execute("SELECT version FROM %s" % ACTIVE_TABLE)
+    rows = cursor.fetchall()
+    if not rows:
+        return None
+    return rows[0][0]
+
+
+def list_versions(connection):
+    """
+    Get the versions that have been loaded into the database.
+    """
+    cursor = connection.cursor()
+    cursor.execute(
+        "SELECT nspname FROM pg_namespace WHERE left(nspname, length(:prefix)) = :prefix "
+        "ORDER BY nspname",
+        {'prefix': SCHEMA_PREFIX}
+    )
+    return [name[len(SCHEMA_PREFIX):] for (name,) in cursor.fetchall()]
+
+
+def mark_version_loaded(connection, version):
+    """
+    Record that a version has been completely loaded, after
+    `schema.create_indices` has finished building all of its indices.
+    """
+    cursor = connection.cursor()
+    cursor.execute("CREATE TABLE %s.%s ()" % (schema_name(version), LOADED_TABLE))
+    connection.commit()
+
+
+def activate_version(connection, version):
+    """
+    Make `version` the version of ConceptNet that's served from this
+    database. It has to be loaded already, as recorded by
+    `mark_version_loaded`.
+    """
+    schema = schema_name(version)
+    cursor = connection.cursor()
+    cursor.execute(
+        "SELECT to_regclass(:table) IS NOT NULL", {'table': schema + '.' + LOADED_TABLE}
+    )
+    [(loaded,)] = cursor.fetchall()
+    if not loaded:
+        raise ValueError("Version %r has not been loaded" % version)
+    cursor.execute("CREATE TABLE IF NOT EXISTS %s (version text NOT NULL)" % ACTIVE_TABLE)
+    cursor.execute("LOCK TABLE %s IN EXCLUSIVE MODE" % ACTIVE_TABLE)
+    cursor.execute("DELETE FROM %s" % ACTIVE_TABLE)
+    cursor.execute("INSERT INTO %s (version) VALUES (:version)" % ACTIVE_TABLE, {'version': version})
+    connection.commit()
+
+
+def drop_version(connection, version):
+    """
+    Remove a version of ConceptNet from the database. The active version
+    can't be dropped.
+    """
+    schema = schema_name(version)
+    if get_active_version(connection) == version:
+        raise ValueError("Version %r is active, so it can't be dropped" % version)
+    cursor = connection.cursor()
+    cursor.execute("DROP SCHEMA IF EXISTS %s CASCADE" % schema)
+    connection.commit()
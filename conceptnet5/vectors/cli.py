@@ -9,7 +9,7 @@ from .evaluation.compare import (
 )
 from .formats import (
     convert_glove, convert_word2vec, convert_fasttext, convert_polyglot,
-    load_hdf, save_hdf, export_text, save_labels_and_npy
+    load_hdf, save_hdf, export_text, save_labels_and_npy, save_mmap
 )
 from .merge import merge_intersect
 from .miniaturize import miniaturize
@@ -208,6 +208,18 @@ def run_export(input_filename, output_filename, language):
     export_text(frame, output_filename, language)
 
 
+@cli.command(name='export_mmap')
+@click.argument('input_filename', type=click.Path(readable=True, dir_okay=False))
+@click.argument('output_dir', type=click.Path(writable=True, dir_okay=True, file_okay=False))
+def run_export_mmap(input_filename, output_dir):
+    """
+    Export vectors as files that the processes of the API server can
+    memory-map and share.
+    """
+    frame = load_hdf(input_filename)
+    save_mmap(frame, output_dir)
+
+
 @cli.command(name='miniaturize')
 @click.argument('input_filename', type=click.Path(readable=True, dir_okay=False))
 @click.argument('extra_vocab_filename', type=click.Path(readable=True, dir_okay=False))
@@ -1,6 +1,8 @@
 import pandas as pd
 import numpy as np
 import gzip
+import marisa_trie
+import os
 import struct
 import pickle
 from .transforms import l1_normalize_columns, l2_normalize_rows, standardize_row_labels
@@ -35,6 +37,65 @@ def save_labels_and_npy(table, vocab_filename, matrix_filename):
     save_index_as_labels(table.index, vocab_filename)
 
 
+# The files in a directory made by `save_mmap`
+MMAP_MATRIX_FILE = 'matrix.npy'
+MMAP_SMALL_MATRIX_FILE = 'small.npy'
+MMAP_LABELS_FILE = 'labels.txt'
+MMAP_TRIE_FILE = 'labels.marisa'
+
+
+def save_mmap(frame, dirname, small_k=100):
+    """
+    Save a semantic vector space as a directory of files that can be
+    memory-mapped by `load_mmap`, so that all the processes that load it
+    share one copy of it in memory:
+
+    - matrix.npy, the matrix of vectors
+    - small.npy, the first `small_k` columns of the matrix, which
+      VectorSpaceWrapper uses to find candidates for similar terms
+    - labels.txt, the row labels, one per line
+    - labels.marisa, a marisa-trie of the labels, for finding them by prefix
+
+    The rows are sorted by their labels, which must be ConceptNet URIs.
+    VectorSpaceWrapper treats other labels as English words when it loads
+    them from an HDF5 file, and the memory-mapped files should be read the
+    same way without having to relabel them.
+    """
+    if not all(label.startswith('/c/') for label in frame.index):
+        raise ValueError(
+            "The labels of memory-mapped vectors must be ConceptNet URIs, "
+            "starting with /c/"
+        )
+    if not frame.index.is_monotonic_increasing:
+        frame = frame.sort_index()
+    os.makedirs(dirname, exist_ok=True)
+    np.save(os.path.join(dirname, MMAP_MATRIX_FILE), np.ascontiguousarray(frame.values))
+    np.save(
+        os.path.join(dirname, MMAP_SMALL_MATRIX_FILE),
+        np.ascontiguousarray(frame.values[:, :small_k])
+    )
+    save_index_as_labels(frame.index, os.path.join(dirname, MMAP_LABELS_FILE))
+    marisa_trie.Trie(list(frame.index)).save(os.path.join(dirname, MMAP_TRIE_FILE))
+
+
+def load_mmap(dirname):
+    """
+    Load a semantic vector space saved by `save_mmap`, mapping its matrices
+    into memory read-only instead of reading them.
+
+    Returns the frame of vectors, the frame of their first few columns,
+    and the trie of their labels.
+    """
+    index = load_labels_as_index(os.path.join(dirname, MMAP_LABELS_FILE))
+    matrix = np.load(os.path.join(dirname, MMAP_MATRIX_FILE), mmap_mode='r')
+    small_matrix = np.load(os.path.join(dirname, MMAP_SMALL_MATRIX_FILE), mmap_mode='r')
+    frame = pd.DataFrame(matrix, index=index, copy=False)
+    small_frame = pd.DataFrame(small_matrix, index=index, copy=False)
+    trie = marisa_trie.Trie()
+    trie.mmap(os.path.join(dirname, MMAP_TRIE_FILE))
+    return frame, small_frame, trie
+
+
 def vec_to_text_line(label, vec):
     """
     Output a labeled vector as a line in a fastText-style text format.
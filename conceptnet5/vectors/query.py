@@ -1,16 +1,18 @@
+import os
+
 import marisa_trie
 import numpy as np
 import pandas as pd
 import wordfreq
 
-from conceptnet5.db.query import AssertionFinder
+from conceptnet5.db.query import make_finder
 from conceptnet5.uri import uri_prefix, get_language, split_uri
 from conceptnet5.util import get_data_filename
 from conceptnet5.vectors import (
     similar_to_vec, weighted_average, normalize_vec, cosine_similarity,
     standardized_uri
 )
-from conceptnet5.vectors.formats import load_hdf
+from conceptnet5.vectors.formats import load_hdf, load_mmap
 from conceptnet5.vectors.transforms import l2_normalize_rows
 
 # Magnitudes smaller than this tell us that we didn't find anything meaningful
@@ -40,6 +42,17 @@ def field_match(value, query):
                 and (len(value) == len(query) or value[len(query)] == '/'))
 
 
+def default_vector_filename():
+    """
+    Get the vectors that the API uses: the memory-mapped ones if they've
+    been built, and otherwise the ones in the HDF5 file.
+    """
+    mmap_dir = get_data_filename('vectors/mini.mmap')
+    if os.path.isdir(mmap_dir):
+        return mmap_dir
+    return get_data_filename('vectors/mini.h5')
+
+
 class VectorSpaceWrapper(object):
     """
     An object that wraps the data necessary to look up vectors for terms
@@ -49,12 +62,18 @@ class VectorSpaceWrapper(object):
     look in default locations for them. They can be specified to replace them
     with toy versions for testing, or to evaluate how other embeddings perform
     while still using ConceptNet for looking up words outside their vocabulary.
+
+    `vector_filename` can also be a directory made by `cn5-vectors
+    export_mmap`, whose matrices are memory-mapped, so that all the
+    processes of a server share one copy of them. By default, the
+    'vectors/mini.mmap' directory is used if it's been built, and
+    'vectors/mini.h5' otherwise.
     """
 
     def __init__(self, vector_filename=None, frame=None, use_db=True):
         if frame is None:
             self.frame = None
-            self.vector_filename = vector_filename or get_data_filename('vectors/mini.h5')
+            self.vector_filename = vector_filename or default_vector_filename()
         else:
             self.frame = frame
             self.vector_filename = None
@@ -64,7 +83,7 @@ class VectorSpaceWrapper(object):
         self.finder = None
         self.trie = None
         if use_db:
-            self.finder = AssertionFinder()
+            self.finder = make_finder()
 
     def load(self):
         """
@@ -73,6 +92,14 @@ class VectorSpaceWrapper(object):
         if self.small_frame is not None:
             return
         try:
+            if self.frame is None and os.path.isdir(self.vector_filename):
+                frame, small_frame, self._trie = load_mmap(self.vector_filename)
+                self.k = frame.shape[1]
+                self.small_k = small_frame.shape[1]
+                self.frame = frame
+                # Setting small_frame marks the space as loaded
+                self.small_frame = small_frame
+                return
             if self.frame is None:
                 self.frame = load_hdf(self.vector_filename)
 
@@ -114,7 +141,8 @@ class VectorSpaceWrapper(object):
         else:
             return field_match(label, filter)
 
-    def expand_terms(self, terms, limit_per_term=10, include_neighbors=True):
+    def expand_terms(self, terms, limit_per_term=10, include_neighbors=True,
+                     neighbor_edges=None):
         """
         Given a list of weighted terms as (term, weight) tuples, add terms that
         are one step away in ConceptNet at a lower weight, terms in English that share the
@@ -126,12 +154,23 @@ class VectorSpaceWrapper(object):
         vector by looking up their neighbors, etc.
 
         This forms a reasonable approximation of the vector an infrequent term would have anyway.
+
+        `neighbor_edges` can be a dictionary from the OOV terms to their
+        edges, if they've already been looked up.
         """
         self.load()
         expanded = terms[:]
+        oov_terms = [term for term, weight in terms if term not in self.frame.index]
+        if neighbor_edges is None:
+            neighbor_edges = {}
+        missing = [term for term in oov_terms if term not in neighbor_edges]
+        if include_neighbors and missing and self.finder is not None:
+            # Look up the neighbors of all the OOV terms in one query
+            neighbor_edges = dict(neighbor_edges)
+            neighbor_edges.update(self.finder.lookup_many(missing, limit_per_uri=limit_per_term))
         for term, weight in terms:
             if include_neighbors and term not in self.frame.index and self.finder is not None:
-                for edge in self.finder.lookup(term, limit=limit_per_term):
+                for edge in neighbor_edges[term]:
                     if field_match(edge['start']['term'], term) and not field_match(
                             edge['end']['term'], term):
                         neighbor = edge['end']['term']
@@ -169,7 +208,8 @@ class VectorSpaceWrapper(object):
         else:
             return [(uri_prefix(term), weight / total_weight) for (term, weight) in expanded]
 
-    def expanded_vector(self, terms, limit_per_term=10, include_neighbors=True):
+    def expanded_vector(self, terms, limit_per_term=10, include_neighbors=True,
+                        neighbor_edges=None):
         """
         Given a list of weighted terms as (term, weight) tuples, make a vector
         representing information from:
@@ -182,7 +222,7 @@ class VectorSpaceWrapper(object):
         self.load()
         return weighted_average(
             self.frame,
-            self.expand_terms(terms, limit_per_term, include_neighbors)
+            self.expand_terms(terms, limit_per_term, include_neighbors, neighbor_edges)
         )
 
     def text_to_vector(self, language, text):
@@ -191,17 +231,14 @@ class VectorSpaceWrapper(object):
         weighted_terms = [(uri_prefix(standardized_uri(language, token)), 1.) for token in tokens]
         return self.get_vector(weighted_terms, include_neighbors=False)
 
-    def get_vector(self, query, include_neighbors=True):
+    @staticmethod
+    def query_terms(query):
         """
-        Given one of the possible types of queries (see `similar_terms`), make
-        a vector to look up from it.
-
-        If there are 5 or fewer terms involved and `include_neighbors=True`, this
-        will allow expanded_vector to look up neighboring terms in ConceptNet.
+        Get the (term, weight) pairs of one of the possible types of queries
+        (see `similar_terms`), or None if the query is already a vector.
         """
-        self.load()
         if isinstance(query, np.ndarray):
-            return query
+            return None
         elif isinstance(query, pd.Series) or isinstance(query, dict):
             terms = list(query.items())
         elif isinstance(query, pd.DataFrame):
@@ -212,8 +249,24 @@ class VectorSpaceWrapper(object):
             terms = query
         else:
             raise ValueError("Can't make a query out of type %s" % type(query))
+        return terms
+
+    def get_vector(self, query, include_neighbors=True, neighbor_edges=None):
+        """
+        Given one of the possible types of queries (see `similar_terms`), make
+        a vector to look up from it.
+
+        If there are 5 or fewer terms involved and `include_neighbors=True`, this
+        will allow expanded_vector to look up neighboring terms in ConceptNet.
+        """
+        self.load()
+        terms = self.query_terms(query)
+        if terms is None:
+            return query
         include_neighbors = include_neighbors and (len(terms) <= 5)
-        vec = self.expanded_vector(terms, include_neighbors=include_neighbors)
+        vec = self.expanded_vector(
+            terms, include_neighbors=include_neighbors, neighbor_edges=neighbor_edges
+        )
         return normalize_vec(vec)
 
     def similar_terms(self, query, filter=None, limit=20):
@@ -250,10 +303,65 @@ class VectorSpaceWrapper(object):
                 start_idx, end_idx = self.index_prefix_range(filter + '/')
                 search_frame = search_frame.iloc[start_idx:end_idx]
         similar_sloppy = similar_to_vec(search_frame, small_vec, limit=limit * 50)
-        similar_choices = l2_normalize_rows(self.frame.loc[similar_sloppy.index].astype('f'))
+        return self._rerank(similar_sloppy.index, vec, limit)
 
-        similar = similar_to_vec(similar_choices, vec, limit=limit)
-        return similar
+    def _rerank(self, candidates, vec, limit):
+        """
+        Rank a list of candidate terms, found by comparing the first
+        `small_k` dimensions of their vectors, by their similarity to the
+        full vector `vec`.
+        """
+        similar_choices = l2_normalize_rows(self.frame.loc[candidates].astype('f'))
+        return similar_to_vec(similar_choices, vec, limit=limit)
+
+    def similar_terms_many(self, queries):
+        """
+        Run many `similar_terms` queries at once, with less overhead than
+        running them one at a time. `queries` is a list of (query, filter,
+        limit) triples, and the result is a list of Series, one per query.
+
+        The ConceptNet neighbors of all the out-of-vocabulary terms are
+        looked up in one database query, and the unfiltered queries are
+        compared to the whole vector space in one matrix product.
+        """
+        self.load()
+        # Look up the neighbors that the queries will be expanded with
+        oov_terms = set()
+        for query, _filter, _limit in queries:
+            terms = self.query_terms(query)
+            if terms is not None and len(terms) <= 5:
+                oov_terms.update(term for term, weight in terms if term not in self.frame.index)
+        neighbor_edges = {}
+        if oov_terms and self.finder is not None:
+            neighbor_edges = self.finder.lookup_many(sorted(oov_terms), limit_per_uri=10)
+
+        results = [None] * len(queries)
+        unfiltered = []
+        for i, (query, filter, limit) in enumerate(queries):
+            if filter:
+                # Filtered queries search a small part of the space anyway
+                vec = self.get_vector(query, neighbor_edges=neighbor_edges)
+                results[i] = self.similar_terms(vec, filter=filter, limit=limit)
+            else:
+                unfiltered.append((i, self.get_vector(query, neighbor_edges=neighbor_edges), limit))
+        if not unfiltered:
+            return results
+
+        small_vecs = np.vstack([
+            vec[:self.small_k] for (i, vec, limit) in unfiltered
+        ])
+        similarity = self.small_frame.values.dot(small_vecs.T)
+        similarity[np.isnan(similarity)] = -np.inf
+        for column, (i, vec, limit) in enumerate(unfiltered):
+            if vec.dot(vec) == 0.:
+                results[i] = pd.Series(data=[], index=[], dtype='f')
+                continue
+            n_candidates = min(limit * 50, len(similarity))
+            scores = similarity[:, column]
+            top = np.argpartition(-scores, n_candidates - 1)[:n_candidates]
+            top = top[np.argsort(-scores[top], kind='mergesort')]
+            results[i] = self._rerank(self.small_frame.index[top], vec, limit)
+        return results
 
     def get_similarity(self, query1, query2):
         vec1 = self.get_vector(query1)
@@ -1,3 +1,10 @@
+DROP MATERIALIZED VIEW IF EXISTS ranked_features;
+DROP MATERIALIZED VIEW IF EXISTS feature_summary;
+DROP MATERIALIZED VIEW IF EXISTS node_edges;
+DROP MATERIALIZED VIEW IF EXISTS edge_order;
+DROP MATERIALIZED VIEW IF EXISTS edge_samples;
+DROP MATERIALIZED VIEW IF EXISTS term_search;
+DROP TABLE IF EXISTS edges_ld;
 DROP TABLE IF EXISTS edge_features;
 DROP TABLE IF EXISTS edge_sources;
 DROP TABLE IF EXISTS node_prefixes;
@@ -5,41 +12,47 @@ DROP TABLE IF EXISTS edges;
 DROP TABLE IF EXISTS nodes;
 DROP TABLE IF EXISTS sources;
 DROP TABLE IF EXISTS relations;
-CREATE TABLE nodes (
-    id     integer NOT NULL PRIMARY KEY,
+CREATE UNLOGGED TABLE nodes (
+    id     integer NOT NULL,
     uri    text NOT NULL
 );
-CREATE TABLE sources (
-    id     integer NOT NULL PRIMARY KEY,
+CREATE UNLOGGED TABLE sources (
+    id     integer NOT NULL,
     uri    text NOT NULL
 );
-CREATE TABLE relations (
-    id        integer NOT NULL PRIMARY KEY,
+CREATE UNLOGGED TABLE relations (
+    id        integer NOT NULL,
     uri       text NOT NULL,
     directed  bool NOT NULL
 );
-CREATE TABLE edges (
-    id             integer NOT NULL PRIMARY KEY,
+CREATE UNLOGGED TABLE edges (
+    id             integer NOT NULL,
     uri            text NOT NULL,
-    relation_id    integer NOT NULL REFERENCES relations (id),
-    start_id       integer NOT NULL REFERENCES nodes (id),
-    end_id         integer NOT NULL REFERENCES nodes (id),
+    relation_id    integer NOT NULL,
+    start_id       integer NOT NULL,
+    end_id         integer NOT NULL,
     weight         real NOT NULL,
     data           jsonb NOT NULL
 );
-CREATE TABLE edge_sources (
-    edge_id        integer NOT NULL REFERENCES edges (id),
-    source_id      integer NOT NULL REFERENCES sources (id)
+-- The precomputed data doesn't include edges_ld, so it's left empty, and
+-- the API transforms the edges itself even with CONCEPTNET_DB_PRECOMPUTED_LD
+CREATE TABLE edges_ld (
+    id             integer NOT NULL,
+    data           text NOT NULL
 );
-CREATE TABLE node_prefixes (
-    node_id        integer NOT NULL REFERENCES nodes (id),
-    prefix_id      integer NOT NULL REFERENCES nodes (id)
+CREATE UNLOGGED TABLE edge_sources (
+    edge_id        integer NOT NULL,
+    source_id      integer NOT NULL
 );
-CREATE TABLE edge_features (
-    rel_id    integer NOT NULL REFERENCES relations (id),
+CREATE UNLOGGED TABLE node_prefixes (
+    node_id        integer NOT NULL,
+    prefix_id      integer NOT NULL
+);
+CREATE UNLOGGED TABLE edge_features (
+    rel_id    integer NOT NULL,
     direction integer NOT NULL,
-    node_id   integer NOT NULL REFERENCES nodes (id),
-    edge_id   integer NOT NULL REFERENCES edges (id)
+    node_id   integer NOT NULL,
+    edge_id   integer NOT NULL
 );
 COPY relations FROM '/data/conceptnet/psql/relations.csv';
 COPY nodes FROM '/data/conceptnet/psql/nodes.csv';
@@ -48,10 +61,18 @@ COPY sources FROM '/data/conceptnet/psql/sources.csv';
 COPY edge_sources FROM '/data/conceptnet/psql/edge_sources.csv';
 COPY node_prefixes FROM '/data/conceptnet/psql/node_prefixes.csv';
 COPY edge_features FROM '/data/conceptnet/psql/edge_features.csv';
-ALTER TABLE nodes ADD CONSTRAINT nodes_unique_uri UNIQUE (uri);
-ALTER TABLE sources ADD CONSTRAINT sources_unique_uri UNIQUE (uri);
-ALTER TABLE edges ADD CONSTRAINT edges_unique_uri UNIQUE (uri);
-ALTER TABLE relations ADD CONSTRAINT relations_unique_uri UNIQUE (uri);
+ALTER TABLE relations SET LOGGED;
+ALTER TABLE nodes SET LOGGED;
+ALTER TABLE sources SET LOGGED;
+ALTER TABLE edges SET LOGGED;
+ALTER TABLE edge_sources SET LOGGED;
+ALTER TABLE node_prefixes SET LOGGED;
+ALTER TABLE edge_features SET LOGGED;
+SET maintenance_work_mem = '256MB';
+ALTER TABLE nodes ADD PRIMARY KEY (id), ADD CONSTRAINT nodes_unique_uri UNIQUE (uri);
+ALTER TABLE sources ADD PRIMARY KEY (id), ADD CONSTRAINT sources_unique_uri UNIQUE (uri);
+ALTER TABLE edges ADD PRIMARY KEY (id), ADD CONSTRAINT edges_unique_uri UNIQUE (uri);
+ALTER TABLE relations ADD PRIMARY KEY (id), ADD CONSTRAINT relations_unique_uri UNIQUE (uri);
 ALTER TABLE edge_sources ADD CONSTRAINT edge_sources_unique UNIQUE (edge_id, source_id);
 ALTER TABLE node_prefixes ADD CONSTRAINT node_prefixes_unique UNIQUE (node_id, prefix_id);
 CREATE INDEX edge_relation ON edges (relation_id);
@@ -63,13 +84,88 @@ CREATE INDEX es_source ON edge_sources (source_id);
 CREATE INDEX np_prefix ON node_prefixes (prefix_id);
 CREATE INDEX ef_feature ON edge_features (rel_id, direction, node_id);
 CREATE INDEX ef_node ON edge_features (node_id);
-CREATE MATERIALIZED VIEW ranked_features AS (
-    SELECT ef.rel_id, ef.direction, ef.node_id, ef.edge_id, e.weight,
-       row_number() OVER (
-           PARTITION BY (ef.node_id, ef.rel_id, ef.direction)
-           ORDER BY e.weight DESC, e.id
-       ) AS rank
-    FROM edge_features ef, edges e WHERE e.id=ef.edge_id
+ALTER TABLE edges
+    ADD FOREIGN KEY (relation_id) REFERENCES relations (id),
+    ADD FOREIGN KEY (start_id) REFERENCES nodes (id),
+    ADD FOREIGN KEY (end_id) REFERENCES nodes (id);
+ALTER TABLE edge_sources
+    ADD FOREIGN KEY (edge_id) REFERENCES edges (id),
+    ADD FOREIGN KEY (source_id) REFERENCES sources (id);
+ALTER TABLE node_prefixes
+    ADD FOREIGN KEY (node_id) REFERENCES nodes (id),
+    ADD FOREIGN KEY (prefix_id) REFERENCES nodes (id);
+ALTER TABLE edge_features
+    ADD FOREIGN KEY (rel_id) REFERENCES relations (id),
+    ADD FOREIGN KEY (node_id) REFERENCES nodes (id),
+    ADD FOREIGN KEY (edge_id) REFERENCES edges (id);
+CREATE MATERIALIZED VIEW feature_summary AS (
+    SELECT f.prefix_id, f.rel_id, f.direction, f.edge_id, f.rank, f.edge_count
+    FROM (
+        SELECT pf.prefix_id, pf.rel_id, pf.direction, pf.edge_id,
+               row_number() OVER (
+                   PARTITION BY pf.prefix_id, pf.rel_id, pf.direction
+                   ORDER BY e.weight DESC, e.uri
+               ) AS rank,
+               count(*) OVER (
+                   PARTITION BY pf.prefix_id, pf.rel_id, pf.direction
+               ) AS edge_count
+        FROM (
+            SELECT DISTINCT p.prefix_id, ef.rel_id, ef.direction, ef.edge_id
+            FROM nodes n, node_prefixes p, edge_features ef
+            WHERE n.uri LIKE '/c/%/%' AND p.prefix_id=n.id AND ef.node_id=p.node_id
+        ) pf, edges e WHERE e.id=pf.edge_id
+    ) f
+    WHERE f.rank <= 100
+) WITH DATA;
+CREATE INDEX fs_prefix ON feature_summary (prefix_id, rank);
+CREATE MATERIALIZED VIEW edge_order AS (
+    SELECT id AS edge_id, CAST(row_number() OVER (ORDER BY uri) AS integer) AS uri_rank
+    FROM edges
+) WITH DATA;
+CREATE UNIQUE INDEX edge_order_edge ON edge_order (edge_id);
+CREATE MATERIALIZED VIEW node_edges AS (
+    SELECT pe.prefix_id, e.id AS edge_id, e.relation_id, e.weight, o.uri_rank,
+           pe.is_start, pe.is_end
+    FROM (
+        SELECT prefix_id, edge_id, bool_or(is_start) AS is_start, bool_or(is_end) AS is_end
+        FROM (
+            SELECT p.prefix_id, e.id AS edge_id, true AS is_start, false AS is_end
+            FROM node_prefixes p, edges e WHERE p.node_id=e.start_id
+            UNION ALL
+            SELECT p.prefix_id, e.id AS edge_id, false AS is_start, true AS is_end
+            FROM node_prefixes p, edges e WHERE p.node_id=e.end_id
+        ) pe_all
+        GROUP BY prefix_id, edge_id
+    ) pe, edges e, edge_order o WHERE e.id=pe.edge_id AND o.edge_id=pe.edge_id
+) WITH DATA;
+CREATE INDEX ne_prefix ON node_edges (prefix_id, weight DESC, uri_rank);
+CREATE INDEX ne_prefix_rel ON node_edges (prefix_id, relation_id, weight DESC, uri_rank);
+CREATE MATERIALIZED VIEW edge_samples AS (
+    SELECT e.id AS edge_id, COALESCE(dn.uri, e.data->>'dataset') AS dataset, e.uri,
+           random() AS sample_key
+    FROM edges e LEFT JOIN nodes dn ON dn.id = (
+        CASE WHEN jsonb_typeof(e.data->'dataset') = 'number'
+        THEN CAST(e.data->>'dataset' AS integer) END
+    )
+) WITH DATA;
+CREATE INDEX edge_samples_key ON edge_samples (sample_key);
+CREATE INDEX edge_samples_dataset ON edge_samples (dataset, sample_key);
+CREATE EXTENSION IF NOT EXISTS pg_trgm WITH SCHEMA public;
+CREATE MATERIALIZED VIEW term_search AS (
+    SELECT n.uri, split_part(n.uri, '/', 3) AS language,
+           split_part(n.uri, '/', 4) AS text, te.edge_count
+    FROM (
+        SELECT prefix_id, count(DISTINCT edge_id) AS edge_count
+        FROM (
+            SELECT p.prefix_id, e.id AS edge_id
+            FROM node_prefixes p, edges e WHERE p.node_id=e.start_id
+            UNION ALL
+            SELECT p.prefix_id, e.id AS edge_id
+            FROM node_prefixes p, edges e WHERE p.node_id=e.end_id
+        ) pe
+        GROUP BY prefix_id
+    ) te, nodes n
+    WHERE n.id=te.prefix_id AND n.uri ~ '^/c/[^/]+/[^/]+$'
 ) WITH DATA;
-CREATE INDEX rf_node ON ranked_features (node_id);
-
+CREATE INDEX term_search_prefix ON term_search (language, text text_pattern_ops);
+CREATE INDEX term_search_trgm ON term_search USING gin (text public.gin_trgm_ops);
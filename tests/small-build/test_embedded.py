@@ -0,0 +1,58 @@
+from nose.tools import eq_, ok_
+import os
+import shutil
+import tempfile
+from conceptnet5.db.embedded import build_embedded, EmbeddedAssertionFinder
+from conceptnet5.db.query import AssertionFinder
+
+DATA = os.environ.get("CONCEPTNET_BUILD_DATA", "testdata")
+
+test_dir = None
+embedded_finder = None
+db_finder = None
+
+
+def setUp():
+    global test_dir, embedded_finder, db_finder
+    test_dir = tempfile.mkdtemp()
+    build_embedded(DATA + '/assertions/assertions.msgpack', test_dir)
+    embedded_finder = EmbeddedAssertionFinder(test_dir)
+    db_finder = AssertionFinder('conceptnet-test', cache=False)
+
+
+def tearDown():
+    embedded_finder.store.close()
+    shutil.rmtree(test_dir)
+
+
+def test_same_lookups():
+    for uri in ['/c/en/quiz', '/c/en/test', '/c/en', '/r/RelatedTo', '/s/resource/verbosity',
+                '/a/[/r/RelatedTo/,/c/en/test/,/c/en/quiz/]', '/c/en/not_a_node']:
+        eq_(embedded_finder.lookup(uri, limit=50), db_finder.lookup(uri, limit=50))
+
+
+def test_same_queries():
+    for criteria in [{'start': '/c/en/test'}, {'node': '/c/en/test', 'other': '/c/en/quiz'},
+                     {'node': '/c/en/test', 'rel': '/r/RelatedTo'}]:
+        eq_(embedded_finder.query(criteria), db_finder.query(criteria))
+
+
+def test_paging():
+    edges = embedded_finder.lookup('/c/en/test', limit=10)
+    first = edges[0]
+    eq_(embedded_finder.lookup('/c/en/test', limit=9, after=(first['weight'], first['@id'])),
+        edges[1:])
+    eq_(embedded_finder.lookup('/c/en/test', limit=9, offset=1), edges[1:])
+    raw = embedded_finder.lookup('/c/en/test', limit=10, raw=True)
+    eq_([edge.uri for edge in raw], [edge['@id'] for edge in edges])
+
+
+def test_feature_summary():
+    eq_(embedded_finder.lookup_feature_summary('/c/en/test'),
+        db_finder.lookup_feature_summary('/c/en/test'))
+
+
+def test_samples():
+    ok_(len(embedded_finder.random_edges(limit=5)) == 5)
+    sample = embedded_finder.sample_dataset('/d/verbosity', limit=5)
+    eq_(sample, embedded_finder.sample_dataset('/d/verbosity', limit=5))
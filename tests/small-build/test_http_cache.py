@@ -0,0 +1,42 @@
+from nose.tools import ok_, eq_
+from conceptnet5.db import versions
+from conceptnet5.db.connection import get_db_connection
+from conceptnet5.db.query import AssertionFinder
+from conceptnet_web import http_cache
+
+TEST_VERSION = 'etag_test'
+
+
+def etag_now():
+    # Don't wait for BUILD_CHECK_INTERVAL to see a new version
+    http_cache._build['checked'] = None
+    return http_cache.make_etag('/c/en/test', [], 'json+identity')
+
+
+def test_etag_follows_active_version():
+    conn = get_db_connection('conceptnet-test')
+    previous = versions.get_active_version(conn)
+    conn.rollback()
+    original_finder = http_cache.FINDER
+    http_cache.FINDER = AssertionFinder('conceptnet-test', cache=False)
+    try:
+        before = etag_now()
+        eq_(etag_now(), before)
+
+        # An empty version is enough, because it only has to be activated
+        cursor = conn.cursor()
+        cursor.execute("CREATE SCHEMA %s" % versions.schema_name(TEST_VERSION))
+        conn.commit()
+        versions.mark_version_loaded(conn, TEST_VERSION)
+        versions.activate_version(conn, TEST_VERSION)
+        ok_(etag_now() != before)
+    finally:
+        http_cache.FINDER = original_finder
+        cursor = conn.cursor()
+        if previous is None:
+            cursor.execute("DELETE FROM %s" % versions.ACTIVE_TABLE)
+            conn.commit()
+        else:
+            versions.activate_version(conn, previous)
+        versions.drop_version(conn, TEST_VERSION)
+        http_cache._build['checked'] = None
@@ -1,5 +1,8 @@
-from nose.tools import eq_
+from nose.tools import eq_, ok_
+import json
+from urllib.parse import parse_qsl, urlsplit
 from conceptnet5.db.query import AssertionFinder
+from conceptnet_web.responses import lookup_response, query_response
 
 test_finder = None
 
@@ -19,6 +22,10 @@ def test_lookup():
     quiz3 = list(test_finder.lookup('/c/en/quiz', limit=1))
     eq_(quiz3, quiz1[:1])
 
+    first = quiz1[0]
+    quiz4 = list(test_finder.lookup('/c/en/quiz', after=(first['weight'], first['@id'])))
+    eq_(quiz4, quiz1[1:])
+
     verbosity_test = quiz1[0]
     eq_(verbosity_test['start']['@id'], '/c/en/test')
     eq_(verbosity_test['end']['@id'], '/c/en/quiz')
@@ -31,6 +38,99 @@ def test_lookup():
     eq_(source['@id'], '/and/[/s/process/split_words/,/s/resource/verbosity/]')
 
 
+def test_lookup_relation():
+    # Each edge matches several prefixes of its nodes, which mustn't crowd
+    # other edges out of the page
+    edges = test_finder.lookup('/r/RelatedTo', limit=40)
+    eq_(len(edges), 40)
+    eq_(len({edge['@id'] for edge in edges}), 40)
+    eq_(test_finder.lookup('/r/RelatedTo', limit=20, offset=20), edges[20:])
+    last = edges[19]
+    eq_(test_finder.lookup('/r/RelatedTo', limit=20, after=(last['weight'], last['@id'])),
+        edges[20:])
+
+
+def test_lookup_many():
+    found = test_finder.lookup_many(['/c/en/quiz', '/c/en/test', '/c/en/not_a_node'], limit_per_uri=1)
+    eq_(found['/c/en/quiz'], test_finder.lookup('/c/en/quiz', limit=1))
+    eq_(found['/c/en/test'], test_finder.lookup('/c/en/test', limit=1))
+    eq_(found['/c/en/not_a_node'], [])
+
+
+def test_precomputed_ld():
+    ld_finder = AssertionFinder('conceptnet-test', precomputed_ld=True)
+    eq_(ld_finder.lookup('/c/en/quiz'), test_finder.lookup('/c/en/quiz'))
+    eq_(
+        ld_finder.lookup_grouped_by_feature('/c/en/test'),
+        test_finder.lookup_grouped_by_feature('/c/en/test')
+    )
+
+
+def test_feature_summary():
+    summary = test_finder.lookup_feature_summary('/c/en/test', limit=1)
+    grouped = test_finder.lookup_grouped_by_feature('/c/en/test', limit=1)
+    eq_(set(summary), set(grouped))
+    for feature, (count, edges) in summary.items():
+        eq_(edges, grouped[feature])
+        eq_(len(edges), 1)
+        ok_(count >= 1)
+    full = test_finder.lookup_feature_summary('/c/en/test', limit=100)
+    for feature, (count, edges) in full.items():
+        eq_(count, len(edges))
+
+
+def test_raw_edges():
+    quiz = test_finder.lookup('/c/en/quiz')
+    ld_finder = AssertionFinder('conceptnet-test', precomputed_ld=True)
+    for finder in (test_finder, ld_finder):
+        raw = finder.lookup('/c/en/quiz', raw=True)
+        eq_([json.loads(edge) for edge in raw], quiz)
+        eq_([edge.uri for edge in raw], [e['@id'] for e in quiz])
+
+
+def test_random_edges():
+    found = test_finder.random_edges(limit=3)
+    eq_(len(found), 3)
+    eq_(len({edge['@id'] for edge in found}), 3)
+
+
+def test_sample_dataset():
+    sample = test_finder.sample_dataset('/d/verbosity', limit=2)
+    ok_(sample)
+    for edge in sample:
+        eq_(edge['dataset'], '/d/verbosity')
+    eq_(test_finder.sample_dataset('/d/verbosity', limit=1, offset=1), sample[1:2])
+    eq_(test_finder.lookup('/d/verbosity', limit=2), sample)
+
+
+def test_dataset_pages():
+    sample = test_finder.sample_dataset('/d/verbosity', limit=2)
+    found = test_finder.lookup('/d/verbosity', limit=2)
+    first = lookup_response('/d/verbosity', found, 1, 0, None, keyset=True)
+    eq_(first['edges'], sample[:1])
+
+    # Datasets are paged by offset, because their order isn't by weight
+    params = dict(parse_qsl(urlsplit(first['view']['nextPage']).query))
+    ok_('after' not in params)
+    offset = int(params['offset'])
+    found = test_finder.lookup('/d/verbosity', limit=2, offset=offset)
+    second = lookup_response('/d/verbosity', found, 1, offset, None, keyset=True)
+    eq_(second['edges'], sample[1:2])
+
+
+def test_zero_limit():
+    found = test_finder.lookup('/c/en/quiz', limit=1)
+    response = lookup_response('/c/en/quiz', found, 0, 0, None, keyset=True)
+    eq_(response['edges'], [])
+    ok_('continuationToken' not in response['view'])
+
+    query = {'node': '/c/en/quiz'}
+    found = test_finder.query(query, limit=1)
+    response = query_response(query, found, 0, 0, None, keyset=True)
+    eq_(response['edges'], [])
+    ok_('continuationToken' not in response['view'])
+
+
 def get_query_ids(query):
     return [match['@id'] for match in test_finder.query(query)]
 
@@ -51,6 +151,14 @@ def test_query_en_quiz():
     eq_(q4, testquiz)
 
 
+def test_query_after():
+    query = {'start': '/c/en/test', 'end': '/c/en/quiz'}
+    first_page = test_finder.query(query, limit=1)
+    last = first_page[0]
+    second_page = test_finder.query(query, after=(last['weight'], last['@id']))
+    eq_([match['@id'] for match in second_page], ['/a/[/r/Synonym/,/c/en/test/n/,/c/en/quiz/]'])
+
+
 def test_query_en_form():
     q = get_query_ids({'rel': '/r/FormOf', 'end': '/c/en/test'})
     eq_(q, ['/a/[/r/FormOf/,/c/en/tests/,/c/en/test/n/]'])
@@ -1,12 +1,14 @@
 import os
+import tempfile
 
 import click
 import numpy as np
 import pandas as pd
-from nose.tools import ok_, eq_, assert_almost_equal
+from nose.tools import ok_, eq_, assert_almost_equal, assert_raises
 
 from conceptnet5.vectors import get_vector
 from conceptnet5.vectors.evaluation.compare import load_any_embeddings
+from conceptnet5.vectors.formats import save_mmap
 from conceptnet5.vectors.query import VectorSpaceWrapper
 from conceptnet5.vectors.transforms import standardize_row_labels, l1_normalize_columns, \
     l2_normalize_rows, shrink_and_sort
@@ -55,6 +57,44 @@ def test_vector_space_wrapper(frame=None):
     ok_(wrap.frame.index.is_monotonic_increasing)
 
 
+def test_similar_terms_many():
+    """
+    Check that running similar_terms queries together gets the same results
+    as running them one at a time.
+    """
+    wrap = VectorSpaceWrapper(vector_filename=DATA + '/vectors/glove12-840B.h5', use_db=False)
+    queries = [
+        ('/c/en/cat', None, 5),
+        ('/c/en/dog', '/c/en', 5),
+        ([('/c/en/cat', 1.), ('/c/en/dog', 0.5)], None, 3),
+    ]
+    for (query, filter, limit), found in zip(queries, wrap.similar_terms_many(queries)):
+        eq_(list(found.index), list(wrap.similar_terms(query, filter=filter, limit=limit).index))
+
+
+def test_mmap_vectors():
+    """
+    Check that vectors exported with save_mmap give the same results as the
+    vectors they came from.
+    """
+    vector_filename = DATA + '/vectors/glove12-840B.h5'
+    wrap = VectorSpaceWrapper(vector_filename=vector_filename, use_db=False)
+    with tempfile.TemporaryDirectory() as mmap_dir:
+        wrap.load()
+        save_mmap(wrap.frame, mmap_dir)
+        mmap_wrap = VectorSpaceWrapper(vector_filename=mmap_dir, use_db=False)
+        mmap_wrap.load()
+        ok_(mmap_wrap.frame.index.equals(wrap.frame.index))
+        eq_(sorted(mmap_wrap.terms_with_prefix('/c/en/ca')), sorted(wrap.terms_with_prefix('/c/en/ca')))
+        eq_(list(mmap_wrap.similar_terms('/c/en/cat', limit=5).index),
+            list(wrap.similar_terms('/c/en/cat', limit=5).index))
+
+        # Labels that aren't ConceptNet URIs would be read differently
+        # from the memory-mapped files than from an HDF5 file
+        frame = pd.DataFrame(np.ones((2, 3)), index=['cat', 'dog'])
+        assert_raises(ValueError, save_mmap, frame, mmap_dir)
+
+
 def test_standardize_row_labels(frame=None):
     if not frame:
         frame = DATA + '/raw/vectors/glove12.840B.300d.txt.gz'
@@ -0,0 +1,39 @@
+from nose.tools import eq_
+from conceptnet5.db.compact import compact_edge, is_compact, CompactEdgeDecoder
+from ordered_set import OrderedSet
+
+ASSERTION = {
+    'uri': '/a/[/r/AtLocation/,/c/en/wheat/,/c/en/field/]',
+    'rel': '/r/AtLocation',
+    'start': '/c/en/wheat',
+    'end': '/c/en/field',
+    'dataset': '/d/conceptnet/4/en',
+    'license': 'cc:by/4.0',
+    'sources': [
+        {'activity': '/s/activity/omcs/vote', 'contributor': '/s/contributor/omcs/user2'}
+    ],
+    'surfaceStart': 'wheat',
+    'surfaceEnd': 'a field',
+    'surfaceText': 'You are likely to find [[wheat]] in [[a field]]',
+    'weight': 2.0
+}
+
+
+def test_compact_round_trip():
+    nodes = OrderedSet(['/c/en/wheat', '/c/en/field', '/d/conceptnet/4/en'])
+    sources = OrderedSet()
+    compact = compact_edge(ASSERTION, 0, 0, 1, 2, sources.add)
+    eq_(is_compact(compact), True)
+    eq_(is_compact(ASSERTION), False)
+    eq_('uri' in compact, False)
+
+    def fetchall(query, params=None):
+        if 'relations' in query:
+            return [(0, '/r/AtLocation')]
+        elif 'sources' in query:
+            return list(enumerate(sources))
+        else:
+            return [(node_id, nodes[node_id]) for node_id in params['ids']]
+
+    decoder = CompactEdgeDecoder(fetchall)
+    eq_(decoder.decode_many([compact]), [ASSERTION])
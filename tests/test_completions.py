@@ -0,0 +1,22 @@
+from nose.tools import eq_
+from conceptnet5.db.completions import completion_prefix, top_completions
+
+
+def test_completion_prefix():
+    eq_(completion_prefix('en', 'Ice Cr'), '/c/en/ice_cr')
+    eq_(completion_prefix('en', 'ice '), '/c/en/ice_')
+    eq_(completion_prefix('en', '  '), '/c/en/')
+
+
+def test_top_completions():
+    uris = sorted(['/c/en/ice', '/c/en/ice_cream', '/c/en/iced', '/c/en/icy', '/c/fr/glace'])
+    counts = {
+        '/c/en/ice': 5, '/c/en/ice_cream': 7, '/c/en/iced': 1, '/c/en/icy': 5, '/c/fr/glace': 3
+    }
+    top = top_completions(uris, [counts[uri] for uri in uris], limit=2, scan_limit=2)
+    eq_(top['/c/'], [['/c/en/ice_cream', 7], ['/c/en/ice', 5]])
+    eq_(top['/c/en/ic'], [['/c/en/ice_cream', 7], ['/c/en/ice', 5]])
+    eq_(top['/c/en/ice'], [['/c/en/ice_cream', 7], ['/c/en/ice', 5]])
+    # Prefixes with only two completions are left to be scanned
+    assert '/c/fr/' not in top
+    assert '/c/en/ice_' not in top
@@ -0,0 +1,111 @@
+from nose.tools import eq_, assert_raises
+import pg8000
+import socket
+from conceptnet5.db.connection import (
+    ConnectionPool, PooledConnection, is_disconnect, is_socket_timeout
+)
+from conceptnet5.db.hosts import CircuitBreaker, DatabaseHost, HostRouter, QueryTimeout
+
+
+def test_circuit_breaker():
+    breaker = CircuitBreaker(failure_threshold=2, retry_seconds=0.01)
+    eq_(breaker.state, 'closed')
+    breaker.record_failure()
+    eq_(breaker.allow(), True)
+    breaker.record_failure()
+    eq_(breaker.state, 'open')
+    eq_(breaker.allow(), False)
+
+    breaker.opened_at -= 1
+    eq_(breaker.state, 'half-open')
+    # Only one caller gets to try the server again
+    eq_(breaker.allow(), True)
+    eq_(breaker.allow(), False)
+    breaker.record_success()
+    eq_(breaker.state, 'closed')
+
+
+def test_routing():
+    hosts = [DatabaseHost('db%d' % i, 5432) for i in range(3)]
+    primary = DatabaseHost('primary', 5432)
+    router = HostRouter(hosts, fallback=primary, routing='round_robin')
+    eq_(router.hosts_to_try(), hosts + [primary])
+    eq_(router.hosts_to_try(), hosts[1:] + hosts[:1] + [primary])
+
+    hosts[2].record_latency(0.001)
+    hosts[0].record_latency(0.5)
+    hosts[1].record_latency(0.1)
+    hosts[1].breaker.failures = hosts[1].breaker.failure_threshold - 1
+    hosts[1].breaker.record_failure()
+    router = HostRouter(hosts, fallback=primary, routing='least_latency')
+    eq_(router.hosts_to_try(), [hosts[2], hosts[0], primary])
+
+
+class StandInConnection(object):
+    def __init__(self, error=None):
+        self.error = error
+        self.closed = False
+
+    def cursor(self):
+        return StandInCursor(self.error)
+
+    def rollback(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+
+class StandInCursor(object):
+    def __init__(self, error):
+        self.error = error
+
+    def execute(self, query, params=None):
+        if self.error is not None:
+            raise self.error
+
+    def fetchall(self):
+        return []
+
+    def close(self):
+        pass
+
+
+def test_checkin_resolves_trial():
+    host = DatabaseHost('db', 5432)
+    host.breaker.failure_threshold = 1
+    pool = ConnectionPool('conceptnet-test', size=1, host=host)
+    for failed, state in [(False, 'closed'), (True, 'open')]:
+        host.breaker.record_failure()
+        host.breaker.opened_at -= host.breaker.retry_seconds
+        eq_(host.breaker.allow(), True)
+        # A caller using checkout and checkin directly, instead of
+        # `connection`, still reports how its trial went
+        pool._slots.acquire()
+        pool.checkin(PooledConnection(StandInConnection()), failed=failed)
+        eq_(host.breaker.state, state)
+        eq_(host.breaker.trial_running, False)
+
+
+def test_socket_timeout_discards_connection():
+    host = DatabaseHost('db', 5432)
+    pool = ConnectionPool('conceptnet-test', size=1, host=host, follow_active=False)
+    conn = StandInConnection(socket.timeout('timed out'))
+    pool._idle.append(PooledConnection(conn))
+    with assert_raises(QueryTimeout):
+        pool.fetchall('SELECT 1')
+    # The reply could still arrive, so the connection mustn't be reused
+    eq_(conn.closed, True)
+    eq_(pool._idle, [])
+    eq_(host.breaker.failures, 1)
+
+
+def test_wrapped_socket_timeout():
+    try:
+        try:
+            raise socket.timeout('timed out')
+        except socket.timeout as err:
+            raise pg8000.InterfaceError('network error on read') from err
+    except pg8000.InterfaceError as err:
+        eq_(is_socket_timeout(err), True)
+        eq_(is_disconnect(err), True)
@@ -0,0 +1,132 @@
+from nose.tools import eq_
+import itertools
+import os
+import shutil
+import tempfile
+from conceptnet5.db import prepare_data
+from conceptnet5.db.binary_copy import ENCODERS
+from conceptnet5.db.prepare_data import (
+    CSV_NAMES, Interner, assertions_to_sql_csv, merge_shards, sanitize, shard_dirs
+)
+from conceptnet5.edges import make_edge
+from conceptnet5.formats.msgpack_stream import MsgpackStreamWriter
+
+CONCEPTS = [
+    '/c/en/cat', '/c/en/dog/n', '/c/en/dog/n/wn/animal', '/c/fr/chat',
+    '/c/ja/猫', '/c/en/back\\slash', '/c/en/tree', '/c/en/bark/v'
+]
+RELATIONS = ['/r/IsA', '/r/RelatedTo', '/r/Synonym', '/r/PartOf']
+CONTRIBUTORS = ['/s/contributor/omcs/%s' % name for name in 'abcde']
+
+
+class CollidingInterner(Interner):
+    """
+    An Interner whose strings all have the same hash.
+    """
+    def _hash(self, data):
+        return 0
+
+
+def test_interner():
+    for interner_class in (Interner, CollidingInterner):
+        written = []
+        interner = interner_class(lambda idx, text: written.append((idx, text)))
+        eq_(interner.add('/c/en/test'), 0)
+        eq_(interner.add('/c/ja/テスト'), 1)
+        eq_(interner.add('/c/en/quiz'), 2)
+        eq_(interner.add('/c/ja/テスト'), 1)
+        eq_(interner.add('/c/en/test'), 0)
+        eq_(len(interner), 3)
+        eq_(written, [(0, '/c/en/test'), (1, '/c/ja/テスト'), (2, '/c/en/quiz')])
+
+
+def test_binary_text_matches_csv():
+    text = '/c/en/tab\tand\nnewline\\'
+    buf = bytearray()
+    ENCODERS['text'](buf, text)
+    # The CSV escapes backslashes, which COPY turns back into one
+    eq_(bytes(buf[4:]).decode('utf-8'), sanitize(text).replace('\\\\', '\\'))
+    eq_(bytes(buf[4:]), b'/c/en/tabandnewline\\')
+
+
+def write_fixture(filename):
+    """
+    Write a few dozen edges between a small set of concepts, so that the
+    shards share many nodes and sources, and include some repeated edges.
+    """
+    writer = MsgpackStreamWriter(filename)
+    pairs = itertools.permutations(CONCEPTS, 2)
+    edges = []
+    for num, (start, end) in enumerate(pairs):
+        contributors = [
+            CONTRIBUTORS[(num * 3 + i) % len(CONTRIBUTORS)] for i in range(num % 3 + 1)
+        ]
+        edges.append(make_edge(
+            rel=RELATIONS[num % len(RELATIONS)], start=start, end=end,
+            dataset='/d/conceptnet/4/en' if num % 2 else '/d/wiktionary/fr',
+            license='cc:by/4.0',
+            sources=[{'contributor': contributor} for contributor in contributors],
+            weight=1.0 + num % 3
+        ))
+    for edge in edges + edges[::7]:
+        writer.write(edge)
+    writer.close()
+
+
+def read_outputs(dirname):
+    outputs = {}
+    for name in CSV_NAMES:
+        with open(os.path.join(dirname, name + '.csv'), 'rb') as file:
+            outputs[name] = file.read()
+    return outputs
+
+
+def convert(input_filename, output_dir, compact=False):
+    os.makedirs(output_dir)
+    assertions_to_sql_csv(input_filename, output_dir, compact)
+    return read_outputs(output_dir)
+
+
+def convert_sharded(input_filename, output_dir, shards, compact=False):
+    os.makedirs(output_dir)
+    dirs = shard_dirs(output_dir, shards)
+    for shard, dirname in enumerate(dirs):
+        os.makedirs(dirname)
+        assertions_to_sql_csv(input_filename, dirname, compact, shards, shard)
+    merge_shards(dirs, output_dir, compact)
+    return read_outputs(output_dir)
+
+
+def test_sharded_output_matches_single():
+    test_dir = tempfile.mkdtemp()
+    try:
+        input_filename = os.path.join(test_dir, 'assertions.msgpack')
+        write_fixture(input_filename)
+        for compact in (False, True):
+            mode = 'compact' if compact else 'full'
+            single = convert(input_filename, os.path.join(test_dir, mode), compact)
+            for shards in (2, 3):
+                merged = convert_sharded(
+                    input_filename, os.path.join(test_dir, '%s%d' % (mode, shards)),
+                    shards, compact
+                )
+                for name in CSV_NAMES:
+                    eq_(merged[name], single[name], '%s differs with %d shards' % (name, shards))
+    finally:
+        shutil.rmtree(test_dir)
+
+
+def test_hash_collisions_keep_uris_apart():
+    test_dir = tempfile.mkdtemp()
+    input_filename = os.path.join(test_dir, 'assertions.msgpack')
+    write_fixture(input_filename)
+    original_hash = prepare_data.bytes_hash
+    try:
+        expected = convert(input_filename, os.path.join(test_dir, 'hashed'))
+        # Every URI and assertion now has the same hash, which mustn't merge
+        # any of them
+        prepare_data.bytes_hash = lambda data: 0
+        eq_(convert(input_filename, os.path.join(test_dir, 'colliding')), expected)
+    finally:
+        prepare_data.bytes_hash = original_hash
+        shutil.rmtree(test_dir)
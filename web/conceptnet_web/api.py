@@ -1,15 +1,25 @@
 """
 This file sets up Flask to serve the ConceptNet 5 API in JSON-LD format.
 """
-from conceptnet_web.json_rendering import jsonify, highlight_and_link_json
+from conceptnet_web.json_rendering import (
+    jsonify, highlight_and_link_json, request_wants_json, stream_ndjson,
+    compress_chunks, requested_encoding
+)
 from conceptnet_web import responses
 from conceptnet_web.responses import VALID_KEYS, error
 from conceptnet_web.filters import FILTERS
+from conceptnet_web.http_cache import cached_response, RESPONSE_CACHE
+from conceptnet_web.params import (
+    get_int, parse_bulk_request, BULK_MAX_REQUESTS, BULK_MAX_RELATED
+)
 from conceptnet5.nodes import standardized_concept_uri
 import flask
 from flask_cors import CORS
 from flask_limiter import Limiter
+from flask_limiter.util import get_ipaddr
+from limits import parse_many
 from raven.contrib.flask import Sentry
+import inspect
 import logging
 import os
 # TODO: vector wrapper
@@ -28,27 +38,39 @@ app = flask.Flask(
 )
 app.config['JSON_AS_ASCII'] = False
 app.config['RATELIMIT_ENABLED'] = os.environ.get('CONCEPTNET_RATE_LIMITING') == '1'
+# Set CONCEPTNET_API_STATS=1 to serve statistics about database queries at /stats
+STATS_ENABLED = os.environ.get('CONCEPTNET_API_STATS') == '1'
 
 
 for filter_name, filter_func in FILTERS.items():
     app.jinja_env.filters[filter_name] = filter_func
 app.jinja_env.add_extension('jinja2_highlight.HighlightExtension')
-limiter = Limiter(app, global_limits=["600 per minute", "6000 per hour"])
+GLOBAL_RATE_LIMITS = ["600 per minute", "6000 per hour"]
+limiter = Limiter(app, key_func=get_ipaddr, global_limits=GLOBAL_RATE_LIMITS)
+RELATED_RATE_LIMIT = "60 per minute"
+# Each request in a /bulk batch counts against the same limits as the
+# single request it stands for, in the same Flask-Limiter storage, so the
+# limits are shared between /bulk and the single endpoints. Flask-Limiter
+# scopes its limits by the name of the endpoint.
+BULK_RATE_LIMITS = {
+    'lookup': ('query_node', parse_many('; '.join(GLOBAL_RATE_LIMITS))),
+    'query': ('query', parse_many('; '.join(GLOBAL_RATE_LIMITS))),
+    'related': ('query_top_related', parse_many(RELATED_RATE_LIMIT)),
+}
+# The rate limiting strategy that Flask-Limiter set up, which this version
+# of Flask-Limiter doesn't make public
+bulk_rate_limiter = limiter._limiter
+# Older versions of `limits`, which the Flask-Limiter we use may install,
+# can only record and test for one hit at a time
+HIT_TAKES_COST = 'cost' in inspect.signature(bulk_rate_limiter.hit).parameters
+TEST_TAKES_COST = 'cost' in inspect.signature(bulk_rate_limiter.test).parameters
 CORS(app)
 application = app  # for uWSGI
 
 
-def get_int(args, key, default, minimum, maximum):
-    strvalue = args.get(key, default)
-    try:
-        value = int(strvalue)
-    except ValueError:
-        value = default
-    return max(minimum, min(maximum, value))
-
-
 # Lookup: match any path starting with /a/, /c/, /d/, /r/, or /s/
 @app.route('/<any(a, c, d, r, s):top>/<path:query>')
+@cached_response
 def query_node(top, query):
     req_args = flask.request.args
     path = '/%s/%s' % (top, query.strip('/'))
@@ -61,12 +83,16 @@ def query_node(top, query):
     elif path.startswith('/a/'):
         results = responses.lookup_single_assertion(path)
     else:
-        results = responses.lookup_paginated(path, offset=offset, limit=limit)
+        results = responses.lookup_paginated(
+            path, offset=offset, limit=limit, after=req_args.get('after'), keyset=True,
+            raw=request_wants_json()
+        )
     return jsonify(results)
 
 
 @app.route('/search')
 @app.route('/query')
+@cached_response
 def query():
     req_args = flask.request.args
     criteria = {}
@@ -75,13 +101,119 @@ def query():
     for key in flask.request.args:
         if key in VALID_KEYS:
             criteria[key] = flask.request.args[key]
-    results = responses.query_paginated(criteria, offset=offset, limit=limit)
+    results = responses.query_paginated(
+        criteria, offset=offset, limit=limit, after=req_args.get('after'), keyset=True,
+        raw=request_wants_json()
+    )
     return jsonify(results)
 
 
+@app.route('/search/<any(prefix, fuzzy):method>')
+@cached_response
+def search_terms(method):
+    """
+    Suggest terms for some text that's being typed, in a given language.
+    /search/prefix finds the terms that start with the text, and
+    /search/fuzzy finds the terms that are spelled like it. The terms with
+    the most edges come first.
+    """
+    req_args = flask.request.args
+    language = req_args.get('language')
+    text = req_args.get('text')
+    if not language:
+        return render_error(400, "Please specify a 'language' parameter.")
+    if not text:
+        return render_error(400, "Please specify a 'text' parameter.")
+    limit = get_int(req_args, 'limit', 10, 1, 50)
+    return jsonify(responses.search_terms(method, language, text, limit=limit))
+
+
+@app.route('/bulk', methods=['POST'])
+def query_bulk():
+    """
+    Handle many lookup, query, and related-term requests at once. The body
+    of the POST is a JSON list of requests, each of which is an object like
+    one of these:
+
+        {"lookup": "/c/en/example", "limit": 20}
+        {"query": {"start": "/c/en/example", "rel": "/r/IsA"}, "limit": 50}
+        {"related": "/c/en/example", "filter": "/c/fr", "limit": 10}
+
+    The optional parameters are the same as the parameters of the single
+    requests. The response is newline-delimited JSON, with one line for the
+    response to each request, in order. An invalid request gets an error
+    response on its line, without affecting the others.
+    """
+    items = flask.request.get_json(force=True, silent=True)
+    if not isinstance(items, list):
+        return render_error(400, "Please POST a JSON list of requests.")
+    if len(items) > BULK_MAX_REQUESTS:
+        return render_error(
+            400, "Please send at most %d requests at once." % BULK_MAX_REQUESTS
+        )
+    requests = [parse_bulk_request(item) for item in items]
+    if sum(1 for request in requests if request['type'] == 'related') > BULK_MAX_RELATED:
+        return render_error(
+            400, "Please send at most %d 'related' requests at once." % BULK_MAX_RELATED
+        )
+    if not charge_bulk_requests(requests):
+        return render_error(429, "Too many requests. Please slow down.")
+    lines = stream_ndjson(responses.bulk_responses(requests))
+    encoding = requested_encoding()
+    if encoding is not None:
+        lines = compress_chunks(lines, encoding)
+    response = flask.Response(lines, mimetype='application/x-ndjson')
+    if encoding is not None:
+        response.headers['Content-Encoding'] = encoding
+    response.vary.add('Accept-Encoding')
+    return response
+
+
+def charge_bulk_requests(requests):
+    """
+    Count a batch of parsed /bulk requests against the rate limits of the
+    client that sent them, which are the limits of the single endpoints
+    they stand for. Returns False, without counting any of them, if the
+    batch would exceed the limits.
+    """
+    if not app.config['RATELIMIT_ENABLED']:
+        return True
+    key = get_ipaddr()
+    counts = {}
+    for request in requests:
+        if request['type'] in BULK_RATE_LIMITS:
+            counts[request['type']] = counts.get(request['type'], 0) + 1
+    charges = []
+    for request_type, cost in sorted(counts.items()):
+        scope, rate_limits = BULK_RATE_LIMITS[request_type]
+        charges.extend((rate_limit, scope, cost) for rate_limit in rate_limits)
+    for rate_limit, scope, cost in charges:
+        if not has_room(rate_limit, key, scope, cost):
+            return False
+    for rate_limit, scope, cost in charges:
+        if HIT_TAKES_COST:
+            bulk_rate_limiter.hit(rate_limit, key, scope, cost=cost)
+        else:
+            for _ in range(cost):
+                bulk_rate_limiter.hit(rate_limit, key, scope)
+    return True
+
+
+def has_room(rate_limit, key, scope, cost):
+    """
+    Determine whether a client's rate limit has room for `cost` more hits,
+    without counting them.
+    """
+    if TEST_TAKES_COST:
+        return bulk_rate_limiter.test(rate_limit, key, scope, cost=cost)
+    _reset_time, remaining = bulk_rate_limiter.get_window_stats(rate_limit, key, scope)
+    return remaining >= cost
+
+
 @app.route('/uri')
 @app.route('/normalize')
 @app.route('/standardize')
+@cached_response
 def query_standardize_uri():
     """
     Look up the URI for a given piece of text. 'text' and 'language' should be
@@ -100,6 +232,7 @@ def query_standardize_uri():
 
 
 @app.route('/')
+@cached_response
 def see_documentation():
     """
     This function redirects to the api documentation
@@ -111,7 +244,8 @@ def see_documentation():
 
 
 @app.route('/related/<path:uri>')
-@limiter.limit("60 per minute")
+@limiter.limit(RELATED_RATE_LIMIT)
+@cached_response
 def query_top_related(uri):
     req_args = flask.request.args
     uri = '/' + uri.rstrip('/ ')
@@ -121,6 +255,23 @@ def query_top_related(uri):
     return jsonify(results)
 
 
+if STATS_ENABLED:
+    @app.route('/stats')
+    def query_stats():
+        """
+        Show how the database queries made by this server process have
+        performed. Each process of a multi-process server keeps its own
+        statistics.
+        """
+        finder = responses.FINDER
+        stats = finder.query_stats()
+        stats['cache'] = finder.cache_stats()
+        stats['prepared_statements'] = finder.prepared_statement_stats()
+        stats['http_cache'] = RESPONSE_CACHE.stats() if RESPONSE_CACHE is not None else None
+        stats['pid'] = os.getpid()
+        return jsonify(stats)
+
+
 @app.errorhandler(IOError)
 @app.errorhandler(MemoryError)
 def error_data_unavailable(e):
@@ -0,0 +1,472 @@
+"""
+The ConceptNet 5 API as an ASGI application, for serving it from an event
+loop instead of from a pool of blocking worker processes.
+
+It has the same routes as `conceptnet_web.api`, and gives the same JSON-LD
+responses, but database queries are awaited through an AsyncAssertionFinder
+and the vector computations of /related run on a thread pool. A waiting
+client only costs an open connection, so a few processes can serve many
+slow clients at once, and each process only needs one copy of the vectors.
+
+Run it with an ASGI server, such as uvicorn:
+
+    uvicorn conceptnet_web.asgi:app --workers 2
+
+Unlike the Flask app, this one responds with JSON or MessagePack, never
+with the HTML view of the JSON, and leaves rate limiting to the proxy in
+front of it. Responses are compressed in the same way as the Flask app's.
+
+CONCEPTNET_VECTOR_THREADS sets how many /related queries can run at once
+(4 by default). The database queries run on threads of their own, as
+many as there are connections in the pool.
+"""
+import asyncio
+import json
+import logging
+import os
+import re
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import parse_qsl
+
+from conceptnet5.db.async_query import AsyncAssertionFinder
+from conceptnet5.nodes import standardized_concept_uri
+from conceptnet_web import responses
+from conceptnet_web.http_cache import (
+    ERROR_MAX_AGE, HTTP_CACHE_MAX_AGE, RESPONSE_CACHE, caching_stream, make_etag
+)
+from conceptnet_web.json_rendering import (
+    MSGPACK_MIMETYPE, RESPONSE_FORMATS, choose_encoding, compress_chunks, is_error,
+    render_body, stream_json, stream_ndjson
+)
+from conceptnet_web.params import (
+    get_int, parse_bulk_request, BULK_MAX_REQUESTS, BULK_MAX_RELATED
+)
+
+LOGGER = logging.getLogger('conceptnet_web')
+
+VECTOR_THREADS = int(os.environ.get('CONCEPTNET_VECTOR_THREADS', 4))
+# Set CONCEPTNET_API_STATS=1 to serve statistics about database queries at /stats
+STATS_ENABLED = os.environ.get('CONCEPTNET_API_STATS') == '1'
+
+# The largest request body we'll read, which is enough for a full /bulk
+# request
+MAX_BODY_SIZE = 1 << 22
+
+FINDER = AsyncAssertionFinder(finder=responses.FINDER)
+VECTOR_EXECUTOR = ThreadPoolExecutor(max_workers=VECTOR_THREADS)
+
+JSON_HEADERS = [
+    (b'content-type', b'application/json'),
+    (b'access-control-allow-origin', b'*'),
+]
+
+# Marks the end of an iterator that's being advanced on another thread
+_DONE = object()
+
+
+class Request(object):
+    """
+    The parts of an HTTP request that the API looks at. `args` has the
+    first value of each query parameter, and `params` has all of them in
+    order, as (key, value) pairs.
+    """
+    def __init__(self, scope, body=b''):
+        self.method = scope['method']
+        self.path = scope['path']
+        self.params = parse_qsl(scope.get('query_string', b'').decode('utf-8', 'replace'))
+        self.args = {}
+        for key, value in self.params:
+            self.args.setdefault(key, value)
+        self.headers = {
+            key.decode('latin-1').lower(): value.decode('latin-1')
+            for (key, value) in scope.get('headers', [])
+        }
+        self.body = body
+
+
+def parse_qualities(header):
+    """
+    Parse an Accept or Accept-Encoding header into a dictionary from each
+    value it lists to its quality, from 0 to 1.
+    """
+    qualities = {}
+    for item in header.split(','):
+        value, *options = item.split(';')
+        value = value.strip().lower()
+        if not value:
+            continue
+        quality = 1.
+        for option in options:
+            name, _, number = option.partition('=')
+            if name.strip() == 'q':
+                try:
+                    quality = float(number)
+                except ValueError:
+                    quality = 0.
+        qualities[value] = quality
+    return qualities
+
+
+def requested_format(request):
+    """
+    Determine whether a request wants a 'json' or 'msgpack' response.
+    """
+    requested = request.args.get('format')
+    if requested in RESPONSE_FORMATS and requested != 'html':
+        return requested
+    if 'msgpack' not in RESPONSE_FORMATS:
+        return 'json'
+    accept = parse_qualities(request.headers.get('accept', ''))
+    msgpack_quality = max(
+        accept.get(MSGPACK_MIMETYPE, 0), accept.get('application/x-msgpack', 0)
+    )
+    json_quality = max(
+        accept.get('application/ld+json', 0), accept.get('application/json', 0)
+    )
+    if msgpack_quality > json_quality:
+        return 'msgpack'
+    return 'json'
+
+
+def requested_encoding(request):
+    """
+    Choose the compression for the response to a request, if any.
+    """
+    accept = parse_qualities(request.headers.get('accept-encoding', ''))
+    return choose_encoding(lambda encoding: accept.get(encoding, accept.get('*', 0)))
+
+
+def error_response(status, details):
+    return status, responses.error({}, status=status, details=details)
+
+
+async def run_vectors(func, *args, **kwargs):
+    """
+    Run a vector computation on the thread pool for them.
+    """
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(VECTOR_EXECUTOR, lambda: func(*args, **kwargs))
+
+
+async def query_node(request, top, query):
+    path = '/%s/%s' % (top, query.strip('/'))
+    offset = get_int(request.args, 'offset', 0, 0, 100000)
+    limit = get_int(request.args, 'limit', 20, 0, 1000)
+    grouped = request.args.get('grouped', 'false').lower() == 'true'
+    if grouped:
+        limit = min(limit, 100)
+        if not path.startswith('/c/'):
+            return 200, responses.error(
+                {}, 400,
+                'Only concept nodes (starting with /c/) can be grouped by feature.'
+            )
+        found = await FINDER.lookup_feature_summary(path, limit=limit)
+        return 200, responses.grouped_response(path, found, limit)
+    elif path.startswith('/a/'):
+        found = await FINDER.lookup(path, limit=1)
+        return 200, responses.assertion_response(path, found)
+    after = request.args.get('after')
+    try:
+        after_key = responses.decode_continuation_token(after) if after is not None else None
+    except ValueError as err:
+        return 200, responses.error({'@id': path}, 400, str(err))
+    found = await FINDER.lookup(path, limit=limit + 1, offset=offset, after=after_key, raw=True)
+    return 200, responses.lookup_response(path, found, limit, offset, after, True)
+
+
+async def query(request):
+    offset = get_int(request.args, 'offset', 0, 0, 100000)
+    limit = get_int(request.args, 'limit', 50, 0, 1000)
+    criteria = {
+        key: value for (key, value) in request.args.items()
+        if key in responses.VALID_KEYS
+    }
+    after = request.args.get('after')
+    try:
+        after_key = responses.decode_continuation_token(after) if after is not None else None
+    except ValueError as err:
+        query_id = responses.make_query_url('/query', criteria.items())
+        return 200, responses.error({'@id': query_id}, 400, str(err))
+    found = await FINDER.query(
+        criteria, limit=limit + 1, offset=offset, after=after_key, raw=True
+    )
+    return 200, responses.query_response(criteria, found, limit, offset, after, True)
+
+
+async def search_terms(request, method):
+    language = request.args.get('language')
+    text = request.args.get('text')
+    if not language:
+        return error_response(400, "Please specify a 'language' parameter.")
+    if not text:
+        return error_response(400, "Please specify a 'text' parameter.")
+    limit = get_int(request.args, 'limit', 10, 1, 50)
+    if method == 'prefix':
+        found = await FINDER.complete_terms(language, text, limit=limit)
+    else:
+        found = await FINDER.fuzzy_terms(language, text, limit=limit)
+    return 200, responses.search_response(method, language, text, limit, found)
+
+
+async def query_standardize_uri(request):
+    language = request.args.get('language')
+    text = request.args.get('text') or request.args.get('term')
+    if not language:
+        return error_response(400, "Please specify a 'language' parameter.")
+    if not text:
+        return error_response(400, "Please specify a 'text' parameter.")
+    return 200, {
+        '@context': responses.CONTEXT,
+        '@id': standardized_concept_uri(language, text)
+    }
+
+
+async def see_documentation(request):
+    return 200, {
+        '@context': responses.CONTEXT,
+        'rdfs:comment': 'See http://www.conceptnet.io for more information about ConceptNet, and http://api.conceptnet.io/docs for the API documentation.'
+    }
+
+
+async def query_top_related(request, uri):
+    uri = '/' + uri.rstrip('/ ')
+    limit = get_int(request.args, 'limit', 50, 0, 100)
+    related_query, failure = responses.related_query(uri)
+    if failure is not None:
+        return 200, failure
+    found = await run_vectors(
+        responses.VECTORS.similar_terms, related_query,
+        filter=request.args.get('filter'), limit=limit
+    )
+    return 200, responses.related_response(uri, found)
+
+
+async def query_stats(request):
+    finder = responses.FINDER
+    stats = finder.query_stats()
+    stats['cache'] = finder.cache_stats()
+    stats['prepared_statements'] = finder.prepared_statement_stats()
+    stats['http_cache'] = RESPONSE_CACHE.stats() if RESPONSE_CACHE is not None else None
+    stats['pid'] = os.getpid()
+    return 200, stats
+
+
+# The routes, as (method, regex, handler, cacheable) tuples. The handlers
+# are given the groups that the regex matched.
+ROUTES = [
+    ('GET', re.compile(r'^/([acdrs])/(.+)$'), query_node, True),
+    ('GET', re.compile(r'^/(?:search|query)$'), query, True),
+    ('GET', re.compile(r'^/search/(prefix|fuzzy)$'), search_terms, True),
+    ('GET', re.compile(r'^/(?:uri|normalize|standardize)$'), query_standardize_uri, True),
+    ('GET', re.compile(r'^/$'), see_documentation, True),
+    ('GET', re.compile(r'^/related/(.+)$'), query_top_related, True),
+]
+if STATS_ENABLED:
+    ROUTES.append(('GET', re.compile(r'^/stats$'), query_stats, False))
+
+
+def etag_matches(header, etag):
+    """
+    Determine whether an If-None-Match header matches an ETag.
+    """
+    for tag in header.split(','):
+        tag = tag.strip()
+        if tag.startswith('W/'):
+            tag = tag[2:]
+        if tag == '*' or tag.strip('"') == etag:
+            return True
+    return False
+
+
+async def send_response(send, status, chunks, headers=JSON_HEADERS):
+    """
+    Send an HTTP response whose body is an iterable of bytes.
+    """
+    await send({'type': 'http.response.start', 'status': status, 'headers': headers})
+    for chunk in chunks:
+        await send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+    await send({'type': 'http.response.body', 'body': b''})
+
+
+def content_headers(mimetype, encoding):
+    headers = [(b'content-type', mimetype.encode('ascii'))] + JSON_HEADERS[1:]
+    if encoding is not None:
+        headers.append((b'content-encoding', encoding.encode('ascii')))
+    headers.append((b'vary', b'Accept, Accept-Encoding'))
+    return headers
+
+
+def cache_headers(etag):
+    return [
+        (b'etag', ('"%s"' % etag).encode('ascii')),
+        (b'cache-control', ('public, max-age=%d' % HTTP_CACHE_MAX_AGE).encode('ascii')),
+    ]
+
+
+def error_cache_headers():
+    return [
+        (b'cache-control', ('public, max-age=%d' % ERROR_MAX_AGE).encode('ascii')),
+    ]
+
+
+async def handle_get(request, send, handler, groups, cacheable):
+    response_format = requested_format(request)
+    encoding = requested_encoding(request)
+    etag = None
+    if cacheable:
+        etag = make_etag(
+            request.path, request.params,
+            '%s+%s' % (response_format, encoding or 'identity')
+        )
+        if etag_matches(request.headers.get('if-none-match', ''), etag):
+            await send_response(send, 304, [], cache_headers(etag))
+            return
+        if RESPONSE_CACHE is not None:
+            cached = RESPONSE_CACHE.get(etag)
+            if cached is not None:
+                body, status, mimetype, used_encoding = cached
+                headers = content_headers(mimetype, used_encoding) + cache_headers(etag)
+                await send_response(send, status, [body], headers)
+                return
+
+    status, obj = await handler(request, *groups)
+    body, mimetype, encoding = render_body(obj, response_format, encoding)
+    chunks = [body] if isinstance(body, bytes) else body
+    headers = content_headers(mimetype, encoding)
+    if etag is not None and status == 200:
+        if is_error(obj):
+            headers = headers + error_cache_headers()
+        else:
+            headers = headers + cache_headers(etag)
+            if RESPONSE_CACHE is not None:
+                chunks = caching_stream(chunks, etag, status, mimetype, encoding)
+    await send_response(send, status, chunks, headers)
+
+
+async def handle_bulk(request, send):
+    """
+    Respond to a POST to /bulk. See `conceptnet_web.api.query_bulk`.
+
+    The responses are computed by `responses.bulk_responses` on the vector
+    thread pool, a chunk at a time, and each chunk is sent as soon as it's
+    ready.
+    """
+    try:
+        items = json.loads(request.body.decode('utf-8'))
+    except ValueError:
+        items = None
+    if not isinstance(items, list):
+        status, obj = error_response(400, "Please POST a JSON list of requests.")
+        await send_response(send, status, stream_json(obj))
+        return
+    if len(items) > BULK_MAX_REQUESTS:
+        status, obj = error_response(
+            400, "Please send at most %d requests at once." % BULK_MAX_REQUESTS
+        )
+        await send_response(send, status, stream_json(obj))
+        return
+
+    requests = [parse_bulk_request(item) for item in items]
+    if sum(1 for request in requests if request['type'] == 'related') > BULK_MAX_RELATED:
+        status, obj = error_response(
+            400, "Please send at most %d 'related' requests at once." % BULK_MAX_RELATED
+        )
+        await send_response(send, status, stream_json(obj))
+        return
+    lines = stream_ndjson(responses.bulk_responses(requests))
+    encoding = requested_encoding(request)
+    if encoding is not None:
+        lines = compress_chunks(lines, encoding)
+    loop = asyncio.get_running_loop()
+    await send({
+        'type': 'http.response.start', 'status': 200,
+        'headers': content_headers('application/x-ndjson', encoding)
+    })
+    while True:
+        chunk = await loop.run_in_executor(VECTOR_EXECUTOR, next, lines, _DONE)
+        if chunk is _DONE:
+            break
+        await send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+    await send({'type': 'http.response.body', 'body': b''})
+
+
+async def read_body(receive):
+    """
+    Read the body of a request, returning None if it's too large.
+    """
+    body = bytearray()
+    while True:
+        message = await receive()
+        if message['type'] == 'http.disconnect':
+            break
+        body += message.get('body', b'')
+        if len(body) > MAX_BODY_SIZE:
+            return None
+        if not message.get('more_body', False):
+            break
+    return bytes(body)
+
+
+async def handle_http(scope, receive, send):
+    path = scope['path']
+    if scope['method'] == 'POST' and path == '/bulk':
+        body = await read_body(receive)
+        if body is None:
+            status, obj = error_response(413, "The request is too large.")
+            await send_response(send, status, stream_json(obj))
+            return
+        await handle_bulk(Request(scope, body), send)
+        return
+
+    for method, regex, handler, cacheable in ROUTES:
+        match = regex.match(path)
+        if match:
+            if scope['method'] != method:
+                status, obj = error_response(405, "Only GET requests are allowed here.")
+                await send_response(send, status, stream_json(obj))
+                return
+            await handle_get(Request(scope), send, handler, match.groups(), cacheable)
+            return
+
+    status, obj = error_response(404, "%r isn't a URL that we understand." % path)
+    await send_response(send, status, stream_json(obj))
+
+
+async def handle_lifespan(receive, send):
+    """
+    Load the vectors when the server starts, instead of on the first
+    request that needs them, and stop the thread pools when it shuts down.
+    """
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            try:
+                await run_vectors(responses.VECTORS.load)
+            except Exception:
+                LOGGER.exception("Couldn't load the vectors; /related will fail")
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            FINDER.close()
+            VECTOR_EXECUTOR.shutdown(wait=True)
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+
+async def app(scope, receive, send):
+    """
+    The ASGI application.
+    """
+    if scope['type'] == 'lifespan':
+        await handle_lifespan(receive, send)
+        return
+    if scope['type'] != 'http':
+        return
+    try:
+        await handle_http(scope, receive, send)
+    except (IOError, MemoryError) as err:
+        status, obj = error_response(503, str(err))
+        await send_response(send, status, stream_json(obj))
+    except Exception:
+        LOGGER.exception("Error handling %s", scope['path'])
+        status, obj = error_response(500, "Internal server error")
+        await send_response(send, status, stream_json(obj))
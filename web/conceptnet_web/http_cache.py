@@ -0,0 +1,244 @@
+"""
+HTTP caching for the API's responses.
+
+ConceptNet's data only changes when a new build is loaded, so a response is
+identified by the build it came from, its normalized URL, and its
+representation: the format it was rendered in (JSON, MessagePack, or HTML)
+and how it was compressed. The `cached_response` decorator gives the
+responses of the read-only endpoints a strong ETag made from these, and a
+long Cache-Control lifetime, so that clients and CDNs can keep them.
+
+A request whose If-None-Match header has the current ETag gets a 304 Not
+Modified response right away, without querying the database or the
+vectors.
+
+Responses that describe an error, even the ones with a status of 200, get
+no ETag and only a short lifetime, and aren't cached.
+
+The rendered responses can also be kept in a cache in this process, or in
+uWSGI's shared cache, so that repeated requests for the same URL don't have
+to be rendered again. This is configured by environment variables:
+
+    CONCEPTNET_HTTP_CACHE - 'none' (the default) for no response cache,
+        'local' for a cache in each process, or 'uwsgi' for uWSGI's cache
+        named 'conceptnet-http'
+    CONCEPTNET_HTTP_CACHE_SIZE - how many responses the local cache holds
+    CONCEPTNET_HTTP_CACHE_MAX_AGE - the lifetime in seconds to put in the
+        Cache-Control header, which defaults to a day
+"""
+import functools
+import hashlib
+import os
+import threading
+import time
+from urllib.parse import urlencode
+
+import flask
+import pg8000
+
+from conceptnet5.db.cache import make_cache
+from conceptnet5.db.connection import get_build_id
+from conceptnet5.db.versions import get_active_version
+from conceptnet5.util import get_data_filename
+from conceptnet_web.json_rendering import representation
+from conceptnet_web.responses import FINDER, VECTORS
+from conceptnet_web.version import __version__
+
+HTTP_CACHE = os.environ.get('CONCEPTNET_HTTP_CACHE', 'none')
+HTTP_CACHE_SIZE = int(os.environ.get('CONCEPTNET_HTTP_CACHE_SIZE', 1000))
+HTTP_CACHE_MAX_AGE = int(os.environ.get('CONCEPTNET_HTTP_CACHE_MAX_AGE', 86400))
+
+# Responses larger than this many bytes aren't kept in the response cache
+MAX_CACHED_SIZE = 1 << 20
+
+# How often, in seconds, to check whether a new build has been loaded
+BUILD_CHECK_INTERVAL = 5
+
+# How long, in seconds, clients can keep a response that describes an error
+ERROR_MAX_AGE = 60
+
+# Query parameters that don't affect the response, and are left out of the
+# normalized URL
+IGNORED_PARAMS = {'_'}
+
+# The query results that AssertionFinder caches are in the uWSGI cache named
+# 'conceptnet', so the responses need a cache of their own
+RESPONSE_CACHE = make_cache(
+    backend=HTTP_CACHE, size=HTTP_CACHE_SIZE, ttl=0, name='conceptnet-http'
+)
+
+_build = {'id': None, 'version': None, 'checked': None}
+
+# Stands for the active version when it couldn't be found out
+_NO_VERSION = object()
+_build_lock = threading.Lock()
+
+
+def _mtime(filename):
+    try:
+        return str(os.stat(filename).st_mtime_ns)
+    except (OSError, TypeError):
+        return None
+
+
+def _active_version(finder):
+    """
+    Ask the database which version of the data is active (see
+    `conceptnet5.db.versions`). Returns `_NO_VERSION` if the API doesn't
+    use the database, or if the database couldn't be asked.
+    """
+    get_pool = getattr(finder, '_get_pool', None)
+    if get_pool is None:
+        return _NO_VERSION
+
+    def read_version(pooled):
+        version = get_active_version(pooled.connection)
+        pooled.connection.rollback()
+        return version
+
+    try:
+        return get_pool().run(read_version)
+    except (pg8000.Error, IOError):
+        return _NO_VERSION
+
+
+def current_build_id():
+    """
+    Get an identifier for all the data that the API's responses come from:
+    the database build and the version of it that's active, the vectors
+    and completions, and the version of this code. It's checked again every
+    BUILD_CHECK_INTERVAL seconds.
+
+    The active version is read from the database, not from the pool, so
+    every worker gets the same identifier as soon as it starts, and it
+    changes when a version is activated from any host. If the database
+    can't be reached, the version that was seen last is kept.
+    """
+    now = time.monotonic()
+    with _build_lock:
+        if _build['checked'] is not None and now - _build['checked'] < BUILD_CHECK_INTERVAL:
+            return _build['id']
+        version = _active_version(FINDER)
+        if version is _NO_VERSION:
+            version = _build['version']
+        parts = [
+            __version__,
+            get_build_id(),
+            version,
+            _mtime(VECTORS.vector_filename),
+            _mtime(get_data_filename('completions/top.marisa')),
+        ]
+        embedded_path = getattr(FINDER, 'path', None)
+        if embedded_path is not None:
+            parts.append(_mtime(os.path.join(embedded_path, 'index.marisa')))
+        _build['id'] = hashlib.sha1(repr(parts).encode('utf-8')).hexdigest()[:16]
+        _build['version'] = version
+        _build['checked'] = now
+        return _build['id']
+
+
+def normalized_url(path, params):
+    """
+    Get a URL in a canonical form, from its path and a list of its
+    (key, value) query parameters: the parameters are put in sorted order.
+    """
+    params = sorted(
+        (key, value) for (key, value) in params if key not in IGNORED_PARAMS
+    )
+    if params:
+        return path + '?' + urlencode(params)
+    return path
+
+
+def make_etag(path, params, response_repr):
+    """
+    Get the ETag for the response to a URL, with the given path and query
+    parameters, in the given representation (see
+    `json_rendering.representation`), such as 'json+gzip'.
+    """
+    key = '\n'.join([current_build_id(), normalized_url(path, params), response_repr])
+    return hashlib.sha1(key.encode('utf-8')).hexdigest()
+
+
+def response_etag(request):
+    """
+    Get the ETag that the response to a Flask request will have.
+    """
+    return make_etag(request.path, request.args.items(multi=True), representation())
+
+
+def _set_error_cache_headers(response):
+    response.headers['Cache-Control'] = 'public, max-age=%d' % ERROR_MAX_AGE
+    return response
+
+
+def _set_cache_headers(response, etag):
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = 'public, max-age=%d' % HTTP_CACHE_MAX_AGE
+    response.vary.add('Accept')
+    response.vary.add('Accept-Encoding')
+    return response
+
+
+def caching_stream(chunks, etag, status, mimetype, encoding=None):
+    """
+    Pass along the chunks of a streamed response, and cache the whole
+    response once it's complete, unless it's too large.
+    """
+    body = []
+    size = 0
+    for chunk in chunks:
+        if body is not None:
+            body.append(chunk)
+            size += len(chunk)
+            if size > MAX_CACHED_SIZE:
+                body = None
+        yield chunk
+    if body is not None:
+        RESPONSE_CACHE.set(etag, (b''.join(body), status, mimetype, encoding))
+
+
+def cached_response(view):
+    """
+    Decorate a Flask view of ConceptNet's data so that its successful
+    responses get an ETag and a Cache-Control header, conditional requests
+    are answered with 304 Not Modified, and rendered responses are cached
+    if CONCEPTNET_HTTP_CACHE is set. Responses that describe an error (see
+    `json_rendering.is_error`) only get a short Cache-Control lifetime.
+    """
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        request = flask.request
+        etag = response_etag(request)
+        if request.if_none_match.contains(etag):
+            return _set_cache_headers(flask.Response(status=304), etag)
+        if RESPONSE_CACHE is not None:
+            cached = RESPONSE_CACHE.get(etag)
+            if cached is not None:
+                body, status, mimetype, encoding = cached
+                response = flask.Response(body, status=status, mimetype=mimetype)
+                if encoding is not None:
+                    response.headers['Content-Encoding'] = encoding
+                return _set_cache_headers(response, etag)
+
+        response = flask.make_response(view(*args, **kwargs))
+        if response.status_code != 200:
+            return response
+        if flask.g.get('response_is_error'):
+            return _set_error_cache_headers(response)
+        _set_cache_headers(response, etag)
+        if RESPONSE_CACHE is not None:
+            encoding = response.headers.get('Content-Encoding')
+            if response.is_streamed:
+                response.response = caching_stream(
+                    response.response, etag, response.status_code, response.mimetype,
+                    encoding
+                )
+            else:
+                body = response.get_data()
+                if len(body) <= MAX_CACHED_SIZE:
+                    RESPONSE_CACHE.set(
+                        etag, (body, response.status_code, response.mimetype, encoding)
+                    )
+        return response
+    return wrapper
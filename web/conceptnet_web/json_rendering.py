@@ -1,24 +1,140 @@
+"""
+Rendering the API's responses, in the format and encoding that the client
+asks for.
+
+The format is JSON-LD, or the same structure encoded as MessagePack when
+the client asks for 'application/msgpack' (or adds `format=msgpack`) and
+the `msgpack` package is installed, or an HTML page showing the JSON to a
+Web browser.
+
+JSON and MessagePack responses are compressed, when the client accepts it
+and they're at least COMPRESS_MIN_SIZE bytes, with Brotli if the `brotli`
+package is installed, or with gzip.
+
+The JSON is encoded with the `json` module by default. Set
+CONCEPTNET_JSON_ENCODER=orjson to encode it with `orjson`, if it's
+installed, which is much faster. orjson leaves out the spaces after commas
+and colons, but the edges that come precomputed from the database keep
+the `json` module's spacing, so its responses mix the two styles.
+"""
 from pygments.formatters import HtmlFormatter
 from pygments.lexers import get_lexer_by_name
 from pygments import highlight
 from jinja2.ext import Markup
+from conceptnet5.db.query import RawEdge
 import flask
+import os
 import re
 import json
+import zlib
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+# How much JSON text to collect before sending it as part of a streamed response
+STREAM_CHUNK_SIZE = 65536
+
+# Responses smaller than this many bytes aren't worth compressing
+COMPRESS_MIN_SIZE = 1024
+
+# How hard gzip and Brotli try. These levels favor speed, because the
+# responses are compressed as they're served.
+GZIP_LEVEL = 6
+BROTLI_QUALITY = 5
+
+MSGPACK_MIMETYPE = 'application/msgpack'
+
+# The formats that responses can be requested in
+if msgpack is not None:
+    RESPONSE_FORMATS = ('json', 'msgpack', 'html')
+else:
+    RESPONSE_FORMATS = ('json', 'html')
+
+JSON_ENCODER = os.environ.get('CONCEPTNET_JSON_ENCODER', 'standard')
+USE_ORJSON = orjson is not None and JSON_ENCODER == 'orjson'
+
+# The separators between items and between keys and values, which match
+# the ones that the encoder uses
+if USE_ORJSON:
+    ITEM_SEPARATOR, KEY_SEPARATOR = ',', ':'
+else:
+    ITEM_SEPARATOR, KEY_SEPARATOR = ', ', ': '
+
+
+def requested_format():
+    """
+    Determine from the request which format the response should be in:
+    'json', 'msgpack', or 'html' for a Web browser that wants pretty
+    rendering.
+    """
+    requested = flask.request.args.get('format')
+    if requested in RESPONSE_FORMATS:
+        return requested
+    mimetypes = ['application/ld+json', 'application/json']
+    if 'msgpack' in RESPONSE_FORMATS:
+        mimetypes += [MSGPACK_MIMETYPE, 'application/x-msgpack']
+    mimetypes.append('text/html')
+    best = flask.request.accept_mimetypes.best_match(mimetypes)
+    if best is None or 'json' in best:
+        return 'json'
+    elif 'msgpack' in best:
+        return 'msgpack'
+    else:
+        return 'html'
+
+
+def choose_encoding(quality):
+    """
+    Choose the compression to use for a response, given a function that
+    returns how much the client accepts a content-coding (as a number from
+    0 to 1). Returns 'br', 'gzip', or None.
+    """
+    for encoding in ('br', 'gzip'):
+        if encoding == 'br' and brotli is None:
+            continue
+        if quality(encoding) > 0:
+            return encoding
+    return None
+
+
+def requested_encoding():
+    """
+    Choose the compression for the response to the current Flask request.
+    """
+    return choose_encoding(lambda encoding: flask.request.accept_encodings[encoding])
+
+
+def representation():
+    """
+    Describe the representation of the response to the current request --
+    its format and compression -- for telling apart the ETags of different
+    representations of the same resource.
+    """
+    response_format = requested_format()
+    if response_format == 'html':
+        return 'html'
+    return '%s+%s' % (response_format, requested_encoding() or 'identity')
 
 
 def request_wants_json():
     """
     Determine from the request headers whether this is a Web browser that wants
-    pretty rendering, or an API user that wants actual JSON-LD.
+    pretty rendering, or an API user that wants actual JSON-LD (or the
+    MessagePack encoding of it).
     """
-    if flask.request.args.get('format') == 'json':
-        return True
-    elif flask.request.args.get('format') == 'html':
-        return False
-    best = flask.request.accept_mimetypes \
-        .best_match(['application/ld+json', 'application/json', 'text/html'])
-    return (best is None) or ('json' in best)
+    return requested_format() != 'html'
 
 
 def regex_replacement_stack(replacements):
@@ -53,19 +169,201 @@ def highlight_and_link_json(content):
     return Markup(urlized_html)
 
 
+def _encode(obj):
+    if USE_ORJSON:
+        return orjson.dumps(obj, option=orjson.OPT_SORT_KEYS).decode('utf-8')
+    return json.dumps(obj, ensure_ascii=False, sort_keys=True)
+
+
+def _has_raw_edges(obj):
+    return any(
+        isinstance(value, list) and any(isinstance(item, RawEdge) for item in value)
+        for value in obj.values()
+    )
+
+
+def iter_json(obj):
+    """
+    Yield pieces of the JSON text for `obj`, which is a response dictionary.
+    The pieces add up to the same text that `_encode` would produce
+    (with sorted keys and without ASCII escaping), but lists of edges can
+    contain RawEdge strings, which are JSON already and are output as is.
+    """
+    yield '{'
+    for i, key in enumerate(sorted(obj)):
+        if i > 0:
+            yield ITEM_SEPARATOR
+        yield _encode(key)
+        yield KEY_SEPARATOR
+        value = obj[key]
+        if isinstance(value, list) and any(isinstance(item, RawEdge) for item in value):
+            yield '['
+            for j, item in enumerate(value):
+                if j > 0:
+                    yield ITEM_SEPARATOR
+                if isinstance(item, RawEdge):
+                    yield str(item)
+                else:
+                    yield _encode(item)
+            yield ']'
+        else:
+            yield _encode(value)
+    yield '}'
+
+
+def stream_json(obj, chunk_size=STREAM_CHUNK_SIZE):
+    """
+    Yield the JSON text of `obj`, as produced by `iter_json`, as UTF-8 bytes
+    in chunks of about `chunk_size` bytes.
+    """
+    chunk = []
+    length = 0
+    for piece in iter_json(obj):
+        data = piece.encode('utf-8')
+        chunk.append(data)
+        length += len(data)
+        if length >= chunk_size:
+            yield b''.join(chunk)
+            chunk = []
+            length = 0
+    if chunk:
+        yield b''.join(chunk)
+
+
+def stream_ndjson(objs, chunk_size=STREAM_CHUNK_SIZE):
+    """
+    Yield newline-delimited JSON for a sequence of response dictionaries,
+    one line per dictionary, as UTF-8 bytes in chunks of about `chunk_size`
+    bytes.
+    """
+    chunk = []
+    length = 0
+    for obj in objs:
+        for piece in iter_json(obj):
+            data = piece.encode('utf-8')
+            chunk.append(data)
+            length += len(data)
+            if length >= chunk_size:
+                yield b''.join(chunk)
+                chunk = []
+                length = 0
+        chunk.append(b'\n')
+        length += 1
+    if chunk:
+        yield b''.join(chunk)
+
+
+def _decode_raw_edges(obj):
+    """
+    Replace the RawEdges in a response dictionary with the dictionaries
+    they encode, for formats other than JSON.
+    """
+    if not isinstance(obj, dict) or not _has_raw_edges(obj):
+        return obj
+    return {
+        key: [json.loads(item) if isinstance(item, RawEdge) else item for item in value]
+        if isinstance(value, list) else value
+        for (key, value) in obj.items()
+    }
+
+
+def encode_msgpack(obj):
+    return msgpack.packb(_decode_raw_edges(obj), use_bin_type=True)
+
+
+def _compressor(encoding):
+    """
+    Get a function that compresses the next piece of data, and a function
+    that returns the end of the compressed data.
+    """
+    if encoding == 'br':
+        compressor = brotli.Compressor(quality=BROTLI_QUALITY)
+        return compressor.process, compressor.finish
+    else:
+        # wbits=31 writes a gzip header and trailer
+        compressor = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 31)
+        return compressor.compress, compressor.flush
+
+
+def compress(data, encoding):
+    """
+    Compress bytes with the content-coding 'br' or 'gzip'.
+    """
+    process, finish = _compressor(encoding)
+    return process(data) + finish()
+
+
+def compress_chunks(chunks, encoding):
+    """
+    Compress a stream of bytes with the content-coding 'br' or 'gzip', as
+    a stream of compressed chunks.
+    """
+    process, finish = _compressor(encoding)
+    for chunk in chunks:
+        compressed = process(chunk)
+        if compressed:
+            yield compressed
+    yield finish()
+
+
+def render_body(obj, response_format='json', encoding=None):
+    """
+    Render a response dictionary as 'json' or 'msgpack', compressed with
+    `encoding` if it's worth compressing. Returns the body -- as bytes, or
+    as an iterator of bytes if it's streamed -- along with its MIME type
+    and the encoding that was actually used.
+    """
+    raw = isinstance(obj, dict) and _has_raw_edges(obj)
+    if response_format == 'msgpack':
+        body = encode_msgpack(obj)
+        mimetype = MSGPACK_MIMETYPE
+    elif raw:
+        body = stream_json(obj)
+        mimetype = 'application/json'
+    else:
+        body = _encode(obj).encode('utf-8')
+        mimetype = 'application/json'
+
+    if isinstance(body, bytes):
+        if encoding is not None and len(body) >= COMPRESS_MIN_SIZE:
+            body = compress(body, encoding)
+        else:
+            encoding = None
+    elif encoding is not None:
+        # A streamed response is usually large, so compress it if we can
+        body = compress_chunks(body, encoding)
+    return body, mimetype, encoding
+
+
+def is_error(obj):
+    """
+    Determine whether a response object, before it's rendered, describes an
+    error, such as a node that doesn't exist or a bad parameter. Some of
+    these are sent with a status of 200.
+    """
+    return isinstance(obj, dict) and 'error' in obj
+
+
 def jsonify(obj, status=200):
     """
     Our custom method for returning JSON, which either provides the raw JSON
-    or fills in an HTML template with pretty, syntax-highlighted, linked JSON,
-    depending on the requested content type.
-    """
-    if flask.request is None or request_wants_json():
-        return flask.Response(
-            json.dumps(obj, ensure_ascii=False, sort_keys=True),
-            status=status,
-            mimetype='application/json'
-        )
-    else:
+    (or MessagePack) or fills in an HTML template with pretty,
+    syntax-highlighted, linked JSON, depending on the requested content
+    type. Raw responses are compressed if the client accepts it.
+
+    If the response contains RawEdges, the JSON is streamed, with the text
+    of the edges copied straight into it.
+
+    If `obj` describes an error, this is noted in `flask.g.response_is_error`,
+    so that `http_cache.cached_response` won't cache it.
+    """
+    if flask.has_request_context() and is_error(obj):
+        flask.g.response_is_error = True
+    raw = isinstance(obj, dict) and _has_raw_edges(obj)
+    response_format = requested_format() if flask.has_request_context() else 'json'
+    if response_format == 'html':
+        if raw:
+            obj = json.loads(''.join(iter_json(obj)))
         pretty_json = json.dumps(obj, ensure_ascii=False, sort_keys=True, indent=2)
         ugly_json = json.dumps(obj, ensure_ascii=False, sort_keys=True)
         return flask.render_template(
@@ -73,3 +371,12 @@ def jsonify(obj, status=200):
             json=pretty_json,
             json_raw=ugly_json
         ), status
+
+    encoding = requested_encoding() if flask.has_request_context() else None
+    body, mimetype, encoding = render_body(obj, response_format, encoding)
+    response = flask.Response(body, status=status, mimetype=mimetype)
+    if encoding is not None:
+        response.headers['Content-Encoding'] = encoding
+    response.vary.add('Accept')
+    response.vary.add('Accept-Encoding')
+    return response
@@ -0,0 +1,84 @@
+"""
+Reading the parameters of API requests, which is shared by the Flask app in
+`conceptnet_web.api` and the ASGI app in `conceptnet_web.asgi`.
+"""
+from conceptnet_web.responses import VALID_KEYS, error
+
+# The most requests that can be sent to /bulk at once. Each of them counts
+# against the rate limit of 600 requests per minute, so a batch has to fit
+# within that to ever succeed.
+BULK_MAX_REQUESTS = 500
+
+# The most 'related' requests that a /bulk batch can contain, which is the
+# rate limit of 60 per minute on /related
+BULK_MAX_RELATED = 60
+
+
+def get_int(args, key, default, minimum, maximum):
+    strvalue = args.get(key, default)
+    try:
+        value = int(strvalue)
+    except (TypeError, ValueError):
+        value = default
+    return max(minimum, min(maximum, value))
+
+
+def parse_bulk_request(item):
+    """
+    Check one of the requests sent to /bulk and fill in its defaults, in the
+    form that `responses.bulk_responses` takes.
+    """
+    if not isinstance(item, dict):
+        return bulk_request_error({}, "Each request should be a JSON object.")
+    if 'lookup' in item:
+        uri = item['lookup']
+        if not isinstance(uri, str) or uri[:3] not in ('/a/', '/c/', '/d/', '/r/', '/s/'):
+            return bulk_request_error(item, "%r is not a URI that can be looked up." % uri)
+        grouped = item.get('grouped') is True
+        limit = get_int(item, 'limit', 20, 0, 100 if grouped else 1000)
+        return {
+            'type': 'lookup',
+            'uri': uri.rstrip('/'),
+            'grouped': grouped,
+            'offset': get_int(item, 'offset', 0, 0, 100000),
+            'limit': limit,
+            'after': bulk_after(item),
+        }
+    elif 'query' in item:
+        query = item['query']
+        if not isinstance(query, dict):
+            return bulk_request_error(item, "The query should be a JSON object.")
+        return {
+            'type': 'query',
+            'criteria': {
+                key: value for (key, value) in query.items()
+                if key in VALID_KEYS and isinstance(value, str)
+            },
+            'offset': get_int(item, 'offset', 0, 0, 100000),
+            'limit': get_int(item, 'limit', 50, 0, 1000),
+            'after': bulk_after(item),
+        }
+    elif 'related' in item:
+        uri = item['related']
+        if not isinstance(uri, str):
+            return bulk_request_error(item, "%r is not a URI." % uri)
+        filter = item.get('filter')
+        return {
+            'type': 'related',
+            'uri': '/' + uri.strip('/ '),
+            'filter': filter if isinstance(filter, str) else None,
+            'limit': get_int(item, 'limit', 50, 0, 100),
+        }
+    else:
+        return bulk_request_error(
+            item, "Each request should have a 'lookup', 'query', or 'related' key."
+        )
+
+
+def bulk_after(item):
+    after = item.get('after')
+    return after if isinstance(after, str) else None
+
+
+def bulk_request_error(item, details):
+    return {'type': 'error', 'response': error({'request': item}, 400, details)}
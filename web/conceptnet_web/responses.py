@@ -1,5 +1,9 @@
+from conceptnet5.db.query import RawEdge
 from conceptnet5.vectors.query import VectorSpaceWrapper
 from conceptnet5.nodes import standardized_concept_uri, ld_node
+import base64
+import binascii
+import json
 
 
 VECTORS = VectorSpaceWrapper()
@@ -10,6 +14,9 @@ CONTEXT = [
 ]
 VALID_KEYS = ['rel', 'start', 'end', 'node', 'other', 'source', 'uri']
 
+# How many of the requests to /bulk are looked up at once
+BULK_CHUNK_SIZE = 100
+
 
 def success(response):
     response['@context'] = CONTEXT
@@ -43,26 +50,74 @@ def groupkey_to_pairs(groupkey, term):
         return [('rel', rel), ('node', term)]
 
 
-def paginated_url(url, params, offset, limit):
+def encode_continuation_token(edge):
+    """
+    Make an opaque token that refers to the position just after the given
+    edge, in the order that edges are returned in (descending weight, then
+    URI). The edge can be a dictionary or a RawEdge.
+    """
+    if isinstance(edge, RawEdge):
+        position = [edge.weight, edge.uri]
+    else:
+        position = [edge['weight'], edge['@id']]
+    payload = json.dumps(position, ensure_ascii=False)
+    token = base64.urlsafe_b64encode(payload.encode('utf-8')).decode('ascii')
+    return token.rstrip('=')
+
+
+def decode_continuation_token(token):
+    """
+    Get the (weight, uri) pair from a token made by
+    `encode_continuation_token`, raising a ValueError if it's not a valid
+    token.
+    """
+    try:
+        padded = token + '=' * (-len(token) % 4)
+        weight, uri = json.loads(base64.urlsafe_b64decode(padded).decode('utf-8'))
+    except (binascii.Error, UnicodeDecodeError, TypeError, ValueError):
+        raise ValueError("%r is not a valid continuation token" % token)
+    if not isinstance(weight, (int, float)) or not isinstance(uri, str):
+        raise ValueError("%r is not a valid continuation token" % token)
+    return float(weight), uri
+
+
+def paginated_url(url, params, offset, limit, after=None):
     new_params = [
         (key, val) for (key, val) in params
-        if key != 'offset' and key != 'limit'
-    ] + [('offset', offset), ('limit', limit)]
+        if key not in ('offset', 'limit', 'after')
+    ]
+    if after is not None:
+        new_params.append(('after', after))
+    else:
+        new_params.append(('offset', offset))
+    new_params.append(('limit', limit))
     return make_query_url(url, new_params)
 
 
-def make_paginated_view(url, params, offset, limit, more):
+def make_paginated_view(url, params, offset, limit, more, after=None, next_token=None):
+    """
+    Describe how to get the pages of a paginated response.
+
+    If `next_token` is given, the link to the next page continues from that
+    token (see `encode_continuation_token`) instead of using an offset, and
+    the token itself appears in the view as 'continuationToken'. `after` is
+    the token that the current page was requested with, if any.
+    """
     prev_offset = max(0, offset - limit)
     next_offset = offset + limit
     pager = {
-        '@id': paginated_url(url, params, offset, limit),
+        '@id': paginated_url(url, params, offset, limit, after=after),
         'firstPage': paginated_url(url, params, 0, limit),
         'paginatedProperty': 'edges'
     }
-    if offset > 0:
+    if offset > 0 and after is None:
         pager['previousPage'] = paginated_url(url, params, prev_offset, limit)
     if more:
-        pager['nextPage'] = paginated_url(url, params, next_offset, limit)
+        if next_token is not None:
+            pager['nextPage'] = paginated_url(url, params, 0, limit, after=next_token)
+            pager['continuationToken'] = next_token
+        else:
+            pager['nextPage'] = paginated_url(url, params, next_offset, limit)
     return pager
 
 
@@ -77,9 +132,17 @@ def lookup_grouped_by_feature(term, filters=None, feature_limit=10):
             'Only concept nodes (starting with /c/) can be grouped by feature.'
         )
 
-    found = FINDER.lookup_grouped_by_feature(term, limit=(feature_limit + 1))
+    found = FINDER.lookup_feature_summary(term, limit=feature_limit)
+    return grouped_response(term, found, feature_limit, filters)
+
+
+def grouped_response(term, found, feature_limit, filters=None):
+    """
+    Make the response to `lookup_grouped_by_feature` from the feature
+    summary that it found.
+    """
     grouped = []
-    for groupkey, assertions in found.items():
+    for groupkey, (count, assertions) in found.items():
         direction, rel = groupkey
         base_url = '/query'
         feature_pairs = groupkey_to_pairs(groupkey, term)
@@ -89,10 +152,10 @@ def lookup_grouped_by_feature(term, filters=None, feature_limit=10):
             '@id': url,
             'weight': sum(assertion['weight'] for assertion in assertions),
             'feature': dict(feature_pairs),
-            'edges': assertions[:feature_limit],
+            'edges': assertions,
             'symmetric': symmetric
         }
-        if len(assertions) > feature_limit:
+        if count > len(assertions):
             view = make_paginated_view(base_url, feature_pairs, 0, feature_limit, more=True)
             group['view'] = view
 
@@ -110,18 +173,52 @@ def lookup_grouped_by_feature(term, filters=None, feature_limit=10):
         return success(response)
 
 
-def lookup_paginated(term, limit=50, offset=0):
+def lookup_paginated(term, limit=50, offset=0, after=None, keyset=False, raw=False):
+    """
+    Look up the edges of a URI, one page at a time.
+
+    `after` is a continuation token from a previous page. If `keyset` is
+    True, the link to the next page will use a continuation token instead
+    of an offset. If `raw` is True, the edges are RawEdge strings of JSON,
+    which only `json_rendering.jsonify` knows how to output.
+    """
+    try:
+        after_key = decode_continuation_token(after) if after is not None else None
+    except ValueError as err:
+        return error({'@id': term}, 400, str(err))
+
     # Query one more edge than asked for, so we know if there are more
-    found = FINDER.lookup(term, limit=(limit + 1), offset=offset)
+    found = FINDER.lookup(term, limit=(limit + 1), offset=offset, after=after_key, raw=raw)
+    return lookup_response(term, found, limit, offset, after, keyset)
+
+
+def lookup_response(term, found, limit, offset, after, keyset):
+    """
+    Make the response to `lookup_paginated`, given the edges it found,
+    including one more edge than `limit` if there are more.
+    """
+    # Dataset samples are in a random order, not by weight, so they can only
+    # be paged through by offset
+    if term.startswith('/d/'):
+        if after is not None:
+            return error(
+                {'@id': term}, 400,
+                "Datasets are paged through with 'offset', not 'after'."
+            )
+        keyset = False
+
     edges = found[:limit]
     response = {
         '@id': term,
         'edges': edges
     }
     more = len(found) > len(edges)
-    if len(found) > len(edges) or offset != 0:
+    if more or offset != 0 or after is not None:
+        next_token = None
+        if more and edges and (keyset or after is not None):
+            next_token = encode_continuation_token(edges[-1])
         response['view'] = make_paginated_view(
-            term, (), offset, limit, more=more
+            term, (), offset, limit, more=more, after=after, next_token=next_token
         )
     if not found:
         return error(response, 404, '%r is not a node in ConceptNet.' % term)
@@ -131,6 +228,10 @@ def lookup_paginated(term, limit=50, offset=0):
 
 def lookup_single_assertion(uri):
     found = FINDER.lookup(uri, limit=1)
+    return assertion_response(uri, found)
+
+
+def assertion_response(uri, found):
     response = {
         '@id': uri
     }
@@ -142,6 +243,19 @@ def lookup_single_assertion(uri):
 
 
 def query_related(uri, filter=None, limit=20):
+    query, failure = related_query(uri)
+    if failure is not None:
+        return failure
+    found = VECTORS.similar_terms(query, filter=filter, limit=limit)
+    return related_response(uri, found)
+
+
+def related_query(uri):
+    """
+    Get the vector space query for a URI that `query_related` was asked
+    about. Returns a pair of the query and None, or None and an error
+    response if the URI can't be used.
+    """
     if uri.startswith('/c/'):
         query = uri
     elif uri.startswith('/list/') and uri.count('/') >= 3:
@@ -158,17 +272,19 @@ def query_related(uri, filter=None, limit=20):
                     weight = 1.
                 query.append(('/c/{}/{}'.format(language, term), weight))
         except ValueError:
-            return error(
+            return None, error(
                 {'@id': uri}, 400,
                 "Couldn't parse this term list: %r" % uri
             )
     else:
-        return error(
+        return None, error(
             {'@id': uri}, 404,
             '%r is not something that I can find related terms to.' % uri
         )
+    return query, None
 
-    found = VECTORS.similar_terms(query, filter=filter, limit=limit)
+
+def related_response(uri, found):
     related = [
         {'@id': key, 'weight': round(float(weight), 3)}
         for (key, weight) in found.items()
@@ -180,21 +296,152 @@ def query_related(uri, filter=None, limit=20):
     return response
 
 
-def query_paginated(query, offset=0, limit=50):
-    found = FINDER.query(query, limit=limit + 1, offset=offset)
+def query_paginated(query, offset=0, limit=50, after=None, keyset=False, raw=False):
+    """
+    Find the edges matching a query, one page at a time. `after`, `keyset`,
+    and `raw` work as in `lookup_paginated`.
+    """
+    query_id = make_query_url('/query', query.items())
+    try:
+        after_key = decode_continuation_token(after) if after is not None else None
+    except ValueError as err:
+        return error({'@id': query_id}, 400, str(err))
+
+    found = FINDER.query(query, limit=limit + 1, offset=offset, after=after_key, raw=raw)
+    return query_response(query, found, limit, offset, after, keyset)
+
+
+def query_response(query, found, limit, offset, after, keyset):
+    """
+    Make the response to `query_paginated`, given the edges it found,
+    including one more edge than `limit` if there are more.
+    """
+    query_id = make_query_url('/query', query.items())
     edges = found[:limit]
     response = {
-        '@id': make_query_url('/query', query.items()),
+        '@id': query_id,
         'edges': edges
     }
     more = len(found) > len(edges)
-    if len(found) > len(edges) or offset != 0:
+    if more or offset != 0 or after is not None:
+        next_token = None
+        if more and edges and (keyset or after is not None):
+            next_token = encode_continuation_token(edges[-1])
         response['view'] = make_paginated_view(
-            '/query', sorted(query.items()), offset, limit, more=more
+            '/query', sorted(query.items()), offset, limit, more=more,
+            after=after, next_token=next_token
         )
     return success(response)
 
 
+def search_terms(method, language, text, limit=10):
+    """
+    Find the terms that complete some partly-typed text (when `method` is
+    'prefix') or that resemble it (when `method` is 'fuzzy'), ranked by
+    their number of edges.
+    """
+    if method == 'prefix':
+        found = FINDER.complete_terms(language, text, limit=limit)
+    else:
+        found = FINDER.fuzzy_terms(language, text, limit=limit)
+    return search_response(method, language, text, limit, found)
+
+
+def search_response(method, language, text, limit, found):
+    """
+    Make the response to `search_terms` from the (uri, edge_count) pairs
+    that it found.
+    """
+    query_id = make_query_url(
+        '/search/' + method, [('language', language), ('text', text), ('limit', limit)]
+    )
+    terms = []
+    for uri, edge_count in found:
+        term = ld_node(uri)
+        term['edge_count'] = edge_count
+        terms.append(term)
+    response = {
+        '@id': query_id,
+        'terms': terms
+    }
+    return success(response)
+
+
+def bulk_responses(requests, chunk_size=BULK_CHUNK_SIZE):
+    """
+    Yield the responses to a list of requests for the /bulk endpoint, in
+    order. Each request is a dictionary made by `api.parse_bulk_request`,
+    whose 'type' is 'lookup', 'query', 'related', or 'error'.
+
+    The requests are handled `chunk_size` at a time, so that the first
+    responses can be sent while later ones are being looked up. Within a
+    chunk, the lookups of concepts are combined into one database query,
+    and the related-term queries into one pass over the vector space. If
+    the data becomes unavailable partway through, the rest of the
+    responses are errors.
+    """
+    for start in range(0, len(requests), chunk_size):
+        chunk = requests[start:start + chunk_size]
+        try:
+            results = _bulk_chunk(chunk)
+        except IOError as err:
+            results = [error({}, 503, str(err)) for request in chunk]
+        yield from results
+
+
+def _bulk_chunk(requests):
+    results = [None] * len(requests)
+    node_lookups = {}
+    related_queries = []
+    for i, request in enumerate(requests):
+        kind = request['type']
+        if kind == 'error':
+            results[i] = request['response']
+        elif kind == 'lookup':
+            uri = request['uri']
+            if request['grouped']:
+                results[i] = lookup_grouped_by_feature(uri, feature_limit=request['limit'])
+            elif uri.startswith('/a/'):
+                results[i] = lookup_single_assertion(uri)
+            elif uri.startswith('/c/') and request['offset'] == 0 and request['after'] is None:
+                node_lookups.setdefault(request['limit'], []).append(i)
+            else:
+                results[i] = lookup_paginated(
+                    uri, offset=request['offset'], limit=request['limit'],
+                    after=request['after'], keyset=True
+                )
+        elif kind == 'query':
+            results[i] = query_paginated(
+                request['criteria'], offset=request['offset'], limit=request['limit'],
+                after=request['after'], keyset=True
+            )
+        elif kind == 'related':
+            query, failure = related_query(request['uri'])
+            if failure is not None:
+                results[i] = failure
+            else:
+                related_queries.append((i, query, request['filter'], request['limit']))
+        else:
+            raise ValueError("Unknown kind of bulk request: %r" % kind)
+
+    # The first page of a concept's edges is the same as what lookup_many
+    # finds for it, so look up the concepts that want the same number of
+    # edges together
+    for limit, indices in node_lookups.items():
+        uris = [requests[i]['uri'] for i in indices]
+        found = FINDER.lookup_many(uris, limit_per_uri=limit + 1)
+        for i, uri in zip(indices, uris):
+            results[i] = lookup_response(uri, found[uri], limit, 0, None, True)
+
+    if related_queries:
+        found = VECTORS.similar_terms_many([
+            (query, filter, limit) for (i, query, filter, limit) in related_queries
+        ])
+        for (i, query, filter, limit), similar in zip(related_queries, found):
+            results[i] = related_response(requests[i]['uri'], similar)
+    return results
+
+
 def standardize_uri(language, text):
     """
     Look up the URI for a given piece of text. 'text' and 'language' should be
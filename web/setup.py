@@ -25,5 +25,11 @@ setup(
         'limits', 'flask==0.11', 'flask-cors', 'flask-limiter',
         'langcodes >= 1.3', 'jinja2-highlight', 'pygments', 'raven[flask]'
     ],
+    extras_require={
+        # For serving the API from conceptnet_web.asgi
+        'asgi': ['uvicorn'],
+        # For faster JSON encoding and Brotli compression of responses
+        'fast': ['orjson', 'brotli'],
+    },
     license = 'Apache License 2.0',
 )